@@ -0,0 +1,39 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from homestage.model import AnalysisSchema, decode_analysis
+from payloads import make_analysis_payload
+
+
+def timed(fn, payload, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(payload)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time decoding of /api/media/ analysis payloads')
+    parser.add_argument('--duration', type=float, default=240.0, help='track length in seconds')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    schema = AnalysisSchema()
+    for shuffle in (False, True):
+        payload = make_analysis_payload(args.duration, shuffle=shuffle)
+        marshmallow = timed(schema.load, payload, args.repeat)
+        decoder = timed(decode_analysis, payload, args.repeat)
+        order = 'shuffled' if shuffle else 'ordered'
+        print(f"{len(payload['segments'])} segments, {order:8}: marshmallow {marshmallow * 1000:8.2f} ms, "
+              f"decode_analysis {decoder * 1000:7.2f} ms ({marshmallow / decoder:.0f}x)")
+
+
+if __name__ == '__main__':
+    main()
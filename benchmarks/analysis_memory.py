@@ -0,0 +1,73 @@
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from homestage.model import Section, Segment, TimingList
+from payloads import make_analysis_payload
+
+
+# The object layout segments and sections had before they were stored in columns, kept here for comparison
+class LegacySection:
+    def __init__(self, start, duration, loudness=None, tempo=None):
+        self.start = start
+        self.duration = duration
+        self.loudness = loudness
+        self.tempo = tempo
+
+
+class LegacySegment:
+    def __init__(self, start, duration, loudness_start=None, loudness_max=None, loudness_max_time=None,
+                 loudness_end=None, pitches=None, timbre=None):
+        self.start = start
+        self.duration = duration
+        self.loudness_start = loudness_start
+        self.loudness_max = loudness_max
+        self.loudness_max_time = loudness_max_time
+        self.loudness_end = loudness_end
+        self.pitches = pitches
+        self.timbre = timbre
+
+
+def build_legacy(payload):
+    # fresh float lists, like the ones marshmallow's fields.List(fields.Float) produced
+    return ([LegacySection(**s) for s in payload['sections']],
+            [LegacySegment(**{k: list(map(float, v)) if isinstance(v, list) else v for k, v in s.items()})
+             for s in payload['segments']])
+
+
+def build_columnar(payload):
+    return (TimingList([Section(**s) for s in payload['sections']], Section),
+            TimingList([Segment(**s) for s in payload['segments']], Segment))
+
+
+def measure(build, payload):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(payload)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-track memory footprint of analysis timelines')
+    parser.add_argument('--duration', type=float, default=240.0, help='track length in seconds')
+    args = parser.parse_args()
+
+    payload = make_analysis_payload(args.duration)
+    print(f"{len(payload['segments'])} segments, {len(payload['sections'])} sections")
+    legacy = measure(build_legacy, payload)
+    columnar = measure(build_columnar, payload)
+    print(f"legacy objects: {legacy / 1024:10.1f} KiB")
+    print(f"columnar:       {columnar / 1024:10.1f} KiB ({legacy / columnar:.1f}x smaller)")
+
+
+if __name__ == '__main__':
+    main()
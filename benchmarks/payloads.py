@@ -0,0 +1,51 @@
+import random
+
+
+def make_analysis_payload(duration: float = 240.0, segment_length: float = 0.25, section_length: float = 20.0,
+                          seed: int = 0, shuffle: bool = False):
+    # Roughly the shape of a Spotify audio analysis: ~1000 segments and a dozen sections for a 4 minute track
+    rng = random.Random(seed)
+    sections = []
+    start = 0.0
+    while start < duration:
+        length = section_length * rng.uniform(0.5, 1.5)
+        sections.append({
+            'start': start,
+            'duration': length,
+            'loudness': rng.uniform(-20, -3),
+            'tempo': rng.uniform(90, 130),
+        })
+        start += length
+
+    segments = []
+    start = 0.0
+    while start < duration:
+        length = segment_length * rng.uniform(0.3, 1.7)
+        segments.append({
+            'start': start,
+            'duration': length,
+            'loudness_start': rng.uniform(-40, -10),
+            'loudness_max': rng.uniform(-20, 0),
+            'loudness_max_time': rng.uniform(0, length),
+            'loudness_end': rng.uniform(-40, -10),
+            'pitches': [rng.random() for _ in range(12)],
+            'timbre': [rng.uniform(-100, 100) for _ in range(12)],
+        })
+        start += length
+
+    if shuffle:
+        rng.shuffle(sections)
+        rng.shuffle(segments)
+
+    return {
+        'danceability': rng.random(),
+        'energy': rng.random(),
+        'loudness': rng.uniform(-20, -3),
+        'speechiness': rng.random(),
+        'acousticness': rng.random(),
+        'instrumentalness': rng.random(),
+        'liveness': rng.random(),
+        'valence': rng.random(),
+        'sections': sections,
+        'segments': segments,
+    }
@@ -0,0 +1,65 @@
+import argparse
+import logging
+import os
+import re
+
+from homestage.controller import StageConfig
+from homestage.render import OfflineRenderer, load_analysis, pattern_names, scale_fixtures
+
+
+def output_path(path: str, pattern: str, size: int) -> str:
+    # frames.dmx -> frames-beat-match-rainbow-8.dmx
+    stem, extension = os.path.splitext(path)
+    return f"{stem}-{re.sub(r'[^a-z0-9]+', '-', pattern.lower()).strip('-')}-{size}{extension}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render patterns offline and report how long frames take')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--pattern', action='append', help='pattern name, can be repeated (default: all)')
+    parser.add_argument('--analysis', help='media analysis JSON, either an /api/media/ payload or its analysis')
+    parser.add_argument('--audio', help='WAV file to analyze (default: a 120 BPM click track)')
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--fps', type=float, default=60)
+    parser.add_argument('--rig-sizes', default='', help='comma separated fixture counts (default: as configured)')
+    parser.add_argument('--output', help='file name to write the rendered DMX frames to, back to back (every '
+                                         'universe of a frame in turn); each run gets its own file, named after '
+                                         'it with the pattern and fixture count added before the extension')
+    parser.add_argument('--allocations', action='store_true', help='also trace allocations (slower)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING,
+                        format="%(asctime)s (%(levelname)s) [%(name)s] %(message)s",
+                        datefmt="%H:%M:%S")
+
+    config = StageConfig(args.config)
+    config.load()
+    if not config.fixtures:
+        parser.error(f'{args.config} has no fixtures')
+
+    patterns = args.pattern or pattern_names(config)
+    # None renders the configured rig as it is
+    sizes = [int(n) for n in args.rig_sizes.split(',') if n] or [None]
+    analysis = load_analysis(args.analysis) if args.analysis else None
+
+    print(f"{'pattern':30} {'fixtures':>8} {'frames/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8}" + (f" {'peak KiB':>9} {'blocks':>7}" if args.allocations else ''))
+    for pattern in patterns:
+        for size in sizes:
+            fixtures = scale_fixtures(config.fixtures, size, config.sacn_universe)
+            renderer = OfflineRenderer(config, fixtures, pattern, analysis, args.audio, args.fps)
+            out = open(output_path(args.output, pattern, len(fixtures)), 'wb') if args.output else None
+            try:
+                stats = renderer.render(args.seconds, out, args.allocations)
+            finally:
+                if out:
+                    out.close()
+            line = (f"{pattern:30} {len(fixtures):8d} {stats['fps']:10.0f} {stats['p50'] * 1000:8.3f} "
+                    f"{stats['p95'] * 1000:8.3f} {stats['p99'] * 1000:8.3f} {stats['max'] * 1000:8.3f}")
+            if args.allocations:
+                line += f" {stats['peak_bytes'] / 1024:9.1f} {stats['net_blocks']:7.1f}"
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
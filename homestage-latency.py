@@ -0,0 +1,73 @@
+import argparse
+import json
+import logging
+
+from homestage.backends import BACKENDS
+from homestage.controller import StageConfig
+from homestage.latency import LatencyHarness
+from homestage.render import scale_fixtures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure how long audio takes to reach the wire as DMX, using '
+                                                 'a synthetic click track and a receiver on localhost')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--backend', choices=[b for b in BACKENDS if b != 'null'],
+                        help='output backend (default: as configured)')
+    parser.add_argument('--fixtures', type=int, help='fixture count (default: as configured)')
+    parser.add_argument('--interval', type=float, default=0.5, help='mean seconds between clicks')
+    parser.add_argument('--jitter', type=float, default=0.25, help='click interval spread, as a fraction of it')
+    parser.add_argument('--hold', type=float, default=0.1, help='seconds the rig stays lit after each click')
+    parser.add_argument('--json', help='file to write the full results to')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING,
+                        format="%(asctime)s (%(levelname)s) [%(name)s] %(message)s",
+                        datefmt="%H:%M:%S")
+
+    config = StageConfig(args.config)
+    config.load()
+    if not config.fixtures:
+        parser.error(f'{args.config} has no fixtures')
+    if args.backend:
+        config.output_backend = args.backend
+    fixtures = config.fixtures
+    if args.fixtures:
+        fixtures = scale_fixtures(fixtures, args.fixtures, config.sacn_universe)
+
+    harness = LatencyHarness(config, fixtures, args.interval, args.jitter, args.hold)
+    results = harness.run(args.seconds)
+
+    latency = results['latency']
+    packets = results['packets']
+    wire = results['wire_frames']
+    render = results['render']
+    print(f"{results['backend']}: {results['fixtures']} fixtures in {results['universes']} universes")
+    print(f"{'':16} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for key in ('audio_to_wire', 'analysis', 'audio_to_frame', 'frame_to_wire'):
+        stats = latency[key]
+        if stats['count']:
+            print(f"{key:16} {stats['count']:6d} {stats['p50'] * 1000:8.2f} {stats['p95'] * 1000:8.2f} "
+                  f"{stats['p99'] * 1000:8.2f} {stats['max'] * 1000:8.2f}")
+        else:
+            print(f"{key:16} {0:6d}")
+    print(f"clicks: {latency['events']}, missed on the wire: {latency['missed']}")
+    print(f"packets: {packets['received']} received, {packets['lost']} lost ({packets['loss'] * 100:.3f}%), "
+          f"{packets['reordered']} reordered, {packets['syncs']} sync")
+    if packets['missing_universes']:
+        print(f"universes never seen: {packets['missing_universes']}")
+    interval = wire['interval']
+    if interval['count']:
+        print(f"wire: {wire['fps']:.2f} frames/s, interval p50 {interval['p50'] * 1000:.2f} ms, "
+              f"p99 {interval['p99'] * 1000:.2f} ms, std {interval['std'] * 1000:.2f} ms, {wire['late']} late")
+    print(f"render: {render['frames']} frames at {render['fps']:.0f} fps, {render['dropped']} dropped, "
+          f"jitter p99 {(render['jitter']['p99'] or 0) * 1000:.2f} ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, default=float)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,13 +4,16 @@ import logging
 from engineio.payload import Payload
 
 from homestage.api import WebServer
+from homestage.backends import create_backend
 from homestage.controller import HomeStage, StageConfig
-from homestage.outputs import PatchedsACNSender
+from homestage.processes import MultiProcessStage
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', default='config.json')
+    parser.add_argument('--processes', action='store_true',
+                        help='run audio analysis and rendering in their own processes')
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO,
@@ -25,11 +28,11 @@ def main():
     config.save()
 
     Payload.max_decode_packets = 500
-    output = PatchedsACNSender(fps=60, bind_address=config.sacn_bind_address)
-    output.activate_output(config.sacn_universe)
-    output[config.sacn_universe].multicast = config.sacn_multicast
-    output[config.sacn_universe].destination = config.sacn_destination
-    stage = HomeStage(config, config.fixtures, output)
+    output = create_backend(config)
+    if args.processes:
+        stage = MultiProcessStage(config, output)
+    else:
+        stage = HomeStage(config, config.fixtures, output)
     server = WebServer(stage)
 
     stage.start()
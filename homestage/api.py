@@ -1,8 +1,85 @@
+import threading
+import time
+
 from flask import Flask, request, jsonify, render_template, redirect
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
+from marshmallow import ValidationError
 
 from homestage.controller import HomeStage
-from homestage.model import MediaSchema, StartDateTimeSchema
+from homestage.model import MediaSchema, StartDateTimeSchema, decode_analysis
+
+STATUS_ROOM = 'status'
+
+
+# Builds one status snapshot per tick and emits it to every client in the status room, so the cost doesn't grow
+# with the number of open tabs or how fast they draw. Clients acknowledge each snapshot's sequence number; one
+# with max_pending snapshots still unacknowledged is left out of the broadcasts until it catches up, so a slow
+# client gets the newest snapshot instead of a growing backlog.
+class StatusBroadcaster:
+    def __init__(self, socketio: SocketIO, stage: HomeStage, rate: float = 30.0, max_pending: int = 2):
+        self.socketio = socketio
+        self.stage = stage
+        self.period = 1 / rate
+        self.max_pending = max_pending
+        self.sequence = 0
+        # sid -> [last sequence sent, last sequence acknowledged]
+        self.clients = {}
+        self.latest = None
+        self.lock = threading.Lock()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = self.socketio.start_background_task(self._run)
+
+    def subscribe(self, sid):
+        with self.lock:
+            self.clients[sid] = [self.sequence, self.sequence]
+
+    def unsubscribe(self, sid):
+        with self.lock:
+            self.clients.pop(sid, None)
+
+    def ack(self, sid, sequence: int):
+        with self.lock:
+            client = self.clients.get(sid)
+            if client is not None:
+                client[1] = max(client[1], min(sequence, client[0]))
+
+    def snapshot(self):
+        state = self.stage.state
+        media = state.media
+        return {
+            'sequence': self.sequence,
+            'enabled': self.stage.enabled,
+            'beat': bool(state.beat),
+            'currentTempo': state.current_tempo,
+            'spectrumAdjusted': state.spectrum_adjusted.tolist(),
+            'media': {
+                'artist': media.artist,
+                'title': media.title,
+                'uri': media.uri,
+                'type': media.type,
+                'position': media.position,
+            }
+        }
+
+    def _run(self):
+        deadline = time.perf_counter()
+        while True:
+            # after a stall, carry on from now rather than sending the missed ticks back to back
+            deadline = max(deadline + self.period, time.perf_counter())
+            self.socketio.sleep(max(0.0, deadline - time.perf_counter()))
+            with self.lock:
+                lagging = [sid for sid, (sent, acked) in self.clients.items() if sent - acked >= self.max_pending]
+                if len(lagging) == len(self.clients):
+                    continue
+                self.sequence += 1
+                for sid, client in self.clients.items():
+                    if sid not in lagging:
+                        client[0] = self.sequence
+            self.latest = self.snapshot()
+            self.socketio.emit('status', self.latest, room=STATUS_ROOM, skip_sid=lagging or None)
 
 
 class WebServer:
@@ -15,6 +92,7 @@ class WebServer:
         app = Flask(__name__)
         app.config['SECRET_KEY'] = config.http_secret_key
         socketio = SocketIO(app)
+        broadcaster = StatusBroadcaster(socketio, self.stage, config.http_status_rate)
 
         def send_config():
             emit('status', {
@@ -28,40 +106,31 @@ class WebServer:
                 } if config.microphone else None,
             })
 
-        def send_status():
-            emit('status', {
-                'enabled': self.stage.enabled,
-                'beat': bool(self.stage.state.beat),
-                'currentTempo': self.stage.state.current_tempo,
-                'spectrumAdjusted': list(self.stage.state.spectrum_adjusted),
-                'media': {
-                    'artist': self.stage.state.media.artist,
-                    'title': self.stage.state.media.title,
-                    'uri': self.stage.state.media.uri,
-                    'type': self.stage.state.media.type,
-                    'position': self.stage.state.media.position,
-                }
-            })
-
         @app.route('/api/media/', methods=['POST'])
         def new_song():
             data = request.get_json()
-            result = MediaSchema().load(data)
-            if len(result.errors):
-                return jsonify({'errors': result.errors}, 401)
-            else:
-                self.stage.state.reset(result.data)
-                return jsonify({"success": True})
+            if not isinstance(data, dict):
+                return jsonify({'errors': {'_schema': ['Invalid input type.']}}), 400
+            # the analysis arrays skip marshmallow and go straight into columns
+            try:
+                media = MediaSchema().load({k: v for k, v in data.items() if k != 'analysis'})
+            except ValidationError as e:
+                return jsonify({'errors': e.messages}), 400
+            try:
+                media.analysis = decode_analysis(data.get('analysis'))
+            except ValidationError as e:
+                return jsonify({'errors': {'analysis': e.messages}}), 400
+            self.stage.load_media(media)
+            return jsonify({"success": True})
 
         @app.route('/api/media/position/', methods=['POST'])
         def position():
-            data = request.get_json()
-            result = StartDateTimeSchema().load(data)
-            if len(result.errors):
-                return jsonify({'errors': result.errors}, 401)
-            else:
-                self.stage.state.media.start_datetime = result.data
-                return jsonify({"success": True})
+            try:
+                start_datetime = StartDateTimeSchema().load(request.get_json())
+            except ValidationError as e:
+                return jsonify({'errors': e.messages}), 400
+            self.stage.sync_media(start_datetime)
+            return jsonify({"success": True})
 
         @app.route('/api/enabled/', methods=['POST'])
         def update_status():
@@ -72,28 +141,49 @@ class WebServer:
                 self.stage.enabled = False
             return jsonify({"success": True})
 
+        @app.route('/api/stats/', methods=['GET'])
+        def stats():
+            return jsonify(self.stage.stats())
+
         @app.route('/')
         def control():
             return render_template('ui.html')
 
         @app.route('/card', methods=['get'])
         def card():
-            return render_template('card.html', current_pattern=self.stage.controller.pattern.name)
+            return render_template('card.html', current_pattern=self.stage.pattern_name)
 
         @app.route('/card/next', methods=['post'])
         def next_card():
-            self.stage.controller.pattern.next_pattern()
+            self.stage.next_pattern()
             return card()
 
         @socketio.on('initialize')
         def initialize(message):
             send_config()
-            send_status()
+
+        @socketio.on('subscribe')
+        def subscribe(message):
+            join_room(STATUS_ROOM)
+            broadcaster.subscribe(request.sid)
+            emit('status', broadcaster.latest or broadcaster.snapshot())
+
+        @socketio.on('unsubscribe')
+        def unsubscribe(message):
+            leave_room(STATUS_ROOM)
+            broadcaster.unsubscribe(request.sid)
+
+        @socketio.on('statusack')
+        def status_ack(sequence):
+            broadcaster.ack(request.sid, int(sequence))
+
+        @socketio.on('disconnect')
+        def disconnect():
+            broadcaster.unsubscribe(request.sid)
 
         @socketio.on('setmicrophone')
         def set_microphone(message):
-            config.microphone = str(message['value']) if message is not None else None
-            config.save()
+            self.stage.set_microphone(str(message['value']) if message is not None else None)
             send_config()
 
         @socketio.on('setcontrol')
@@ -104,10 +194,6 @@ class WebServer:
                 setattr(self.stage.control, key, bool(message[key]))
             for key in ('lt', 'rt'):
                 setattr(self.stage.control, key, float(message[key]))
-            send_status()
-
-        @socketio.on('poll')
-        def poll(message):
-            send_status()
 
+        broadcaster.start()
         socketio.run(app, debug=config.debug, host=config.http_bind_address, port=config.http_port)
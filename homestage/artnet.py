@@ -0,0 +1,47 @@
+import struct
+
+import numpy as np
+
+from homestage.universe import UNIVERSE_SIZE
+
+ARTNET_PORT = 6454
+ARTNET_ID = b'Art-Net\x00'
+ARTNET_VERSION = 14
+OP_DMX = 0x5000
+OP_SYNC = 0x5200
+
+SEQUENCE_OFFSET = 12
+DMX_OFFSET = 18
+
+
+# One port-address's ArtDmx packet, built once; like E131Packet only the slots and the sequence change per send
+class ArtDmxPacket:
+    def __init__(self, port_address: int, slots: int = UNIVERSE_SIZE):
+        if not 0 <= port_address < 1 << 15:
+            raise ValueError(f'Art-Net port-address {port_address} out of range')
+        slots += slots % 2
+        self.port_address = port_address
+        self.buffer = bytearray(DMX_OFFSET + slots)
+        struct.pack_into('<8sH', self.buffer, 0, ARTNET_ID, OP_DMX)
+        struct.pack_into('>HBBBBH', self.buffer, 10, ARTNET_VERSION, 0, 0, port_address & 0xff,
+                         port_address >> 8 & 0x7f, slots)
+        self.view = memoryview(self.buffer)
+        self.dmx = np.frombuffer(self.buffer, dtype=np.uint8, count=slots, offset=DMX_OFFSET)
+        # 0 means sequencing is off, so it counts 1..255
+        self.sequence = 1
+
+    def next(self) -> memoryview:
+        self.buffer[SEQUENCE_OFFSET] = self.sequence
+        self.sequence = self.sequence % 255 + 1
+        return self.view
+
+
+class ArtSyncPacket:
+    def __init__(self):
+        self.buffer = bytearray(14)
+        struct.pack_into('<8sH', self.buffer, 0, ARTNET_ID, OP_SYNC)
+        struct.pack_into('>HBB', self.buffer, 10, ARTNET_VERSION, 0, 0)
+        self.view = memoryview(self.buffer)
+
+    def next(self) -> memoryview:
+        return self.view
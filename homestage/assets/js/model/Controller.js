@@ -22,6 +22,7 @@ export default class {
   animationFrameRequestId;
   socket;
   lastSendTime = 0;
+  lastControl = null;
   updateInterval = 10;
 
   @computed
@@ -36,8 +37,17 @@ export default class {
 
     this.socket.on('status', this.update);
 
+    // the server pushes status to subscribers; acknowledging each one lets it skip this client while it's behind
+    this.socket.on('status', data => {
+      if (data.sequence !== undefined) {
+        this.socket.emit('statusack', data.sequence);
+      }
+    });
+
     this.socket.on('connect', () => {
       this.socket.emit('initialize', {});
+      this.socket.emit('subscribe', {});
+      this.lastControl = null;
       this.connected = true;
     });
 
@@ -68,7 +78,7 @@ export default class {
     }
 
     if (this.gamepad) {
-      this.socket.emit('setcontrol', {
+      const control = {
         axis0: [this.gamepad.axes[0], this.gamepad.axes[1]],
         axis1: [this.gamepad.axes[2], this.gamepad.axes[3]],
         lb: buttonPressed(this.gamepad.buttons[4]),
@@ -83,9 +93,13 @@ export default class {
         square: buttonPressed(this.gamepad.buttons[2]),
         circle: buttonPressed(this.gamepad.buttons[1]),
         cross: buttonPressed(this.gamepad.buttons[0]),
-      });
-    } else {
-      this.socket.emit('poll', {});
+      };
+      // only send the gamepad when it changes
+      const encoded = JSON.stringify(control);
+      if (encoded !== this.lastControl) {
+        this.lastControl = encoded;
+        this.socket.emit('setcontrol', control);
+      }
     }
   }
 
@@ -107,9 +121,8 @@ export default class {
         }
 
         this._sendUpdate();
+        this.lastSendTime = now;
       }
-
-      this.lastSendTime = now;
     } finally {
       this.animationFrameRequestId = requestAnimationFrame(this.loop);
     }
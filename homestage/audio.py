@@ -0,0 +1,317 @@
+import math
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+import numpy as np
+
+WINDOWS = {
+    'rectangular': np.ones,
+    'hann': np.hanning,
+    'hamming': np.hamming,
+    'blackman': np.blackman,
+}
+
+
+# Per-band spectrum history stored as a (bands x size) ring buffer. Each push writes one column in place and
+# keeps the window max/min in monotonic deques and the short-window average as a running sum, so the cost per
+# block doesn't depend on the history size.
+class SpectrumHistory:
+    def __init__(self, band_count: int, size: int, average_size: int):
+        if not 0 < average_size <= size:
+            raise ValueError(f'average_size must be in (0, {size}], got {average_size}')
+        self.band_count = band_count
+        self.size = size
+        self.average_size = average_size
+        self.data = np.zeros((band_count, size))
+        self.head = -1
+        self.count = 0
+        self._sum = np.zeros(band_count)
+        self._maximum = np.zeros(band_count)
+        self._minimum = np.zeros(band_count)
+        # the buffer starts out zero-filled, so each deque starts with the newest of those zeros
+        self._max_queues = [deque([(-1, 0.0)]) for _ in range(band_count)]
+        self._min_queues = [deque([(-1, 0.0)]) for _ in range(band_count)]
+
+    def push(self, values):
+        head = self.count % self.size
+        index = self.count
+        expired = index - self.size
+
+        leaving = self.data[:, (head - self.average_size) % self.size]
+        self._sum += values
+        self._sum -= leaving
+        self.data[:, head] = values
+        self.head = head
+        self.count += 1
+
+        # refresh the short-window sum every lap so float error can't accumulate
+        if head == self.size - 1:
+            self._recompute_sum()
+
+        for i in range(self.band_count):
+            value = float(values[i])
+
+            queue = self._max_queues[i]
+            while queue and queue[-1][1] <= value:
+                queue.pop()
+            queue.append((index, value))
+            if queue[0][0] <= expired:
+                queue.popleft()
+            self._maximum[i] = queue[0][1]
+
+            queue = self._min_queues[i]
+            while queue and queue[-1][1] >= value:
+                queue.pop()
+            queue.append((index, value))
+            if queue[0][0] <= expired:
+                queue.popleft()
+            self._minimum[i] = queue[0][1]
+
+    def _recompute_sum(self):
+        newest = (self.head - np.arange(self.average_size)) % self.size
+        self._sum[:] = self.data[:, newest].sum(axis=1)
+
+    @property
+    def maximum(self) -> np.ndarray:
+        return self._maximum
+
+    @property
+    def minimum(self) -> np.ndarray:
+        return self._minimum
+
+    @property
+    def average(self) -> np.ndarray:
+        return self._sum / self.average_size
+
+    def latest(self, n: int) -> np.ndarray:
+        # newest first, like the old np.roll'd arrays
+        return self.data[:, (self.head - np.arange(n)) % self.size]
+
+
+def hz_to_mel(f):
+    return 2595 * np.log10(1 + np.asarray(f) / 700)
+
+
+def mel_to_hz(m):
+    return 700 * (10 ** (np.asarray(m) / 2595) - 1)
+
+
+def _rectangular_filterbank(edges, bin_count, bin_width):
+    bank = np.zeros((len(edges) - 1, bin_count))
+    for i, (lower, upper) in enumerate(zip(edges[:-1], edges[1:])):
+        lower = min(int(lower / bin_width), bin_count - 1)
+        upper = max(lower + 1, min(int(upper / bin_width), bin_count))
+        bank[i, lower:upper] = 1 / (upper - lower)
+    return bank
+
+
+def octave_filterbank(band_count, sample_rate, fft_size, min_frequency=None):
+    # the top band ends at Nyquist and each band below it is an octave lower, the lowest one reaching down to 0 Hz
+    edges = [0] + [sample_rate * 2 ** (x - band_count) for x in range(band_count)]
+    return _rectangular_filterbank(edges, fft_size // 2 + 1, sample_rate / fft_size)
+
+
+def log_filterbank(band_count, sample_rate, fft_size, min_frequency=20.0):
+    edges = np.geomspace(min_frequency, sample_rate / 2, band_count + 1)
+    return _rectangular_filterbank(edges, fft_size // 2 + 1, sample_rate / fft_size)
+
+
+def mel_filterbank(band_count, sample_rate, fft_size, min_frequency=20.0):
+    bin_count = fft_size // 2 + 1
+    frequencies = np.arange(bin_count) * sample_rate / fft_size
+    points = mel_to_hz(np.linspace(hz_to_mel(min_frequency), hz_to_mel(sample_rate / 2), band_count + 2))
+    bank = np.zeros((band_count, bin_count))
+    for i in range(band_count):
+        lower, center, upper = points[i:i + 3]
+        rising = (frequencies - lower) / (center - lower)
+        falling = (upper - frequencies) / (upper - center)
+        bank[i] = np.maximum(0, np.minimum(rising, falling))
+        if not bank[i].any():
+            # narrower than one bin: use the nearest bin
+            bank[i, int(round(center * fft_size / sample_rate))] = 1
+    return bank / bank.sum(axis=1, keepdims=True)
+
+
+BAND_LAYOUTS = {
+    'octave': octave_filterbank,
+    'log': log_filterbank,
+    'mel': mel_filterbank,
+}
+
+
+# Turns blocks of samples into band levels. The sliding FFT buffer, window and magnitude buffers are allocated once
+# and the bins are reduced to bands with a single product against a (bands x bins) filterbank, with each row
+# normalized so a band is the (weighted) average of its bins.
+class SpectrumAnalyzer:
+    def __init__(self, sample_rate: int, fft_size: int, block_size: int, band_count: int = 8,
+                 layout: str = 'octave', window: str = 'rectangular', min_frequency: float = 20.0):
+        if layout not in BAND_LAYOUTS:
+            raise ValueError(f'unknown band layout {layout!r}, expected one of {", ".join(BAND_LAYOUTS)}')
+        if window not in WINDOWS:
+            raise ValueError(f'unknown window {window!r}, expected one of {", ".join(WINDOWS)}')
+        self.sample_rate = sample_rate
+        self.fft_size = fft_size
+        self.block_size = block_size
+        self.band_count = band_count
+        self.layout = layout
+        self.filterbank = BAND_LAYOUTS[layout](band_count, sample_rate, fft_size, min_frequency)
+        self.window = WINDOWS[window](fft_size)
+        self.buffer = np.zeros(fft_size)
+        self._windowed = np.zeros(fft_size)
+        self.magnitude = np.zeros(fft_size // 2 + 1)
+        self.spectrum = np.zeros(band_count)
+        self.budget = block_size / sample_rate
+        self.last_cost = 0.0
+        self.cost = 0.0
+
+    def process(self, signal: np.ndarray) -> np.ndarray:
+        start = time.perf_counter()
+        n = len(signal)
+        self.buffer[:-n] = self.buffer[n:]
+        self.buffer[-n:] = signal
+        np.multiply(self.buffer, self.window, out=self._windowed)
+        # rfft always returns a fresh array, but it is the only allocation left per block
+        np.abs(np.fft.rfft(self._windowed), out=self.magnitude)
+        np.dot(self.filterbank, self.magnitude, out=self.spectrum)
+        self.last_cost = time.perf_counter() - start
+        self.cost += (self.last_cost - self.cost) * 0.05
+        return self.spectrum
+
+    @property
+    def load(self) -> float:
+        # fraction of the real-time budget for one block spent in process()
+        return self.cost / self.budget
+
+
+# Fixed-size ring of preallocated sample blocks handed from the capture thread to the analysis thread. The capture
+# side never blocks by default: when the ring is full the oldest block is dropped and counted as an overrun. The
+# analysis side can catch up by skipping to the newest blocks once it falls more than max_lag blocks behind, unless
+# the producer waits for room (a source that isn't real time), since then every block is meant to be analyzed.
+class BlockRing:
+    def __init__(self, capacity: int, block_size: int, max_lag: Optional[int] = None, dtype='float32'):
+        self.capacity = capacity
+        self.block_size = block_size
+        self.max_lag = max_lag
+        self.blocks = np.zeros((capacity, block_size), dtype=dtype)
+        self.timestamps = np.zeros(capacity)
+        self.written = 0
+        self.read = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.max_depth = 0
+        # set while the producer waits for room instead of dropping, in which case nothing may be skipped either
+        self.lossless = False
+        self._condition = threading.Condition()
+
+    @property
+    def depth(self) -> int:
+        return self.written - self.read
+
+    def put(self, block: np.ndarray, timestamp: float, wait: bool = False):
+        with self._condition:
+            self.lossless = wait
+            if self.written - self.read >= self.capacity:
+                if wait:
+                    self._condition.wait_for(lambda: self.written - self.read < self.capacity)
+                else:
+                    self.read += 1
+                    self.overruns += 1
+            slot = self.written % self.capacity
+            np.copyto(self.blocks[slot], block.reshape(-1), casting='same_kind')
+            self.timestamps[slot] = timestamp
+            self.written += 1
+            self.max_depth = max(self.max_depth, self.written - self.read)
+            self._condition.notify_all()
+
+    def get(self, out: np.ndarray, timeout: Optional[float] = None) -> Optional[float]:
+        # copies the next block into out and returns its timestamp, or None if nothing arrived in time
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.written > self.read, timeout):
+                return None
+            if self.max_lag is not None and not self.lossless and self.written - self.read > self.max_lag:
+                skip = self.written - self.read - 1
+                self.read += skip
+                self.skipped += skip
+            slot = self.read % self.capacity
+            out[:] = self.blocks[slot]
+            timestamp = self.timestamps[slot]
+            self.read += 1
+            self._condition.notify_all()
+            return timestamp
+
+    def clear(self):
+        with self._condition:
+            self.read = self.written
+            self._condition.notify_all()
+
+
+# Phase-locked estimate of the beat grid. Each detected beat (timestamped for when it actually happened, not when it
+# was detected) nudges the phase of the predicted grid and the period towards the measured tempo, so patterns can
+# ask where the next beat falls instead of reacting one pipeline delay after it. latency is added to every query
+# so changes can be scheduled early enough to reach the lights on the beat. Onsets and queries are on clock, which
+# has to be the one the frames are built on.
+class BeatTracker:
+    def __init__(self, latency: float = 0.0, phase_gain: float = 0.25, period_gain: float = 0.1,
+                 min_tempo: float = 40, max_tempo: float = 240, clock: Callable[[], float] = time.perf_counter):
+        self.clock = clock
+        self.latency = latency
+        self.phase_gain = phase_gain
+        self.period_gain = period_gain
+        self.min_period = 60 / max_tempo
+        self.max_period = 60 / min_tempo
+        self.period = 0.0
+        self.reference = None
+        self.last_error = 0.0
+
+    @property
+    def locked(self) -> bool:
+        return self.reference is not None and self.period > 0
+
+    @property
+    def tempo(self) -> float:
+        return 60 / self.period if self.period else 0
+
+    def reset(self):
+        self.period = 0.0
+        self.reference = None
+
+    def onset(self, at: float, tempo: Optional[float] = None):
+        target = min(self.max_period, max(self.min_period, 60 / tempo)) if tempo else None
+        if not self.locked:
+            if target:
+                self.period = target
+                self.reference = at
+            return
+
+        beats = round((at - self.reference) / self.period)
+        predicted = self.reference + beats * self.period
+        error = at - predicted
+        self.last_error = error
+        self.reference = predicted + self.phase_gain * error
+        if target:
+            self.period += self.period_gain * (target - self.period)
+        elif beats:
+            self.period += self.period_gain * error / beats
+        self.period = min(self.max_period, max(self.min_period, self.period))
+
+    def beat_position(self, now: Optional[float] = None) -> Optional[float]:
+        # beats elapsed since the reference beat, as seen from now + latency
+        if not self.locked:
+            return None
+        if now is None:
+            now = self.clock()
+        return (now + self.latency - self.reference) / self.period
+
+    def beat_index(self, now: Optional[float] = None) -> Optional[int]:
+        position = self.beat_position(now)
+        return math.floor(position) if position is not None else None
+
+    def phase(self, now: Optional[float] = None) -> Optional[float]:
+        position = self.beat_position(now)
+        return position % 1 if position is not None else None
+
+    def time_to_next_beat(self, now: Optional[float] = None) -> Optional[float]:
+        phase = self.phase(now)
+        return (1 - phase) * self.period if phase is not None else None
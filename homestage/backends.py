@@ -0,0 +1,388 @@
+import asyncio
+import logging
+import socket
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from homestage.artnet import ARTNET_PORT, ArtDmxPacket, ArtSyncPacket
+from homestage.e131 import DISCOVERY_INTERVAL, DISCOVERY_UNIVERSE, E131_PORT, E131Packet, E131Sender, \
+    E131SyncPacket, discovery_packets, multicast_address, new_cid
+from homestage.universe import Universe
+
+logger = logging.getLogger(__name__)
+
+# e131 (the default) is the threaded sender that keeps its own frame clock, which rendering phase-locks to; sacn and
+# artnet are asyncio backends that send as soon as a frame is handed over, sacn-library is the sacn package's
+# sender and null drops every frame
+BACKENDS = ('sacn', 'artnet', 'e131', 'sacn-library', 'null')
+
+
+# What HomeStage sends its frames through. Once per frame it calls send() with the universe buffer and the numbers
+# of the universes that have to go out; a backend sends those together and then releases the frame (a sync packet,
+# where the protocol has one). tick() is when the backend's own clock last sent, for backends that pace themselves,
+# and None for the ones that send as soon as they're handed a frame.
+class OutputBackend:
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def send(self, universe: Universe, numbers: List[int]):
+        raise NotImplementedError()
+
+    def tick(self) -> Optional[float]:
+        return None
+
+    def stats(self):
+        return None
+
+
+class NullBackend(OutputBackend):
+    def __init__(self):
+        self.frames = 0
+        self.packets = 0
+
+    def send(self, universe: Universe, numbers: List[int]):
+        self.frames += 1
+        self.packets += len(numbers)
+
+    def stats(self):
+        return {'frames': self.frames, 'packets': self.packets}
+
+
+# Keeps a copy of the last data sent for each universe, and hands every release to on_send if given
+class LoopbackBackend(NullBackend):
+    def __init__(self, on_send=None):
+        super().__init__()
+        self.on_send = on_send
+        self.data: Dict[int, bytes] = {}
+        self.last_send = None
+
+    def send(self, universe: Universe, numbers: List[int]):
+        super().send(universe, numbers)
+        for number in numbers:
+            self.data[number] = universe.views[number].tobytes()
+        self.last_send = time.perf_counter()
+        if self.on_send is not None:
+            self.on_send(numbers, self.last_send)
+
+
+# Adapter for senders with the sacn library's output[universe].dmx_data interface and a send thread of their own
+class SenderBackend(OutputBackend):
+    def __init__(self, sender):
+        self.sender = sender
+
+    def start(self):
+        self.sender.start()
+
+    def stop(self):
+        self.sender.stop()
+
+    def send(self, universe: Universe, numbers: List[int]):
+        for number in numbers:
+            self.sender[number].dmx_data = universe.views[number]
+
+    def tick(self) -> Optional[float]:
+        tick = getattr(self.sender, 'tick', None)
+        return tick() if tick is not None else None
+
+    def stats(self):
+        stats = getattr(self.sender, 'stats', None)
+        return stats() if stats is not None else None
+
+
+# An asyncio event loop on a thread of its own, shared by every datagram backend it is handed to, so one loop
+# multiplexes all universes, protocols and destinations. Runs while any backend using it is started.
+class EventLoopThread:
+    def __init__(self):
+        self.loop = None
+        self.users = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def acquire(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self.users == 0:
+                ready = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(ready,), name='output loop', daemon=True)
+                self._thread.start()
+                ready.wait()
+            self.users += 1
+            return self.loop
+
+    def release(self):
+        with self._lock:
+            self.users -= 1
+            if self.users == 0:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self._thread.join()
+                self._thread = None
+
+    def _run(self, ready: threading.Event):
+        self.loop = asyncio.new_event_loop()
+        ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+            self.loop = None
+
+
+class _Protocol(asyncio.DatagramProtocol):
+    def __init__(self, backend: 'DatagramBackend'):
+        self.backend = backend
+
+    def error_received(self, exc):
+        self.backend.errors += 1
+        logger.debug(f'{type(self.backend).__name__} send failed: {exc}')
+
+
+# Sends preallocated packets from an asyncio event loop over a single non-blocking datagram socket shared by every
+# universe and destination. send() copies the frame into the packets on the caller's
+# thread; the loop then writes every packet to every destination and finishes with the sync packets, so all
+# universes of a frame are released together.
+class DatagramBackend(OutputBackend):
+    port = 0
+
+    def __init__(self, destinations: Dict[int, List[str]], bind_address: str = '0.0.0.0', ttl: int = 8,
+                 runner: Optional[EventLoopThread] = None):
+        self.runner = runner or EventLoopThread()
+        self.bind_address = bind_address
+        self.ttl = ttl
+        self.packets = {}
+        self.destinations: Dict[int, List[Tuple[str, int]]] = {}
+        for number, hosts in destinations.items():
+            self.packets[number] = self.make_packet(number)
+            self.destinations[number] = [(host, self.port) for host in hosts]
+        self.sync_packet = None
+        self.sync_destinations: List[Tuple[str, int]] = []
+        self.lock = threading.Lock()
+        self.loop = None
+        self.transport = None
+        self.last_release = None
+        self.frames = 0
+        self.sent = 0
+        self.errors = 0
+        self.release_time = 0.0
+        self.max_release_time = 0.0
+
+    def make_packet(self, number: int):
+        raise NotImplementedError()
+
+    def start(self):
+        if self.loop is not None:
+            return
+        loop = self.runner.acquire()
+        asyncio.run_coroutine_threadsafe(self._open(loop), loop).result()
+        self.loop = loop
+
+    def stop(self):
+        if self.loop is None:
+            return
+        loop, self.loop = self.loop, None
+        asyncio.run_coroutine_threadsafe(self._close(), loop).result()
+        self.runner.release()
+
+    async def _open(self, loop: asyncio.AbstractEventLoop):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+        sock.bind((self.bind_address, 0))
+        sock.setblocking(False)
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: _Protocol(self), sock=sock)
+        self.started(loop)
+
+    async def _close(self):
+        self.stopped()
+        self.transport.close()
+        self.transport = None
+
+    def started(self, loop: asyncio.AbstractEventLoop):
+        pass
+
+    def stopped(self):
+        pass
+
+    def send(self, universe: Universe, numbers: List[int]):
+        if self.loop is None:
+            return
+        with self.lock:
+            for number in numbers:
+                packet = self.packets.get(number)
+                if packet is not None:
+                    packet.dmx[:universe.size] = universe.blocks[universe.index[number]]
+        self.loop.call_soon_threadsafe(self._release, tuple(numbers))
+
+    def _release(self, numbers: Tuple[int, ...]):
+        if self.transport is None:
+            return
+        start = time.perf_counter()
+        sent = 0
+        with self.lock:
+            for number in numbers:
+                packet = self.packets.get(number)
+                if packet is None:
+                    continue
+                view = packet.next()
+                for destination in self.destinations[number]:
+                    self.transport.sendto(view, destination)
+                    sent += 1
+            if self.sync_packet is not None and sent:
+                view = self.sync_packet.next()
+                for destination in self.sync_destinations:
+                    self.transport.sendto(view, destination)
+                    sent += 1
+        elapsed = time.perf_counter() - start
+        self.last_release = start
+        self.frames += 1
+        self.sent += sent
+        self.release_time += (elapsed - self.release_time) * 0.05
+        self.max_release_time = max(self.max_release_time, elapsed)
+
+    def stats(self):
+        return {
+            'universes': len(self.packets),
+            'frames': self.frames,
+            'packets': self.sent,
+            'errors': self.errors,
+            'release_time': self.release_time,
+            'max_release_time': self.max_release_time,
+            'buffered': self.transport.get_write_buffer_size() if self.transport is not None else 0,
+        }
+
+
+class SACNBackend(DatagramBackend):
+    port = E131_PORT
+
+    def __init__(self, destinations: Dict[int, List[str]], bind_address: str = '0.0.0.0', ttl: int = 8,
+                 source_name: str = 'homestage', priority: int = 100, sync_universe: int = 0,
+                 universe_discovery: bool = True, runner: Optional[EventLoopThread] = None):
+        self.cid = new_cid()
+        self.source_name = source_name
+        self.priority = priority
+        self.sync_universe = sync_universe
+        self.universe_discovery = universe_discovery
+        self._discovery = None
+        super().__init__(destinations, bind_address, ttl, runner)
+        if sync_universe:
+            self.sync_packet = E131SyncPacket(sync_universe, self.cid)
+            # unicast receivers get the sync packet directly, multicast ones on the sync universe's group
+            self.sync_destinations = sorted({multicast_address(sync_universe) if host.startswith('239.') else host
+                                             for hosts in destinations.values() for host in hosts})
+            self.sync_destinations = [(host, self.port) for host in self.sync_destinations]
+
+    def make_packet(self, number: int):
+        return E131Packet(number, self.cid, self.source_name, self.priority,
+                          sync_address=self.sync_universe)
+
+    def started(self, loop: asyncio.AbstractEventLoop):
+        if self.universe_discovery:
+            self._discover(loop)
+
+    def stopped(self):
+        if self._discovery is not None:
+            self._discovery.cancel()
+            self._discovery = None
+
+    def _discover(self, loop: asyncio.AbstractEventLoop):
+        for packet in discovery_packets(list(self.packets), self.cid, self.source_name):
+            self.transport.sendto(packet, (multicast_address(DISCOVERY_UNIVERSE), self.port))
+        self._discovery = loop.call_later(DISCOVERY_INTERVAL, self._discover, loop)
+
+
+class ArtNetBackend(DatagramBackend):
+    port = ARTNET_PORT
+
+    def __init__(self, destinations: Dict[int, List[str]], bind_address: str = '0.0.0.0', ttl: int = 8,
+                 universe_offset: int = 0, sync: bool = True, runner: Optional[EventLoopThread] = None):
+        self.universe_offset = universe_offset
+        super().__init__(destinations, bind_address, ttl, runner)
+        if sync:
+            self.sync_packet = ArtSyncPacket()
+            self.sync_destinations = sorted({destination for destinations in self.destinations.values()
+                                             for destination in destinations})
+
+    def make_packet(self, number: int):
+        return ArtDmxPacket(number + self.universe_offset)
+
+
+# Several backends fed the same frames, e.g. sACN and Art-Net nodes on one rig
+class MultiBackend(OutputBackend):
+    def __init__(self, backends: List[OutputBackend]):
+        self.backends = backends
+
+    def start(self):
+        for backend in self.backends:
+            backend.start()
+
+    def stop(self):
+        for backend in self.backends:
+            backend.stop()
+
+    def send(self, universe: Universe, numbers: List[int]):
+        for backend in self.backends:
+            backend.send(universe, numbers)
+
+    def tick(self) -> Optional[float]:
+        ticks = [tick for tick in (backend.tick() for backend in self.backends) if tick is not None]
+        return ticks[0] if ticks else None
+
+    def stats(self):
+        return {type(backend).__name__: backend.stats() for backend in self.backends}
+
+
+def universe_destinations(universes: Iterable[int], multicast: bool, destination: str,
+                          overrides: Dict) -> Dict[int, List[str]]:
+    # each universe goes to its own multicast group or the configured destination, unless the config lists hosts
+    # for it
+    destinations = {}
+    for number in universes:
+        hosts = overrides.get(str(number), overrides.get(number))
+        if hosts is None:
+            hosts = [multicast_address(number) if multicast else destination]
+        elif isinstance(hosts, str):
+            hosts = [hosts]
+        destinations[number] = list(hosts)
+    return destinations
+
+
+def create_backend(config, runner: Optional[EventLoopThread] = None) -> OutputBackend:
+    # outputs.backend is one backend name or a list of them; the asyncio ones share one event loop
+    names = config.output_backend
+    if not isinstance(names, str):
+        runner = runner or EventLoopThread()
+        backends = [_create_backend(config, name, runner) for name in names]
+        return backends[0] if len(backends) == 1 else MultiBackend(backends)
+    return _create_backend(config, names, runner)
+
+
+def _create_backend(config, backend: str, runner: Optional[EventLoopThread] = None) -> OutputBackend:
+    universes = config.universes
+    if backend == 'sacn':
+        return SACNBackend(universe_destinations(universes, config.sacn_multicast, config.sacn_destination,
+                                                 config.sacn_destinations),
+                           bind_address=config.sacn_bind_address, priority=config.sacn_priority,
+                           sync_universe=config.sacn_sync_universe, runner=runner)
+    if backend == 'artnet':
+        return ArtNetBackend(universe_destinations(universes, False, config.artnet_destination,
+                                                   config.artnet_destinations),
+                             bind_address=config.artnet_bind_address, universe_offset=config.artnet_universe_offset,
+                             sync=config.artnet_sync, runner=runner)
+    if backend in ('e131', 'sacn-library'):
+        if backend == 'e131':
+            sender = E131Sender(fps=config.render_fps, bind_address=config.sacn_bind_address,
+                                priority=config.sacn_priority)
+        else:
+            from homestage.outputs import PatchedsACNSender
+            sender = PatchedsACNSender(fps=int(config.render_fps), bind_address=config.sacn_bind_address)
+        for universe in universes:
+            sender.activate_output(universe)
+            sender[universe].multicast = config.sacn_multicast
+            sender[universe].destination = config.sacn_destination
+            sender[universe].priority = config.sacn_priority
+        return SenderBackend(sender)
+    if backend == 'null':
+        return NullBackend()
+    raise ValueError(f'unknown output backend {backend!r}')
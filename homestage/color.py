@@ -0,0 +1,103 @@
+from typing import Dict, Optional
+
+import numpy as np
+
+# Conversions work on whole arrays: a hue array of shape (n,) gives a (3, n) array of r, g, b in 0..1, and a
+# scalar hue gives a (3,) array, so one call colors the whole rig.
+
+_OFFSETS = np.array([5, 3, 1], dtype=np.float64)
+
+
+def hsv_to_rgb(h, s=1.0, v=1.0) -> np.ndarray:
+    h = np.asarray(h, dtype=np.float64)
+    s = np.asarray(s, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+    offsets = _OFFSETS.reshape((3,) + (1,) * np.broadcast(h, s, v).ndim)
+    k = (offsets + h % 1 * 6) % 6
+    return v - v * s * np.clip(np.minimum(k, 4 - k), 0, 1)
+
+
+def hsl_to_rgb(h, s=1.0, lightness=0.5) -> np.ndarray:
+    h = np.asarray(h, dtype=np.float64)
+    s = np.asarray(s, dtype=np.float64)
+    lightness = np.asarray(lightness, dtype=np.float64)
+    v = lightness + s * np.minimum(lightness, 1 - lightness)
+    sv = np.divide(2 * (v - lightness), v, out=np.zeros(np.broadcast(v, h).shape), where=v > 0)
+    return hsv_to_rgb(h, sv, v)
+
+
+def hue_to_rgb(h) -> np.ndarray:
+    # fully saturated, full value
+    return hsv_to_rgb(h)
+
+
+def rgb_to_rgbw(rgb) -> np.ndarray:
+    # pull the common part of r, g and b out into a white channel: (3, ...) -> (4, ...)
+    rgb = np.asarray(rgb, dtype=np.float64)
+    w = rgb.min(axis=0)
+    return np.concatenate([rgb - w, w[None]])
+
+
+# Precomputed hue wheel for patterns that convert a lot of hues every frame: 8 bits is plenty for DMX output,
+# 16 bits for slow fades where steps would show.
+class HueTable:
+    def __init__(self, bits: int = 8):
+        self.size = 1 << bits
+        self.table = (hue_to_rgb(np.arange(self.size) / self.size) * 255).astype(np.float32)
+
+    def lookup(self, h) -> np.ndarray:
+        index = (np.asarray(h, dtype=np.float64) % 1 * self.size).astype(np.intp)
+        return self.table[:, index]
+
+
+def gamma_table(gamma: float) -> np.ndarray:
+    return np.round((np.arange(256) / 255) ** gamma * 255).astype(np.uint8)
+
+
+# Output curves, applied to a channel's 0..255 value as the rig is flushed
+CURVES: Dict[str, np.ndarray] = {
+    'linear': np.arange(256, dtype=np.uint8),
+    'gamma': gamma_table(2.2),
+    'square': gamma_table(2.0),
+    'cubic': gamma_table(3.0),
+    's-curve': np.round((1 - np.cos(np.arange(256) / 255 * np.pi)) / 2 * 255).astype(np.uint8),
+}
+
+
+def curve_table(curve) -> Optional[np.ndarray]:
+    # a curve name, a gamma value, or a 256 entry table
+    if curve is None:
+        return None
+    if isinstance(curve, str):
+        if curve not in CURVES:
+            raise ValueError(f'unknown curve {curve!r}')
+        return CURVES[curve]
+    if isinstance(curve, (int, float)):
+        return gamma_table(curve)
+    table = np.asarray(curve, dtype=np.uint8)
+    if table.shape != (256,):
+        raise ValueError('a curve table needs 256 entries')
+    return table
+
+
+def inverse_table(table: np.ndarray) -> np.ndarray:
+    # for each output value, the smallest input whose output is closest to it, so values the curve produced map back
+    # to an input that produces them again
+    distance = np.abs(table.astype(np.int16)[None, :] - np.arange(256, dtype=np.int16)[:, None])
+    return distance.argmin(axis=1).astype(np.uint8)
+
+
+def paint(rig, rgb, scale: float = 255):
+    # Sets r, g, b from a (3,) or (3, n) color in 0..1. Fixtures with a white channel and white_from_rgb set get the
+    # common part of the color on it instead of mixing it from r, g and b; other white channels are left alone.
+    rgb = np.asarray(rgb, dtype=np.float64) * scale
+    if rgb.ndim == 1:
+        rgb = rgb[:, None]
+    mixes_white = rig.channel_mask('w') * rig.flag_mask('white_from_rgb')
+    if mixes_white.any():
+        w = rgb.min(axis=0) * mixes_white
+        rgb = rgb - w
+        rig.w = np.where(mixes_white > 0, w, rig.w)
+    rig.r = rgb[0]
+    rig.g = rgb[1]
+    rig.b = rgb[2]
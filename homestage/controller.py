@@ -8,8 +8,15 @@ import aubio
 import soundcard
 
 import homestage.fixtures
+from homestage.audio import SpectrumHistory, SpectrumAnalyzer, BlockRing, BeatTracker
 from homestage.model import Media, Section, Segment
+from homestage.sources import MicrophoneSource, SOURCES
+from homestage.timeline import CueSchedule, SECTION, SEGMENT
 from homestage.patterns import *
+from homestage.frame import FrameBuilder, FrameContext, FrameScheduler, SystemClock
+from homestage.recording import ShowDirector, ShowLibrary
+from homestage.rig import Rig
+from homestage.universe import Universe, allocate, universe_numbers
 
 logger = logging.getLogger(__name__)
 
@@ -20,13 +27,39 @@ class StageConfig:
         self.config = {}
         self.debug = False
         self._microphone = None
+        self.audio_source_config = {'type': 'microphone'}
+        self._audio_source = None
+        self.audio_sample_rate = 44100
+        self.audio_band_count = 8
+        self.audio_band_layout = 'octave'
+        self.audio_window = 'rectangular'
+        self.audio_latency_offset = 0.0
+        self.fade_time = 1.0
+        self.fade_curve = 'smooth'
+        self.curves = {}
+        self.render_fps = 60.0
+        self.render_phase_lock = True
+        self.render_lead = 0.004
+        self.recording_directory = 'recordings'
+        self.recording_record = False
+        self.recording_playback = True
         self.http_bind_address = '0.0.0.0'
         self.http_port = 8923
         self.http_secret_key = secrets.token_hex(32)
+        self.http_status_rate = 30.0
         self.sacn_bind_address = '0.0.0.0'
         self.sacn_multicast = False
         self.sacn_destination = '127.0.0.1'
         self.sacn_universe = 1
+        self.sacn_priority = 100
+        self.sacn_destinations = {}
+        self.sacn_sync_universe = 0
+        self.output_backend = 'e131'
+        self.artnet_bind_address = '0.0.0.0'
+        self.artnet_destination = '255.255.255.255'
+        self.artnet_destinations = {}
+        self.artnet_universe_offset = 0
+        self.artnet_sync = True
         self.fixtures = []
 
     def load(self):
@@ -42,11 +75,46 @@ class StageConfig:
         self.debug = bool(config.get('debug', False))
         self.microphone = config.get('microphone', None)
 
+        audio_config = config.get('audio', {})
+        self.audio_sample_rate = int(audio_config.get('sample_rate', 44100))
+        self.audio_band_count = int(audio_config.get('band_count', 8))
+        self.audio_band_layout = audio_config.get('band_layout', 'octave')
+        # no window unless one is asked for (see homestage.audio.WINDOWS), which keeps the analysis as it always was
+        self.audio_window = audio_config.get('window', 'rectangular')
+        self.audio_latency_offset = float(audio_config.get('latency_offset', 0.0))
+        self.audio_source_config = dict(audio_config.get('source', {'type': 'microphone'}))
+        self._update_audio_source()
+
+        mixer_config = config.get('mixer', {})
+        self.fade_time = float(mixer_config.get('fade_time', 1.0))
+        self.fade_curve = mixer_config.get('fade_curve', 'smooth')
+
+        render_config = config.get('render', {})
+        self.render_fps = float(render_config.get('fps', 60.0))
+        self.render_phase_lock = bool(render_config.get('phase_lock', True))
+        self.render_lead = float(render_config.get('lead', 0.004))
+
+        # recorded shows are played back instead of rendering live for media that has one
+        recording_config = config.get('recording', {})
+        self.recording_directory = recording_config.get('directory', 'recordings')
+        self.recording_record = bool(recording_config.get('record', False))
+        self.recording_playback = bool(recording_config.get('playback', True))
+
+        # output curves per fixture class, e.g. {"LEDWash": {"r": "gamma", "brightness": 2.5}}
+        self.curves = dict(config.get('curves', {}))
+
         fixtures_config = config.get('fixtures', [])
         fixtures = []
         for fc in fixtures_config:
             cls = getattr(homestage.fixtures, fc['class'])
-            fixture = cls(address=fc.get('address', 0))
+            fixture = cls(address=fc.get('address'), universe=fc.get('universe'))
+            if 'groups' in fc:
+                fixture.groups = tuple(fc['groups'])
+            if 'white_from_rgb' in fc:
+                fixture.white_from_rgb = bool(fc['white_from_rgb'])
+            curves = {**self.curves.get(fc['class'], {}), **fc.get('curves', {})}
+            if curves:
+                fixture.curves = curves
             fixtures.append(fixture)
         self.fixtures = fixtures
 
@@ -54,35 +122,93 @@ class StageConfig:
         self.http_bind_address = http_config.get('bind', '0.0.0.0')
         self.http_port = http_config.get('port', 8923)
         self.http_secret_key = http_config.get('key', secrets.token_hex(32))
+        # status snapshots pushed to the web UI per second
+        self.http_status_rate = float(http_config.get('status_rate', 30.0))
 
         outputs_config = config.get('outputs', {})
         sacn_config = outputs_config.get('sACN', {})
+        # one of homestage.backends.BACKENDS, or a list of them to drive together; configs from before there was a
+        # choice pick between the native sender and the sacn package with sACN.native
+        self.output_backend = outputs_config.get(
+            'backend', 'e131' if sacn_config.get('native', True) else 'sacn-library')
         self.sacn_bind_address = sacn_config.get('bind', '0.0.0.0')
         self.sacn_multicast = bool(sacn_config.get('multicast', True))
         self.sacn_destination = sacn_config.get('destination', '127.0.0.1')
         self.sacn_universe = sacn_config.get('universe', 1)
+        self.sacn_priority = int(sacn_config.get('priority', 100))
+        # universe number -> host or list of hosts, for universes that don't go to the default destination
+        self.sacn_destinations = dict(sacn_config.get('destinations', {}))
+        self.sacn_sync_universe = int(sacn_config.get('sync_universe', 0))
+
+        artnet_config = outputs_config.get('ArtNet', {})
+        self.artnet_bind_address = artnet_config.get('bind', '0.0.0.0')
+        self.artnet_destination = artnet_config.get('destination', '255.255.255.255')
+        self.artnet_destinations = dict(artnet_config.get('destinations', {}))
+        self.artnet_universe_offset = int(artnet_config.get('universe_offset', 0))
+        self.artnet_sync = bool(artnet_config.get('sync', True))
+
+        # fixtures without a universe or address are packed in after the ones that have both, from sacn_universe on
+        allocate(self.fixtures, self.sacn_universe)
 
     def save(self):
         self.config.update({
             'debug': self.debug,
             'microphone': self.microphone.id if self.microphone else None,
+            'audio': {
+                'sample_rate': self.audio_sample_rate,
+                'band_count': self.audio_band_count,
+                'band_layout': self.audio_band_layout,
+                'window': self.audio_window,
+                'latency_offset': self.audio_latency_offset,
+                'source': self.audio_source_config,
+            },
+            'mixer': {
+                'fade_time': self.fade_time,
+                'fade_curve': self.fade_curve,
+            },
+            'render': {
+                'fps': self.render_fps,
+                'phase_lock': self.render_phase_lock,
+                'lead': self.render_lead,
+            },
+            'recording': {
+                'directory': self.recording_directory,
+                'record': self.recording_record,
+                'playback': self.recording_playback,
+            },
             'http': {
                 'bind': self.http_bind_address,
                 'port': self.http_port,
                 'key': self.http_secret_key,
+                'status_rate': self.http_status_rate,
             },
             'outputs': {
+                'backend': self.output_backend,
                 'sACN': {
                     'bind': self.sacn_bind_address,
                     'multicast': self.sacn_multicast,
                     'destination': self.sacn_destination,
                     'universe': self.sacn_universe,
-                }
+                    'priority': self.sacn_priority,
+                    'destinations': self.sacn_destinations,
+                    'sync_universe': self.sacn_sync_universe,
+                },
+                'ArtNet': {
+                    'bind': self.artnet_bind_address,
+                    'destination': self.artnet_destination,
+                    'destinations': self.artnet_destinations,
+                    'universe_offset': self.artnet_universe_offset,
+                    'sync': self.artnet_sync,
+                },
             }
         })
         with open(self.path, 'w') as f:
             json.dump(self.config, f, sort_keys=True, indent=2)
 
+    @property
+    def universes(self):
+        return universe_numbers(self.fixtures, self.sacn_universe)
+
     @property
     def microphone(self):
         return self._microphone
@@ -92,13 +218,39 @@ class StageConfig:
         if value is None:
             self._microphone = None
         elif isinstance(value, str):
+            self._microphone = None
             for mic in self.get_microphones():
                 if mic.id == value:
                     self._microphone = mic
-                    return
-            self._microphone = None
+                    break
         else:
             self._microphone = value
+        if self.audio_source_config.get('type', 'microphone') == 'microphone':
+            self._update_audio_source()
+
+    @property
+    def audio_source(self):
+        return self._audio_source
+
+    @audio_source.setter
+    def audio_source(self, source):
+        # for harnesses that bring their own source; the capture thread reopens as soon as it changes
+        self._audio_source = source
+
+    def _update_audio_source(self):
+        source_type = self.audio_source_config.get('type', 'microphone')
+        if source_type == 'microphone':
+            if self._microphone is None:
+                self._audio_source = None
+            elif not isinstance(self._audio_source, MicrophoneSource) or \
+                    self._audio_source.microphone != self._microphone:
+                # a new source object makes the capture thread reopen the recorder
+                self._audio_source = MicrophoneSource(self._microphone)
+        elif source_type in SOURCES:
+            options = {k: v for k, v in self.audio_source_config.items() if k != 'type'}
+            self._audio_source = SOURCES[source_type](**options)
+        else:
+            raise ValueError(f'unknown audio source type {source_type!r}')
 
     def get_microphones(self):
         return soundcard.all_microphones()
@@ -123,67 +275,115 @@ class ControlState:
 
 
 class AudioState:
-    media = Media()
     current_tempo = 0
 
-    def __init__(self, config: StageConfig, sample_rate=44100, fft_size=1024, block_size=512):
+    def __init__(self, config: StageConfig, sample_rate=44100, fft_size=1024, block_size=512, band_count=8,
+                 band_layout='octave', window='rectangular', queue_size=16, max_lag=8, latency_offset=0.0, clock=None):
         self.config = config
+        # the stage's frame clock: beats are dated and media played back on it
+        self.clock = clock or SystemClock()
+        self.media = Media()
+        self.media.timeline.clock = self.clock.now
         self.sample_rate = sample_rate
         self.fft_size = fft_size
         self.block_size = block_size
         self.tempo = aubio.tempo("default", self.fft_size, self.block_size, self.sample_rate)
         self.beat = False
+        self.beat_tracker = BeatTracker(latency=latency_offset, clock=self.clock.now)
+        self.frames = 0
         self.enabled = False
-        self.buffer_size = self.block_size * 2
-        self.buffer = np.zeros(self.buffer_size)
-        self.band_count = 8
-        self.bands = [self.sample_rate * 2 ** (x - self.band_count) for x in range(self.band_count)]
-        self.band_windows = [
-            (int((lower * self.buffer_size) / self.sample_rate), int((upper * self.buffer_size) / self.sample_rate))
-            for lower, upper in zip([0] + self.bands[:-1], self.bands)]
-        self.spectrum = np.zeros(self.band_count)
+        self.band_count = band_count
+        self.analyzer = SpectrumAnalyzer(self.sample_rate, self.fft_size, self.block_size, band_count,
+                                         layout=band_layout, window=window)
+        self.spectrum = self.analyzer.spectrum
         self.spectrum_history_size = int((self.sample_rate / self.block_size) * 5)
         self.spectrum_history_average_size = int((self.sample_rate / self.block_size) * 0.05)
-        self.spectrum_history = [np.zeros(self.spectrum_history_size) for i in range(self.band_count)]
+        self.spectrum_history = SpectrumHistory(self.band_count, self.spectrum_history_size,
+                                                self.spectrum_history_average_size)
         self.spectrum_adjusted = np.zeros(self.band_count)
+        self.ring = BlockRing(queue_size, self.block_size, max_lag=max_lag)
+        self.signal = np.zeros(self.block_size, dtype='float32')
+        self.blocks_analyzed = 0
+        self.last_latency = 0.0
+        self.latency = 0.0
+        self.max_latency = 0.0
 
     def reset(self, media: Media):
+        if media.timeline.clock != self.clock.now:
+            # media loaded on another clock: move its playhead over to the stage's
+            media.timeline.clock = self.clock.now
+            media.start_datetime = media.start_datetime
         self.media = media
         logger.info(f"Media change ({media.title}) - danceability: {media.analysis.danceability}, "
                     f"energy: {media.analysis.energy}, "
                     f"valence: {media.analysis.valence}")
 
     def start(self):
-        threading.Thread(target=self._run).start()
-
-    def _run(self):
+        threading.Thread(target=self._capture).start()
+        threading.Thread(target=self._analyze).start()
+
+    def stats(self):
+        return {
+            'blocks': self.blocks_analyzed,
+            'overruns': self.ring.overruns,
+            'skipped': self.ring.skipped,
+            'queue_depth': self.ring.depth,
+            'max_queue_depth': self.ring.max_depth,
+            'latency': self.latency,
+            'max_latency': self.max_latency,
+            'analysis_load': self.analyzer.load,
+        }
+
+    def _capture(self):
+        # only moves samples into the ring so analysis stalls never delay the next record()
         while True:
-            microphone = self.config.microphone
-            if not microphone:
-                time.sleep(1)  # no microphone? try again later
+            source = self.config.audio_source
+            if not source:
+                time.sleep(1)  # no audio source? try again later
                 continue
-            with microphone.recorder(samplerate=self.sample_rate, channels=1, blocksize=self.block_size) as mic:
-                while microphone == self.config.microphone:
-                    signal = mic.record(numframes=self.block_size)
+            with source.recorder(samplerate=self.sample_rate, channels=1, blocksize=self.block_size) as recorder:
+                while source is self.config.audio_source:
+                    if not self.enabled and not source.realtime:
+                        # nothing paces a file or synthetic source, so don't spin reading it into the void
+                        time.sleep(0.1)
+                        continue
+                    if getattr(recorder, 'finished', False):
+                        # a file that has played to the end only has silence left; wait for another source
+                        time.sleep(0.1)
+                        continue
+                    signal = recorder.record(numframes=self.block_size)
                     if self.enabled:
-                        signal = signal.flatten().astype('float32', casting='same_kind')
-                        self.beat = self.tempo(signal)[0] > 0
-                        self.current_tempo = self.tempo.get_bpm()
-
-                        self.buffer = np.roll(self.buffer, self.block_size)
-                        self.buffer[:self.block_size] = signal
-                        dfft = abs(np.fft.rfft(self.buffer))
-                        self.spectrum = [np.average(dfft[lower:upper]) for lower, upper in self.band_windows]
-                        for i in range(self.band_count):
-                            self.spectrum_history[i] = np.roll(self.spectrum_history[i], 1)
-                            self.spectrum_history[i][0] = self.spectrum[i]
-                            max_ = self.spectrum_history[i].max(initial=0)
-                            if max_ > 0:
-                                min_ = self.spectrum_history[i].min(initial=0)
-                                self.spectrum_adjusted[i] = min(255, (
-                                    np.average(self.spectrum_history[i][:self.spectrum_history_average_size])) / (max_))
-                            else:
-                                self.spectrum_adjusted[i] = 0
+                        self.ring.put(signal, time.perf_counter(), wait=not source.realtime)
+
+    def _analyze(self):
+        while True:
+            timestamp = self.ring.get(self.signal, timeout=1)
+            if timestamp is not None and self.enabled:
+                self.process(self.signal, timestamp)
+
+    def process(self, signal: np.ndarray, timestamp: float, measure_latency: bool = True):
+        # timestamp is when the block was captured on the stage clock; latency is only measured against
+        # perf_counter, so offline rendering in virtual time leaves it out
+        self.beat = self.tempo(signal)[0] > 0
+        self.current_tempo = self.tempo.get_bpm()
+        self.frames += len(signal)
+        if self.beat:
+            # aubio reports the beat some way back into the stream, so date it from the end of this block
+            age = self.frames / self.sample_rate - self.tempo.get_last_s()
+            self.beat_tracker.onset(timestamp - age, self.current_tempo)
+
+        self.spectrum = self.analyzer.process(signal)
+        self.spectrum_history.push(self.spectrum)
+        max_ = self.spectrum_history.maximum
+        np.divide(self.spectrum_history.average, max_, out=self.spectrum_adjusted, where=max_ > 0)
+        self.spectrum_adjusted[max_ <= 0] = 0
+        np.minimum(self.spectrum_adjusted, 255, out=self.spectrum_adjusted)
+
+        self.blocks_analyzed += 1
+        if measure_latency:
+            self.last_latency = time.perf_counter() - timestamp
+            self.latency += (self.last_latency - self.latency) * 0.05
+            self.max_latency = max(self.max_latency, self.last_latency)
 
 
 class PatternController:
@@ -191,7 +391,7 @@ class PatternController:
     section: Optional[Section]
     segment: Optional[Segment]
 
-    def __init__(self, state: AudioState, control: ControlState):
+    def __init__(self, state: AudioState, control: ControlState, fade_time=1.0, fade_curve='smooth'):
         self.state = state
         self.pattern = PatternList(state, control, [
             ('Beat Match (Rainbow)', DualToneResponseFastSweep(state, [[1, 0, 0], [1, 0.5, 0], [0, 1, 0], [0, 0, 1], [1, 0, 1]])),
@@ -199,43 +399,64 @@ class PatternController:
             ('Beat Match (Purple + Red)', DualToneResponseFastSweep(state, [[1, 0, 1], [1, 0, 0]])),
             ('Beat Match (Green + Yellow)', DualToneResponseFastSweep(state, [[0, 1, 0], [1, 1, 0]])),
             ('THE GOOD STUFF', RainbowRoundabout(state, control, 10)),
-        ])
+        ], fade_time, fade_curve)
         self.last_media = None
-        self.last_section = None
-        self.last_segment = None
+        self.schedule = None
+        self.section = None
+        self.segment = None
 
-    def update(self, fixtures):
-        media = self.state.media
-        position = media.position
-        section = media.analysis.sections.at(position) if position else None
-        segment = media.analysis.segments.at(position) if position else None
+    def update(self, rig: Rig, frame: FrameContext):
+        media = frame.media
 
         if self.last_media != media:
             self.last_media = media
+            self.schedule = CueSchedule(media.analysis.sections, media.analysis.segments)
+            self.section = None
+            self.segment = None
             self.pattern.on_media_change(media)
 
-        if self.last_section != section:
-            self.last_section = section
-            self.pattern.on_section_change(section)
+        for kind, index in self.schedule.advance(frame.position):
+            if kind == SECTION:
+                self.section = media.analysis.sections[index]
+                self.pattern.on_section_change(self.section)
+            else:
+                self.segment = media.analysis.segments[index]
+                self.pattern.on_segment_change(self.segment)
 
-        if self.last_segment != segment:
-            self.last_segment = segment
-            self.pattern.on_segment_change(segment)
+        if frame.position is not None:
+            frame.next_section = self.schedule.time_to_next(SECTION, frame.position)
+            frame.next_segment = self.schedule.time_to_next(SEGMENT, frame.position)
 
-        self.pattern.update(fixtures)
+        self.pattern.update(rig, frame)
 
 
 class HomeStage:
-    def __init__(self, config: StageConfig, fixtures, output):
+    def __init__(self, config: StageConfig, fixtures, output, clock=None, universe=None, state=None, control=None):
         self.config = config
+        self.clock = clock or SystemClock()
+        self.frames = FrameBuilder(self.clock)
+        # backends that send on a clock of their own get the frames locked to it, the rest send as frames finish
+        tick = output.tick if config.render_phase_lock else None
+        self.scheduler = FrameScheduler(self.clock, config.render_fps, tick, config.render_lead)
         self.fixtures = fixtures
+        self.universe = universe or Universe(universe_numbers(fixtures, config.sacn_universe))
+        for fixture in fixtures:
+            self.universe.patch(fixture)
+        self.rig = Rig(fixtures, self.universe)
         self.output = output
-        self.state = AudioState(config)
-        self.control = ControlState()
-        self.controller = PatternController(self.state, self.control)
+        self.state = state or AudioState(config, sample_rate=config.audio_sample_rate,
+                                         band_count=config.audio_band_count, band_layout=config.audio_band_layout,
+                                         window=config.audio_window, latency_offset=config.audio_latency_offset,
+                                         clock=self.clock)
+        self.control = control or ControlState()
+        self.controller = PatternController(self.state, self.control, config.fade_time, config.fade_curve)
+        self.shows = None
+        if config.recording_record or config.recording_playback:
+            self.shows = ShowDirector(ShowLibrary(config.recording_directory), self.universe, config.render_fps,
+                                      record=config.recording_record, playback=config.recording_playback)
+        self.playing = False
         self.lock = threading.RLock()
         self._enabled = False
-        self.dmx_data = [0] * 512
 
     def start(self):
         self.enabled = True
@@ -252,7 +473,7 @@ class HomeStage:
             if enabled and not self._enabled:
                 logger.info("Output enabled")
                 self._enabled = True
-                self.state.enabled = self._enabled
+                self.state.enabled = not self.playing
                 self.output.start()
 
             if not enabled and self._enabled:
@@ -261,14 +482,59 @@ class HomeStage:
                 self.state.enabled = self._enabled
                 self.output.stop()
 
+    @property
+    def pattern_name(self):
+        return self.controller.pattern.name
+
+    def next_pattern(self):
+        self.controller.pattern.next_pattern()
+
+    def load_media(self, media: Media):
+        self.state.reset(media)
+
+    def sync_media(self, start_datetime):
+        self.state.media.start_datetime = start_datetime
+
+    def set_microphone(self, microphone):
+        self.config.microphone = microphone
+        self.config.save()
+
     def run(self):
         while True:
             if self.enabled:
-                self.controller.update(self.fixtures)
-                for fixture in self.fixtures:
-                    values = fixture.values
-                    self.dmx_data[fixture.address:fixture.address + len(values)] = values
-                self.output[self.config.sacn_universe].dmx_data = tuple(self.dmx_data)
-                time.sleep(0.01)
+                self.scheduler.wait()
+                self.render()
+                self.scheduler.done()
             else:
-                time.sleep(1)
+                self.scheduler.reset()
+                self.clock.sleep(1)
+
+    def stats(self):
+        return {
+            'audio': self.state.stats(),
+            'frames': self.scheduler.stats(),
+            'output': self.universe.stats(),
+            'sender': self.output.stats(),
+            'shows': self.shows.stats() if self.shows is not None else None,
+        }
+
+    def render(self) -> FrameContext:
+        frame = self.frames.next(self.state)
+        playing = self.shows is not None and self.shows.play(frame)
+        if playing != self.playing:
+            self.playing = playing
+            # nothing needs the audio analysis while a recording plays, and once it stops the patterns carry on
+            # from what it left in the universe
+            self.state.enabled = self._enabled and not playing
+            if not playing:
+                self.rig.load()
+        if not playing:
+            self.controller.update(self.rig, frame)
+            self.rig.flush()
+            if self.shows is not None:
+                self.shows.capture(frame)
+        # every universe that changed goes to the backend in one pass, to be released together
+        numbers = self.universe.commit(frame.time)
+        if numbers:
+            self.output.send(self.universe, numbers)
+        return frame
@@ -0,0 +1,416 @@
+import ctypes
+import ctypes.util
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from homestage.universe import UNIVERSE_SIZE
+
+logger = logging.getLogger(__name__)
+
+E131_PORT = 5568
+ACN_IDENTIFIER = b'ASC-E1.17\x00\x00\x00'
+VECTOR_ROOT_E131_DATA = 0x00000004
+VECTOR_ROOT_E131_EXTENDED = 0x00000008
+VECTOR_E131_DATA_PACKET = 0x00000002
+VECTOR_E131_EXTENDED_SYNCHRONIZATION = 0x00000001
+VECTOR_E131_EXTENDED_DISCOVERY = 0x00000002
+VECTOR_UNIVERSE_DISCOVERY_UNIVERSE_LIST = 0x00000001
+VECTOR_DMP_SET_PROPERTY = 0x02
+DISCOVERY_UNIVERSE = 64214
+DISCOVERY_INTERVAL = 10.0
+
+# offsets into a data packet
+PRIORITY_OFFSET = 108
+SYNC_ADDRESS_OFFSET = 109
+SEQUENCE_OFFSET = 111
+OPTIONS_OFFSET = 112
+DMX_OFFSET = 126
+
+
+def new_cid() -> bytes:
+    # a random component identifier, one per source
+    return uuid.UUID(int=random.getrandbits(128)).bytes
+
+
+def multicast_address(universe: int) -> str:
+    return f'239.255.{universe >> 8 & 0xff}.{universe & 0xff}'
+
+
+def _flags_length(length: int) -> int:
+    return 0x7000 | length
+
+
+def _root_layer(buffer: bytearray, length: int, vector: int, cid: bytes):
+    struct.pack_into('!HH12sHI16s', buffer, 0, 0x0010, 0x0000, ACN_IDENTIFIER, _flags_length(length - 16), vector,
+                     cid)
+
+
+def _source_name(name: str) -> bytes:
+    return name.encode('utf-8')[:63].ljust(64, b'\x00')
+
+
+# One universe's E1.31 data packet, built once. Each send only rewrites the bytes that change (DMX slots, sequence
+# number and, rarely, priority) in place, and the whole packet is handed to the socket as a memoryview.
+class E131Packet:
+    def __init__(self, universe: int, cid: bytes, source_name: str, priority: int = 100, slots: int = UNIVERSE_SIZE,
+                 sync_address: int = 0):
+        length = DMX_OFFSET + slots
+        self.universe = universe
+        self.buffer = bytearray(length)
+        _root_layer(self.buffer, length, VECTOR_ROOT_E131_DATA, cid)
+        struct.pack_into('!HI64sBHBBH', self.buffer, 38, _flags_length(length - 38), VECTOR_E131_DATA_PACKET,
+                         _source_name(source_name), priority, sync_address, 0, 0, universe)
+        struct.pack_into('!HBBHHHB', self.buffer, 115, _flags_length(length - 115), VECTOR_DMP_SET_PROPERTY, 0xa1,
+                         0x0000, 0x0001, slots + 1, 0)
+        self.view = memoryview(self.buffer)
+        self.dmx = np.frombuffer(self.buffer, dtype=np.uint8, count=slots, offset=DMX_OFFSET)
+        self.sequence = 0
+
+    @property
+    def priority(self) -> int:
+        return self.buffer[PRIORITY_OFFSET]
+
+    @priority.setter
+    def priority(self, value: int):
+        self.buffer[PRIORITY_OFFSET] = value
+
+    @property
+    def sync_address(self) -> int:
+        return struct.unpack_from('!H', self.buffer, SYNC_ADDRESS_OFFSET)[0]
+
+    @sync_address.setter
+    def sync_address(self, value: int):
+        struct.pack_into('!H', self.buffer, SYNC_ADDRESS_OFFSET, value)
+
+    def next(self) -> memoryview:
+        self.buffer[SEQUENCE_OFFSET] = self.sequence
+        self.sequence = (self.sequence + 1) & 0xff
+        return self.view
+
+
+class E131SyncPacket:
+    def __init__(self, sync_address: int, cid: bytes):
+        length = 49
+        self.buffer = bytearray(length)
+        _root_layer(self.buffer, length, VECTOR_ROOT_E131_EXTENDED, cid)
+        struct.pack_into('!HIBHH', self.buffer, 38, _flags_length(length - 38), VECTOR_E131_EXTENDED_SYNCHRONIZATION,
+                         0, sync_address, 0)
+        self.view = memoryview(self.buffer)
+        self.sequence = 0
+
+    def next(self) -> memoryview:
+        self.buffer[44] = self.sequence
+        self.sequence = (self.sequence + 1) & 0xff
+        return self.view
+
+
+def discovery_packets(universes: List[int], cid: bytes, source_name: str) -> List[bytes]:
+    # universe discovery, at most 512 universes per page
+    universes = sorted(universes)
+    pages = [universes[i:i + 512] for i in range(0, len(universes), 512)] or [[]]
+    packets = []
+    for page, page_universes in enumerate(pages):
+        length = 120 + 2 * len(page_universes)
+        buffer = bytearray(length)
+        _root_layer(buffer, length, VECTOR_ROOT_E131_EXTENDED, cid)
+        struct.pack_into('!HI64s4x', buffer, 38, _flags_length(length - 38), VECTOR_E131_EXTENDED_DISCOVERY,
+                         _source_name(source_name))
+        struct.pack_into(f'!HIBB{len(page_universes)}H', buffer, 112, _flags_length(length - 112),
+                         VECTOR_UNIVERSE_DISCOVERY_UNIVERSE_LIST, page, len(pages) - 1, *page_universes)
+        packets.append(bytes(buffer))
+    return packets
+
+
+class _Iovec(ctypes.Structure):
+    _fields_ = [('base', ctypes.c_void_p), ('length', ctypes.c_size_t)]
+
+
+class _SockaddrIn(ctypes.Structure):
+    _fields_ = [('family', ctypes.c_ushort), ('port', ctypes.c_uint16), ('address', ctypes.c_uint32),
+                ('zero', ctypes.c_char * 8)]
+
+
+class _Msghdr(ctypes.Structure):
+    _fields_ = [('name', ctypes.c_void_p), ('name_length', ctypes.c_uint32), ('iov', ctypes.POINTER(_Iovec)),
+                ('iov_length', ctypes.c_size_t), ('control', ctypes.c_void_p), ('control_length', ctypes.c_size_t),
+                ('flags', ctypes.c_int)]
+
+
+class _Mmsghdr(ctypes.Structure):
+    _fields_ = [('header', _Msghdr), ('length', ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+# A batch of (packet buffer, destination) pairs that goes out in one sendmmsg() call on Linux. The message headers
+# point straight at the packet buffers, so they're built once and never touched again. A message that can't be
+# sent (an unreachable destination, say) is counted in failed and skipped, and the rest of the batch still goes.
+class BatchSender:
+    def __init__(self, sock: socket.socket, messages: List[Tuple[bytearray, Tuple[str, int]]]):
+        self.socket = sock
+        self.messages = messages
+        self.count = len(messages)
+        self.failed = 0
+        self.headers = None
+        if _sendmmsg is not None and sock.family == socket.AF_INET and self.count:
+            self._buffers = [(ctypes.c_char * len(buffer)).from_buffer(buffer) for buffer, _ in messages]
+            self._iovecs = (_Iovec * self.count)()
+            self._addresses = (_SockaddrIn * self.count)()
+            self.headers = (_Mmsghdr * self.count)()
+            for i, ((buffer, (host, port)), raw) in enumerate(zip(messages, self._buffers)):
+                self._iovecs[i].base = ctypes.addressof(raw)
+                self._iovecs[i].length = len(buffer)
+                address = self._addresses[i]
+                address.family = socket.AF_INET
+                address.port = socket.htons(port)
+                address.address = struct.unpack('=I', socket.inet_aton(host))[0]
+                header = self.headers[i].header
+                header.name = ctypes.addressof(address)
+                header.name_length = ctypes.sizeof(_SockaddrIn)
+                header.iov = ctypes.pointer(self._iovecs[i])
+                header.iov_length = 1
+
+    def send(self) -> int:
+        # returns how many messages went out
+        sent = 0
+        if self.headers is not None:
+            position = 0
+            while position < self.count:
+                result = _sendmmsg(self.socket.fileno(),
+                                   ctypes.addressof(self.headers) + position * ctypes.sizeof(_Mmsghdr),
+                                   self.count - position, 0)
+                if result < 0:
+                    # the error belongs to the first message that didn't go
+                    self.failed += 1
+                    logger.debug(f'sACN send to {self.messages[position][1]} failed: '
+                                 f'{OSError(ctypes.get_errno(), "sendmmsg failed")}')
+                    position += 1
+                elif result == 0:
+                    break
+                else:
+                    position += result
+                    sent += result
+            return sent
+        for buffer, destination in self.messages:
+            try:
+                self.socket.sendto(buffer, destination)
+                sent += 1
+            except OSError as e:
+                self.failed += 1
+                logger.debug(f'sACN send to {destination} failed: {e}')
+        return sent
+
+
+class E131Output:
+    def __init__(self, sender: 'E131Sender', universe: int):
+        self.sender = sender
+        self.universe = universe
+        self.packet = E131Packet(universe, sender.cid, sender.source_name, sender.priority)
+        self.multicast = sender.multicast
+        self.destination = sender.destination
+        self.changed = False
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return (multicast_address(self.universe) if self.multicast else self.destination), E131_PORT
+
+    @property
+    def priority(self) -> int:
+        return self.packet.priority
+
+    @priority.setter
+    def priority(self, value: int):
+        self.packet.priority = value
+
+    @property
+    def dmx_data(self):
+        return self.packet.dmx
+
+    @dmx_data.setter
+    def dmx_data(self, data):
+        with self.sender.lock:
+            self.packet.dmx[:len(data)] = np.frombuffer(data, dtype=np.uint8) \
+                if isinstance(data, (bytes, bytearray, memoryview)) else data
+            self.changed = True
+
+
+# sACN sender that replaces the sacn library's: the same output[universe].dmx_data interface, but every universe's
+# packet is preallocated and patched in place, and a tick sends every universe that changed since the last one
+# in a single batch. Unchanged universes are left to the caller's keepalives (see Universe.commit).
+class E131Sender:
+    def __init__(self, bind_address: str = '0.0.0.0', bind_port: int = 0, source_name: str = 'homestage',
+                 cid: Optional[bytes] = None, fps: float = 60, priority: int = 100, multicast: bool = True,
+                 destination: str = '127.0.0.1', ttl: int = 8, universe_discovery: bool = True):
+        self.bind_address = bind_address
+        self.bind_port = bind_port
+        self.source_name = source_name
+        self.cid = cid or new_cid()
+        self.fps = fps
+        self.priority = priority
+        self.multicast = multicast
+        self.destination = destination
+        self.ttl = ttl
+        self.universe_discovery = universe_discovery
+        self.outputs: Dict[int, E131Output] = {}
+        self.lock = threading.Lock()
+        self.socket = None
+        self._thread = None
+        self._running = False
+        self._batches = {}
+        self.last_tick = None
+        self.last_discovery = 0.0
+        self.packets = 0
+        self.batches = 0
+        self.errors = 0
+        self.send_time = 0.0
+        self.max_send_time = 0.0
+        self.send_time_per_packet = 0.0
+        self.packets_per_second = 0.0
+        self._window_start = None
+        self._window_packets = 0
+
+    def activate_output(self, universe: int):
+        if universe not in self.outputs:
+            self.outputs[universe] = E131Output(self, universe)
+            self._batches.clear()
+
+    def deactivate_output(self, universe: int):
+        self.outputs.pop(universe, None)
+        self._batches.clear()
+
+    def __getitem__(self, universe: int) -> E131Output:
+        return self.outputs[universe]
+
+    def get_active_outputs(self):
+        return tuple(self.outputs)
+
+    def _open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.bind((self.bind_address, self.bind_port))
+        return sock
+
+    def start(self):
+        self.stop()
+        self.socket = self._open()
+        self._batches.clear()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='homestage sACN sender', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        self._batches.clear()
+
+    def tick(self):
+        return self.last_tick
+
+    def _run(self):
+        period = 1 / self.fps
+        deadline = time.perf_counter()
+        while self._running:
+            now = time.perf_counter()
+            if now < deadline:
+                time.sleep(deadline - now)
+            deadline += period
+            if time.perf_counter() > deadline:
+                deadline = time.perf_counter() + period
+            self.flush()
+
+    def _batch(self, universes: Tuple[int, ...]) -> BatchSender:
+        batch = self._batches.get(universes)
+        if batch is None:
+            batch = BatchSender(self.socket, [(self.outputs[u].packet.buffer, self.outputs[u].address)
+                                              for u in universes])
+            self._batches[universes] = batch
+        return batch
+
+    def flush(self):
+        # send every universe that changed since the last flush, all in one go. Every flush is a tick, whether or
+        # not anything changed, so frames lock to the send clock through static scenes too
+        now = time.perf_counter()
+        self.last_tick = now
+        if self.universe_discovery and now - self.last_discovery > DISCOVERY_INTERVAL:
+            self.last_discovery = now
+            self._discover()
+        with self.lock:
+            universes = tuple(u for u, output in self.outputs.items() if output.changed)
+            if not universes:
+                return 0
+            for universe in universes:
+                output = self.outputs[universe]
+                output.packet.next()
+                output.changed = False
+            start = time.perf_counter()
+            batch = self._batch(universes)
+            failed = batch.failed
+            # on suspend or other network trouble sends fail; the failed ones are counted and the rest carry on
+            sent = batch.send()
+            self.errors += batch.failed - failed
+            elapsed = time.perf_counter() - start
+        self._record(sent, elapsed, start)
+        return sent
+
+    def _discover(self):
+        try:
+            for packet in discovery_packets(list(self.outputs), self.cid, self.source_name):
+                self.socket.sendto(packet, (multicast_address(DISCOVERY_UNIVERSE), E131_PORT))
+        except OSError:
+            self.errors += 1
+
+    def _record(self, sent: int, elapsed: float, now: float):
+        self.packets += sent
+        self.batches += 1
+        self.send_time += (elapsed - self.send_time) * 0.05
+        self.max_send_time = max(self.max_send_time, elapsed)
+        if sent:
+            # each batch's cost per packet, averaged like send_time
+            self.send_time_per_packet += (elapsed / sent - self.send_time_per_packet) * 0.05
+        if self._window_start is None:
+            self._window_start = now
+        self._window_packets += sent
+        if now - self._window_start >= 1:
+            self.packets_per_second = self._window_packets / (now - self._window_start)
+            self._window_start = now
+            self._window_packets = 0
+
+    def stats(self):
+        return {
+            'universes': len(self.outputs),
+            'packets': self.packets,
+            'batches': self.batches,
+            'errors': self.errors,
+            'packets_per_second': self.packets_per_second,
+            'send_time': self.send_time,
+            'max_send_time': self.max_send_time,
+            'send_time_per_packet': self.send_time_per_packet,
+            'batched': _sendmmsg is not None,
+        }
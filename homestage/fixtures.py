@@ -1,17 +1,95 @@
+from typing import Dict, Tuple
+
+import numpy as np
+
+
+class Channel:
+    # One DMX slot of a fixture, read and written straight through the fixture's channel buffer
+    def __init__(self, offset: int):
+        self.offset = offset
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        return int(obj.channels[self.offset])
+
+    def __set__(self, obj, value):
+        # numpy refuses out of range ints for a uint8 slot, so clip like the rig does
+        obj.channels[self.offset] = min(255, max(0, int(value)))
+
+
+class Alias:
+    # Attribute that drives several channels at once, like MiniSpider.r feeding two LEDs
+    def __init__(self, names: Tuple[str, ...]):
+        self.names = names
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        return getattr(obj, self.names[0])
+
+    def __set__(self, obj, value):
+        for name in self.names:
+            setattr(obj, name, value)
+
+
+# Each subclass's mapping is compiled into channel offsets when the class is created. An instance keeps its
+# channels in a small uint8 array until it is patched into a Universe, after which the same attributes read and
+# write a view of the universe buffer.
 class Fixture:
     mapping = []
+    universe = None
+    groups: Tuple[str, ...] = ()
+    # output curve per channel name, see homestage.color.CURVES
+    curves: Dict[str, object] = {}
+    # whether homestage.color.paint puts the common part of r, g and b on the white channel
+    white_from_rgb = False
+    aliases: Dict[str, Tuple[str, ...]] = {}
+    offsets: Dict[str, int] = {}
+    defaults = np.zeros(0, dtype=np.uint8)
 
-    def __new__(cls, address):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        defaults = []
+        for offset, key in enumerate(cls.mapping):
+            default = getattr(cls, key, 0)
+            if isinstance(default, Channel):
+                # inherited from the fixture this one subclasses: cls.defaults is still the parent's here
+                channel, default = default, int(cls.defaults[default.offset])
+                if channel.offset == offset:
+                    defaults.append(default)
+                    continue
+            defaults.append(default)
+            setattr(cls, key, Channel(offset))
+        for name, targets in cls.aliases.items():
+            alias = Alias(tuple(targets))
+            alias.__set_name__(cls, name)
+            setattr(cls, name, alias)
+        cls.offsets = {key: offset for offset, key in enumerate(cls.mapping)}
+        cls.defaults = np.array(defaults, dtype=np.uint8)
+
+    def __new__(cls, address=None, universe=None):
+        # address is 0 based within the universe; either can be left for homestage.universe.allocate to fill in
         o = super().__new__(cls)
-        for key in o.mapping:
-            if not hasattr(o, key):
-                setattr(o, key, 0)
+        o.channels = cls.defaults.copy()
         o.address = address
+        o.universe = universe
+        o.slot = address
         return o
 
+    @classmethod
+    def channel_offsets(cls, name):
+        # every channel written by an attribute, following aliases
+        if name in cls.offsets:
+            return [cls.offsets[name]]
+        return [offset for target in cls.aliases.get(name, ()) for offset in cls.channel_offsets(target)]
+
     @property
     def values(self):
-        return [getattr(self, k) for k in self.mapping]
+        return self.channels.tolist()
 
 
 class MovingHeadLight(Fixture):
@@ -27,28 +105,9 @@ class LEDWash(Fixture):
 class MiniSpider(Fixture):
     mapping = ['motor1', 'motor2', 'dimmer', 'strobe', 'led1', 'led2', 'led3', 'led4', 'led5', 'led6', 'led7', 'led8',
                'macro', 'speed', 'reset']
+    aliases = {
+        'r': ('led1', 'led5'),
+        'g': ('led2', 'led6'),
+        'b': ('led3', 'led7'),
+    }
     dimmer = 255
-
-    @property
-    def r(self):
-        return self.led1
-
-    @r.setter
-    def r(self, value):
-        self.led1 = self.led5 = value
-
-    @property
-    def g(self):
-        return self.led2
-
-    @g.setter
-    def g(self, value):
-        self.led2 = self.led6 = value
-
-    @property
-    def b(self):
-        return self.led1
-
-    @b.setter
-    def b(self, value):
-        self.led3 = self.led7 = value
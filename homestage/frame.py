@@ -0,0 +1,209 @@
+import math
+import time
+from typing import Optional
+
+import numpy as np
+
+
+class SystemClock:
+    def now(self) -> float:
+        return time.perf_counter()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+
+# Time only moves when someone sleeps or advances it, so a render loop driven by it runs as fast as it can
+class VirtualClock:
+    def __init__(self, start: float = 0.0):
+        self.time = start
+
+    def now(self) -> float:
+        return self.time
+
+    def sleep(self, seconds: float):
+        self.time += max(0.0, seconds)
+
+    def advance(self, seconds: float):
+        self.time += seconds
+
+
+# Everything a pattern needs to know about the current frame, read once per frame so every fixture sees the same
+# instant: the clock, a copy of the audio analysis, the predicted beat and the media playhead. The pattern controller
+# fills in the seconds to the next section and segment of the media, if it knows them.
+class FrameContext:
+    __slots__ = ('index', 'time', 'dt', 'spectrum', 'beat', 'tempo', 'beat_index', 'beat_phase', 'media', 'position',
+                 'next_section', 'next_segment')
+
+    def __init__(self, index: int, time: float, dt: float, spectrum: np.ndarray, beat: bool, tempo: float,
+                 beat_index: Optional[int], beat_phase: Optional[float], media, position: Optional[float],
+                 next_section: Optional[float] = None, next_segment: Optional[float] = None):
+        self.index = index
+        self.time = time
+        self.dt = dt
+        self.spectrum = spectrum
+        self.beat = beat
+        self.tempo = tempo
+        self.beat_index = beat_index
+        self.beat_phase = beat_phase
+        self.media = media
+        self.position = position
+        self.next_section = next_section
+        self.next_segment = next_segment
+
+
+class FrameBuilder:
+    def __init__(self, clock=None):
+        self.clock = clock or SystemClock()
+        self.index = -1
+        self.last_time = None
+
+    def next(self, state) -> FrameContext:
+        now = self.clock.now()
+        dt = now - self.last_time if self.last_time is not None else 0.0
+        self.index += 1
+        self.last_time = now
+        tracker = state.beat_tracker
+        media = state.media
+        return FrameContext(
+            index=self.index,
+            time=now,
+            dt=dt,
+            spectrum=state.spectrum_adjusted.copy(),
+            beat=bool(state.beat),
+            tempo=state.current_tempo,
+            beat_index=tracker.beat_index(now),
+            beat_phase=tracker.phase(now),
+            media=media,
+            position=media.timeline.position_at(now),
+        )
+
+
+HISTOGRAM_BINS = 200
+HISTOGRAM_BIN_WIDTH = 0.00025
+
+
+# Fixed-bin histogram of durations in seconds; the last bin also collects everything beyond it
+class Histogram:
+    def __init__(self, bins: int = HISTOGRAM_BINS, bin_width: float = HISTOGRAM_BIN_WIDTH):
+        self.bin_width = bin_width
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.total = 0.0
+        self.max = 0.0
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def add(self, value: float):
+        self.counts[min(int(max(value, 0.0) / self.bin_width), len(self.counts) - 1)] += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def reset(self):
+        self.counts[:] = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def percentile(self, p: float) -> Optional[float]:
+        # upper edge of the bin the percentile falls in
+        count = self.count
+        if not count:
+            return None
+        index = int(np.searchsorted(np.cumsum(self.counts), count * p / 100))
+        return (index + 1) * self.bin_width
+
+    def summary(self):
+        count = self.count
+        return {
+            'count': count,
+            'mean': self.total / count if count else None,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'histogram': self.counts.tolist(),
+            'bin_width': self.bin_width,
+        }
+
+
+# Paces the render loop against absolute deadlines one period apart, so the rate doesn't drift with pattern cost.
+# Sleeps are cut short by the oversleep seen so far. A frame that overruns pushes the next deadline to the next
+# whole period rather than bunching frames up to catch up. Given tick, a callable returning when the output last
+# sent (on the same clock), the deadlines are slowly pulled to lead seconds ahead of the send, so each rendered
+# frame goes out on the next packet instead of being sent twice or skipped.
+class FrameScheduler:
+    def __init__(self, clock=None, fps: float = 60.0, tick=None, lead: float = 0.004, lock_gain: float = 0.1):
+        self.clock = clock or SystemClock()
+        self.period = 1 / fps
+        self.tick = tick
+        self.lead = lead
+        self.lock_gain = lock_gain
+        self.deadline = None
+        self.oversleep = 0.0
+        self.started = None
+        self.frames = 0
+        self.dropped = 0
+        self.phase_error = 0.0
+        self.frame_times = Histogram()
+        self.jitter = Histogram()
+        self.intervals = Histogram()
+
+    @property
+    def fps(self) -> float:
+        return 1 / self.period
+
+    def reset(self):
+        self.deadline = None
+        self.started = None
+
+    def wait(self) -> float:
+        clock = self.clock
+        now = clock.now()
+        if self.deadline is None:
+            self.deadline = now
+        remaining = self.deadline - now - self.oversleep
+        if remaining > 0:
+            clock.sleep(remaining)
+            woke = clock.now()
+            self.oversleep += (woke - (now + remaining) - self.oversleep) * 0.1
+        start = clock.now()
+        self.jitter.add(start - self.deadline)
+        if self.started is not None:
+            self.intervals.add(start - self.started)
+        self.started = start
+        return start
+
+    def done(self):
+        end = self.clock.now()
+        self.frame_times.add(end - self.started)
+        self.frames += 1
+        self.deadline += self.period
+        if self.tick is not None:
+            self._lock()
+        if end > self.deadline:
+            missed = math.floor((end - self.deadline) / self.period) + 1
+            self.dropped += missed
+            self.deadline += missed * self.period
+
+    def _lock(self):
+        tick = self.tick()
+        if tick is None:
+            return
+        # distance from the wanted phase, wrapped into half a period either way
+        error = (self.deadline - (tick - self.lead)) / self.period
+        error = (error - round(error)) * self.period
+        self.phase_error = error
+        self.deadline -= error * self.lock_gain
+
+    def stats(self):
+        return {
+            'fps': self.fps,
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'oversleep': self.oversleep,
+            'phase_error': self.phase_error if self.tick is not None else None,
+            'frame_time': self.frame_times.summary(),
+            'jitter': self.jitter.summary(),
+            'interval': self.intervals.summary(),
+        }
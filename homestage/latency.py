@@ -0,0 +1,306 @@
+import logging
+import multiprocessing
+import socket
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from homestage.artnet import ARTNET_ID, ARTNET_PORT, OP_DMX, OP_SYNC
+from homestage.backends import create_backend
+from homestage.color import paint
+from homestage.controller import AudioState, HomeStage, StageConfig
+from homestage.e131 import ACN_IDENTIFIER, DMX_OFFSET, E131_PORT, SEQUENCE_OFFSET, VECTOR_E131_DATA_PACKET, \
+    VECTOR_E131_EXTENDED_SYNCHRONIZATION, VECTOR_ROOT_E131_DATA, VECTOR_ROOT_E131_EXTENDED
+from homestage.patterns import Pattern
+from homestage.sources import ImpulseSource
+
+logger = logging.getLogger(__name__)
+
+SYNC = 'sync'
+
+# clicks this close to the end of a run may not have made it to the wire yet, so they aren't counted
+SETTLE_TIME = 0.25
+
+
+def parse_packet(data: memoryview):
+    # (universe, sequence, sequence modulus, slots) for an sACN or Art-Net DMX packet, SYNC for their sync packets
+    # and None for anything else
+    if len(data) >= DMX_OFFSET and data[4:16] == ACN_IDENTIFIER:
+        root_vector = int.from_bytes(data[18:22], 'big')
+        framing_vector = int.from_bytes(data[40:44], 'big')
+        if root_vector == VECTOR_ROOT_E131_EXTENDED and framing_vector == VECTOR_E131_EXTENDED_SYNCHRONIZATION:
+            return SYNC
+        if root_vector != VECTOR_ROOT_E131_DATA or framing_vector != VECTOR_E131_DATA_PACKET or data[125] != 0:
+            return None
+        count = int.from_bytes(data[123:125], 'big') - 1
+        return int.from_bytes(data[113:115], 'big'), data[SEQUENCE_OFFSET], 256, data[DMX_OFFSET:DMX_OFFSET + count]
+    if len(data) >= 14 and data[:8] == ARTNET_ID:
+        opcode = int.from_bytes(data[8:10], 'little')
+        if opcode == OP_SYNC:
+            return SYNC
+        if opcode != OP_DMX or len(data) < 18:
+            return None
+        length = int.from_bytes(data[16:18], 'big')
+        # sequence 0 means the sender doesn't number its packets
+        return int.from_bytes(data[14:16], 'little'), data[12] or None, 255, data[18:18 + length]
+    return None
+
+
+# What one universe looked like on the wire. Only the probe slots (the r, g and b channels ProbePattern drives) say
+# whether it's lit: it is when most of them are at half level or above, and each change from dark to lit is an
+# onset. Everything else in the universe, and whatever a sender put out before the first rendered frame, is ignored.
+class UniverseTrace:
+    def __init__(self, probe_slots=()):
+        self.probe_slots = np.asarray(probe_slots, dtype=np.intp)
+        self.lit = False
+        self.sequence = None
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.arrivals = []
+        self.onsets = []
+
+    def add(self, now: float, sequence: Optional[int], modulus: int, slots: memoryview):
+        self.received += 1
+        if sequence is not None:
+            if self.sequence is not None:
+                gap = (sequence - self.sequence - 1) % modulus
+                if gap > modulus // 2:
+                    # an old packet arriving late, its data is stale
+                    self.reordered += 1
+                    return
+                self.lost += gap
+            self.sequence = sequence
+        self.arrivals.append(now)
+        if not len(self.probe_slots):
+            return
+        levels = np.frombuffer(slots, dtype=np.uint8)
+        probes = self.probe_slots[self.probe_slots < len(levels)]
+        lit = int(np.count_nonzero(levels[probes] >= 128)) * 2 > len(self.probe_slots)
+        if lit and not self.lit:
+            self.onsets.append(now)
+        self.lit = lit
+
+
+def probe_slots(fixtures: List, universe_offset: int = 0) -> Dict[int, List[int]]:
+    # wire universe -> slots of the channels ProbePattern paints; its white goes all on w where paint() mixes it
+    slots = {}
+    for fixture in fixtures:
+        names = ('w',) if fixture.white_from_rgb and fixture.channel_offsets('w') else ('r', 'g', 'b')
+        for name in names:
+            for offset in fixture.channel_offsets(name):
+                slots.setdefault(fixture.universe + universe_offset, []).append(fixture.address + offset)
+    return slots
+
+
+def run_receiver(host: str, port: int, probes: Dict[int, List[int]], connection):
+    # Stands in for a lighting node. Runs in a process of its own so it never waits on the stage's threads for
+    # the GIL; perf_counter is the system-wide monotonic clock on Linux, so its timestamps compare with the stage's.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.settimeout(0.05)
+    buffer = bytearray(2048)
+    traces: Dict[int, UniverseTrace] = {}
+    syncs = 0
+    connection.send('ready')
+    while not connection.poll():
+        try:
+            size = sock.recv_into(buffer)
+        except socket.timeout:
+            continue
+        now = time.perf_counter()
+        packet = parse_packet(memoryview(buffer)[:size])
+        if packet == SYNC:
+            syncs += 1
+        elif packet is not None:
+            universe, sequence, modulus, slots = packet
+            trace = traces.get(universe)
+            if trace is None:
+                trace = traces[universe] = UniverseTrace(probes.get(universe, ()))
+            trace.add(now, sequence, modulus, slots)
+    connection.recv()
+    sock.close()
+    connection.send({'traces': traces, 'syncs': syncs})
+
+
+# AudioState that notes when each click entered it (the timestamp the capture thread put its block in the ring
+# with) and when analysis got to it
+class ProbeAudioState(AudioState):
+    def __init__(self, config: StageConfig, threshold: float = 0.4, **kwargs):
+        super().__init__(config, **kwargs)
+        self.threshold = threshold
+        self.entered = []
+        self.analyzed = []
+        self._loud = False
+
+    def start(self):
+        for target in (self._capture, self._analyze):
+            threading.Thread(target=target, daemon=True).start()
+
+    def process(self, signal: np.ndarray, timestamp: float, measure_latency: bool = True):
+        super().process(signal, timestamp, measure_latency)
+        loud = float(np.abs(signal).max()) >= self.threshold
+        if loud and not self._loud:
+            self.analyzed.append(time.perf_counter())
+            self.entered.append(timestamp)
+        self._loud = loud
+
+
+# Full white for hold seconds after each click the audio state has seen, dark otherwise. Both alternate between two
+# levels on the same side of half so every frame differs from the last and goes out, which lets the receiver see
+# the frame rate on the wire.
+class ProbePattern(Pattern):
+    def __init__(self, state: ProbeAudioState, hold: float = 0.1):
+        self.state = state
+        self.hold = hold
+        self.seen = 0
+        self.lit_until = float('-inf')
+        self.rendered = []
+
+    def update(self, rig, frame):
+        count = len(self.state.entered)
+        if count != self.seen:
+            self.rendered.extend([frame.time] * (count - self.seen))
+            self.seen = count
+            self.lit_until = frame.time + self.hold
+        step = 0.2 * (frame.index % 2)
+        level = 1.0 - step if frame.time < self.lit_until else step
+        paint(rig, np.full(3, level))
+        rig.brightness = 255
+        return False
+
+
+def distribution(values) -> dict:
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': float(values.mean()),
+        'std': float(values.std()),
+        'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+    }
+
+
+# Runs HomeStage in real time against a synthetic click track and a receiver on localhost, and measures how long
+# each click takes from entering AudioState to the lit frame arriving on the wire, along with packet loss and how
+# steady the frame rate is. Needs no audio device or lighting hardware.
+class LatencyHarness:
+    def __init__(self, config: StageConfig, fixtures: List, interval: float = 0.5, jitter: float = 0.25,
+                 hold: float = 0.1, threshold: float = 0.4, seed: int = 0):
+        backends = [config.output_backend] if isinstance(config.output_backend, str) else config.output_backend
+        if 'null' in backends:
+            raise ValueError('the null backend sends nothing to measure')
+        self.port = ARTNET_PORT if backends[0] == 'artnet' else E131_PORT
+        self.probes = probe_slots(fixtures, config.artnet_universe_offset if backends[0] == 'artnet' else 0)
+        # everything goes to the receiver on localhost
+        config.fixtures = fixtures
+        config.sacn_multicast = False
+        config.sacn_destination = '127.0.0.1'
+        config.sacn_destinations = {}
+        config.artnet_destination = '127.0.0.1'
+        config.artnet_destinations = {}
+        config.audio_source = ImpulseSource(interval, jitter, seed=seed)
+        self.config = config
+        self.output = create_backend(config)
+        self.state = ProbeAudioState(config, threshold, sample_rate=config.audio_sample_rate,
+                                     band_count=config.audio_band_count, band_layout=config.audio_band_layout,
+                                     window=config.audio_window, latency_offset=config.audio_latency_offset)
+        self.stage = HomeStage(config, fixtures, self.output, state=self.state)
+        self.pattern = ProbePattern(self.state, hold)
+        self.stage.controller.pattern = self.pattern
+
+    def run(self, seconds: float) -> dict:
+        context = multiprocessing.get_context('spawn')
+        connection, child = context.Pipe()
+        receiver = context.Process(target=run_receiver, name='homestage-receiver', daemon=True,
+                                   args=('127.0.0.1', self.port, self.probes, child))
+        receiver.start()
+        connection.recv()
+
+        self.stage.enabled = True
+        threading.Thread(target=self.stage.run, daemon=True).start()
+        self.state.start()
+        time.sleep(seconds)
+        end = time.perf_counter()
+        self.stage.enabled = False
+        # let the last packets land
+        time.sleep(SETTLE_TIME)
+
+        connection.send('stop')
+        results = connection.recv()
+        receiver.join()
+        return self.summarize(results, end)
+
+    def summarize(self, results: dict, end: float) -> dict:
+        traces: Dict[int, UniverseTrace] = results['traces']
+        count = sum(1 for entered in self.state.entered if entered < end - SETTLE_TIME)
+        entered = np.array(self.state.entered[:count])
+        analyzed = np.array(self.state.analyzed[:count])
+        rendered = np.array(self.pattern.rendered[:count])
+        # universes without anything the probe paints never light up
+        onsets = [np.array(trace.onsets) for trace in traces.values() if len(trace.probe_slots)]
+
+        # a click's lit frame is the first onset after it and before the next click, and it's on the wire once
+        # every universe has shown it
+        matched = []
+        wire = []
+        for i, start in enumerate(entered):
+            stop = entered[i + 1] if i + 1 < len(entered) else end
+            arrivals = []
+            for universe_onsets in onsets:
+                j = np.searchsorted(universe_onsets, start)
+                if j < len(universe_onsets) and universe_onsets[j] < stop:
+                    arrivals.append(universe_onsets[j])
+            if onsets and len(arrivals) == len(onsets) and i < len(rendered):
+                matched.append(i)
+                wire.append(max(arrivals))
+        wire = np.array(wire)
+
+        received = sum(trace.received for trace in traces.values())
+        lost = sum(trace.lost for trace in traces.values())
+        intervals = np.concatenate([np.diff(trace.arrivals) for trace in traces.values()] or [np.zeros(0)])
+        period = 1 / self.config.render_fps
+        frames = self.stage.scheduler.stats()
+
+        return {
+            'backend': self.config.output_backend,
+            'universes': len(self.stage.universe.numbers),
+            'fixtures': len(self.stage.fixtures),
+            'latency': {
+                'events': len(entered),
+                'missed': len(entered) - len(matched),
+                'audio_to_wire': distribution(wire - entered[matched]),
+                'analysis': distribution(analyzed - entered),
+                'audio_to_frame': distribution(rendered - entered[:len(rendered)]),
+                'frame_to_wire': distribution(wire - rendered[matched]),
+            },
+            'packets': {
+                'received': received,
+                'lost': lost,
+                'reordered': sum(trace.reordered for trace in traces.values()),
+                'loss': lost / (received + lost) if received + lost else 0.0,
+                'syncs': results['syncs'],
+                'missing_universes': sorted(set(self.stage.universe.numbers) - set(traces)),
+            },
+            'wire_frames': {
+                'fps': 1 / intervals.mean() if len(intervals) else 0.0,
+                'interval': distribution(intervals),
+                'late': int(np.count_nonzero(intervals > period * 1.5)),
+            },
+            'render': {
+                'fps': frames['fps'],
+                'frames': frames['frames'],
+                'dropped': frames['dropped'],
+                'jitter': {key: frames['jitter'][key] for key in ('p50', 'p95', 'p99', 'max')},
+                'interval': {key: frames['interval'][key] for key in ('p50', 'p95', 'p99', 'max')},
+            },
+            'audio': self.state.stats(),
+            'sender': self.output.stats(),
+        }
@@ -0,0 +1,191 @@
+import math
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from homestage.rig import Rig
+
+HTP = 'htp'
+LTP = 'ltp'
+
+# Intensity channels merge highest-takes-precedence, so a fading layer can only add light; everything else (pan,
+# tilt, motors, macros...) merges latest-takes-precedence, where a layer moves the value towards its own by its level.
+INTENSITY = {'level', 'brightness', 'dimmer', 'r', 'g', 'b', 'w',
+             'led1', 'led2', 'led3', 'led4', 'led5', 'led6', 'led7', 'led8'}
+
+CURVES = {
+    'linear': lambda t: t,
+    'smooth': lambda t: t * t * (3 - 2 * t),
+    'sine': lambda t: (1 - math.cos(t * math.pi)) / 2,
+    'exponential': lambda t: t * t,
+}
+
+
+def group_mask(fixtures: List, groups: Optional[Iterable[str]]) -> Optional[np.ndarray]:
+    # a fixture belongs to its class name and to any groups it was given in the config
+    if groups is None:
+        return None
+    groups = set(groups)
+    return np.array([type(f).__name__ in groups or bool(groups.intersection(f.groups)) for f in fixtures],
+                    dtype=np.float64)
+
+
+class Layer:
+    def __init__(self, pattern, level: float = 1.0, groups: Optional[Iterable[str]] = None):
+        self.pattern = pattern
+        self.level = level
+        self.groups = None if groups is None else tuple(groups)
+        self.rig = None
+        self.mask = None
+        self.fade = None
+
+    def fade_to(self, level: float, start: float, duration: float, curve: str):
+        if duration <= 0:
+            self.level = level
+            self.fade = None
+        else:
+            self.fade = (self.level, level, start, duration, CURVES[curve])
+
+    @property
+    def fading_out(self):
+        return self.fade is not None and self.fade[1] < self.fade[0]
+
+    def advance(self, now: float):
+        if self.fade is None:
+            return
+        start_level, end_level, start, duration, curve = self.fade
+        t = min(1.0, max(0.0, (now - start) / duration))
+        self.level = start_level + (end_level - start_level) * curve(t)
+        if t >= 1:
+            self.fade = None
+
+    def bind(self, rig: Rig):
+        # each layer renders into its own rig over the same fixtures; it's never flushed, only read by the mixer
+        if self.rig is None or self.rig.fixtures != rig.fixtures:
+            self.rig = Rig(rig.fixtures, rig.universe)
+            self.mask = group_mask(rig.fixtures, self.groups)
+        return self.rig
+
+
+# Renders several patterns at once and blends them into the stage rig. Layers are kept bottom to top; crossfade()
+# puts a new pattern on top fading in while every layer below fades out and is dropped once it reaches zero.
+# Blending is a handful of whole-rig array operations per attribute, so the cost doesn't depend on the pattern.
+class Mixer:
+    def __init__(self, pattern=None, fade_time: float = 1.0, fade_curve: str = 'smooth',
+                 merge: Optional[Dict[str, str]] = None):
+        if fade_curve not in CURVES:
+            raise ValueError(f'unknown fade curve {fade_curve!r}')
+        self.fade_time = fade_time
+        self.fade_curve = fade_curve
+        self.merge = merge or {}
+        self.layers: List[Layer] = []
+        self.now = None
+        self._weight = np.empty(0)
+        self._delta = np.empty(0)
+        if pattern is not None:
+            self.add(pattern)
+
+    @property
+    def pattern(self):
+        # the pattern that's on top, or fading in
+        return self.layers[-1].pattern if self.layers else None
+
+    def add(self, pattern, level: float = 1.0, groups: Optional[Iterable[str]] = None) -> Layer:
+        layer = Layer(pattern, level, groups)
+        self.layers.append(layer)
+        return layer
+
+    def remove(self, layer: Layer):
+        self.layers.remove(layer)
+
+    def crossfade(self, pattern, duration: Optional[float] = None, curve: Optional[str] = None,
+                  groups: Optional[Iterable[str]] = None) -> Layer:
+        duration = self.fade_time if duration is None else duration
+        curve = curve or self.fade_curve
+        if self.now is None:
+            # nothing rendered yet, so there's nothing to fade from
+            duration = 0
+        # a pattern that's still fading out is brought back from where it is rather than rendered twice
+        layer = next((layer for layer in self.layers if layer.pattern is pattern), None)
+        if layer is not None:
+            self.layers.remove(layer)
+            layer.fade = None
+        for other in self.layers:
+            other.fade_to(0.0, self.now, duration, curve)
+        if layer is None:
+            layer = Layer(pattern, 0.0, groups)
+        elif groups is not None:
+            layer.groups = tuple(groups)
+            layer.rig = None
+        self.layers.append(layer)
+        layer.fade_to(1.0, self.now, duration, curve)
+        self._drop_finished()
+        return layer
+
+    def _drop_finished(self):
+        self.layers = [layer for layer in self.layers if layer.level > 0 or layer.fade is not None]
+
+    def on_media_change(self, media):
+        for layer in self.layers:
+            layer.pattern.on_media_change(media)
+
+    def on_section_change(self, section):
+        for layer in self.layers:
+            layer.pattern.on_section_change(section)
+
+    def on_segment_change(self, segment):
+        for layer in self.layers:
+            layer.pattern.on_segment_change(segment)
+
+    def update(self, rig: Rig, frame):
+        self.now = frame.time
+        for layer in self.layers:
+            layer.advance(frame.time)
+        self._drop_finished()
+
+        if len(self.layers) == 1 and self.layers[0].level >= 1 and self.layers[0].groups is None:
+            # nothing to blend: let the pattern draw straight into the stage rig, and start its own rig over from
+            # the output if it's faded again later
+            self.layers[0].rig = None
+            return self.layers[0].pattern.update(rig, frame)
+
+        if len(self._weight) != rig.count:
+            self._weight = np.empty(rig.count)
+            self._delta = np.empty(rig.count)
+
+        names = set()
+        for layer in self.layers:
+            layer.pattern.update(layer.bind(rig), frame)
+            names.update(layer.rig.values)
+
+        for name in names:
+            self._blend(rig, name)
+        return False
+
+    def _blend(self, rig: Rig, name: str):
+        out = getattr(rig, name)
+        weight = self._weight
+        delta = self._delta
+        htp = self.merge.get(name, HTP if name in INTENSITY else LTP) == HTP
+        if htp:
+            out[:] = 0
+
+        for layer in self.layers:
+            values = getattr(layer.rig, name)
+            if htp:
+                level = layer.level
+            else:
+                # a layer fading out keeps its precedence while the layers above it fade in over it
+                level = 1.0 if layer.fading_out else layer.level
+            if layer.mask is None:
+                weight[:] = level
+            else:
+                np.multiply(layer.mask, level, out=weight)
+
+            if htp:
+                np.multiply(values, weight, out=weight)
+                np.maximum(out, weight, out=out)
+            else:
+                np.subtract(values, out, out=delta)
+                delta *= weight
+                out += delta
@@ -1,15 +1,80 @@
 import datetime
-from typing import Optional, Iterable, TypeVar, List
+from typing import Optional, Iterable, TypeVar, List, Generic, Dict, Sequence
 
-from bisect import bisect_right
+import numpy as np
+from marshmallow import Schema, fields, post_load, ValidationError
 
-from marshmallow import Schema, fields, post_load
+from homestage.timeline import MediaTimeline
+
+# how many boundaries a cursor walks forward before treating the move as a seek
+CURSOR_STEPS = 4
+
+
+class Column:
+    # Attribute stored in a column of the owning TimingList (or a one-row column set for standalone objects)
+    def __init__(self, optional: bool = False):
+        self.optional = optional
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        value = obj._columns[self.name][obj._index]
+        if self.optional and value != value:  # NaN marks a missing value
+            return None
+        return value
+
+    def __set__(self, obj, value):
+        obj._columns[self.name][obj._index] = value
+
+
+class MatrixColumn(Column):
+    # Fixed-width vector per entry, stored as one row of a 2D float32 array
+    def __init__(self, width: int):
+        super().__init__(optional=True)
+        self.width = width
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        value = obj._columns[self.name][obj._index]
+        if value is None or value[0] != value[0]:
+            return None
+        return value
 
 
 class Timing:
+    __slots__ = ('_columns', '_index')
+    fields = ('start',)
+    matrix_fields = ()
+    start = Column()
+
     def __init__(self, start: float):
+        self._columns = {name: [None] for name in self.fields + self.matrix_fields}
+        self._index = 0
         self.start = start
 
+    @classmethod
+    def view(cls, columns: Dict[str, Sequence], index: int):
+        o = cls.__new__(cls)
+        o._columns = columns
+        o._index = index
+        return o
+
+    def __eq__(self, o: object) -> bool:
+        return isinstance(o, Timing) and o._columns is self._columns and o._index == self._index
+
+    def __hash__(self):
+        return hash((id(self._columns), self._index))
+
+    @classmethod
+    def column_dtype(cls, name: str):
+        # timestamps keep double precision, everything else is a float32 feature
+        return np.float64 if name in ('start', 'duration') else np.float32
+
     def __lt__(self, o: object) -> bool:
         try:
             other = getattr(o, 'start')
@@ -42,16 +107,94 @@ class Timing:
 T = TypeVar('T')
 
 
-class TimingList(Iterable[T], list):
+class TimingCursor:
+    def __init__(self, timings: 'TimingList'):
+        self.starts = timings.starts
+        self.index = -1
+
+    def seek(self, offset: float) -> int:
+        # index of the last entry starting at or before offset, or -1
+        starts = self.starts
+        count = len(starts)
+        index = self.index
+        if index < 0 or starts[index] <= offset:
+            for _ in range(CURSOR_STEPS):
+                if index + 1 < count and starts[index + 1] <= offset:
+                    index += 1
+                else:
+                    self.index = index
+                    return index
+        index = int(np.searchsorted(starts, offset, side='right')) - 1
+        self.index = index
+        return index
+
+
+# Timeline of Section/Segment entries stored as one array per field. Indexing hands out views onto the columns, and
+# at() follows playback with a cursor so the usual forward-moving lookup doesn't search at all.
+class TimingList(Generic[T]):
+    def __init__(self, items: Iterable[T] = (), item_type: Optional[type] = None,
+                 columns: Optional[Dict[str, Sequence]] = None):
+        if columns is None:
+            items = list(items)
+            if item_type is None and items:
+                item_type = type(items[0])
+            columns = {}
+            if item_type is not None:
+                for name in item_type.fields:
+                    columns[name] = to_column([getattr(item, name) for item in items],
+                                              item_type.column_dtype(name))
+                for name in item_type.matrix_fields:
+                    columns[name] = to_matrix([getattr(item, name) for item in items],
+                                              getattr(item_type, name).width)
+        self.item_type = item_type
+        self.columns = columns
+        self.starts = columns['start'] if 'start' in columns else np.empty(0)
+        self._cursor = TimingCursor(self)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index: int) -> T:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('timing index out of range')
+        return self.item_type.view(self.columns, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.item_type.view(self.columns, index)
+
+    def cursor(self) -> TimingCursor:
+        return TimingCursor(self)
+
     def at(self, offset) -> T:
-        index = bisect_right(self, Timing(offset))
-        if index == 0:
+        index = self._cursor.seek(offset)
+        if index < 0:
             return None
         else:
-            return self[index - 1]
+            return self.item_type.view(self.columns, index)
+
+
+def to_column(values, dtype=np.float64) -> np.ndarray:
+    return np.array([np.nan if value is None else value for value in values], dtype=dtype)
+
+
+def to_matrix(rows, width: int) -> np.ndarray:
+    matrix = np.full((len(rows), width), np.nan, dtype=np.float32)
+    for i, row in enumerate(rows):
+        if row is not None:
+            matrix[i] = row
+    return matrix
 
 
 class Section(Timing):
+    __slots__ = ()
+    fields = ('start', 'duration', 'loudness', 'tempo')
+    duration = Column()
+    loudness = Column(optional=True)
+    tempo = Column(optional=True)
+
     def __init__(self, start: float, duration: float, loudness: Optional[float] = None,
                  tempo: Optional[float] = None):
         super().__init__(start)
@@ -64,6 +207,17 @@ class Section(Timing):
 
 
 class Segment(Timing):
+    __slots__ = ()
+    fields = ('start', 'duration', 'loudness_start', 'loudness_max', 'loudness_max_time', 'loudness_end')
+    matrix_fields = ('pitches', 'timbre')
+    duration = Column()
+    loudness_start = Column(optional=True)
+    loudness_max = Column(optional=True)
+    loudness_max_time = Column(optional=True)
+    loudness_end = Column(optional=True)
+    pitches = MatrixColumn(12)
+    timbre = MatrixColumn(12)
+
     def __init__(self, start: float, duration: float, loudness_start: Optional[float] = None,
                  loudness_max: Optional[float] = None, loudness_max_time: Optional[float] = None,
                  loudness_end: Optional[float] = None, pitches: List[float] = None, timbre: List[float] = None):
@@ -113,13 +267,28 @@ class Media:
         self.title = title
         self.uri = uri
         self.type = type
+        self.timeline = MediaTimeline()
+        self._start_datetime = None
         self.start_datetime = start_datetime
         self.analysis = analysis or Analysis()
 
+    @property
+    def start_datetime(self) -> Optional[datetime.datetime]:
+        return self._start_datetime
+
+    @start_datetime.setter
+    def start_datetime(self, value: Optional[datetime.datetime]):
+        # the wall clock is only read here; the timeline turns it into a sync sample on the monotonic clock
+        self._start_datetime = value
+        if value is None:
+            self.timeline.stop()
+        else:
+            at = self.timeline.clock()
+            self.timeline.sync((datetime.datetime.now(datetime.timezone.utc) - value).total_seconds(), at)
+
     @property
     def position(self):
-        return (datetime.datetime.now(
-            datetime.timezone.utc) - self.start_datetime).total_seconds() if self.start_datetime else None
+        return self.timeline.position
 
 
 class SectionSchema(Schema):
@@ -129,7 +298,7 @@ class SectionSchema(Schema):
     tempo = fields.Float()
 
     @post_load
-    def construct(self, data):
+    def construct(self, data, **kwargs):
         return Section(**data)
 
 
@@ -144,7 +313,7 @@ class SegmentSchema(Schema):
     timbre = fields.List(fields.Float)
 
     @post_load
-    def construct(self, data):
+    def construct(self, data, **kwargs):
         return Segment(**data)
 
 
@@ -161,11 +330,11 @@ class AnalysisSchema(Schema):
     segments = fields.Nested(SegmentSchema, many=True)
 
     @post_load
-    def construct(self, data):
+    def construct(self, data, **kwargs):
         if data.get('sections') is not None:
-            data['sections'] = TimingList(sorted(data['sections']))
+            data['sections'] = TimingList(sorted(data['sections']), Section)
         if data.get('segments') is not None:
-            data['segments'] = TimingList(sorted(data['segments']))
+            data['segments'] = TimingList(sorted(data['segments']), Segment)
         return Analysis(**data)
 
 
@@ -174,7 +343,7 @@ class StartDateTimeSchema(Schema):
     at = fields.AwareDateTime(required=True)
 
     @post_load
-    def construct(self, data):
+    def construct(self, data, **kwargs):
         return data['at'] - datetime.timedelta(seconds=data['elapsed'])
 
 
@@ -187,7 +356,108 @@ class MediaSchema(Schema):
     analysis = fields.Nested(AnalysisSchema)
 
     @post_load
-    def construct(self, data):
+    def construct(self, data, **kwargs):
         if data.get('analysis') is None:
             data['analysis'] = Analysis()
         return Media(**data)
+
+
+ANALYSIS_FIELDS = ('danceability', 'energy', 'loudness', 'speechiness', 'acousticness', 'instrumentalness',
+                   'liveness', 'valence')
+REQUIRED_TIMING_FIELDS = ('start', 'duration')
+
+
+# Fast path for AnalysisSchema: converts the sections/segments arrays straight into TimingList columns, one
+# np.array() per field, and only walks the entries one by one to report errors when that conversion fails.
+# Raises ValidationError with messages shaped like marshmallow's.
+def decode_analysis(data) -> Analysis:
+    if data is None:
+        return Analysis()
+    if not isinstance(data, dict):
+        raise ValidationError({'_schema': ['Invalid input type.']})
+
+    values = {}
+    errors = {}
+    for name in ANALYSIS_FIELDS:
+        value = data.get(name)
+        if value is not None:
+            try:
+                values[name] = float(value)
+            except (TypeError, ValueError):
+                errors[name] = ['Not a valid number.']
+    for name, item_type in (('sections', Section), ('segments', Segment)):
+        try:
+            values[name] = decode_timings(data.get(name), item_type)
+        except ValidationError as e:
+            errors[name] = e.messages
+    if errors:
+        raise ValidationError(errors)
+    return Analysis(**values)
+
+
+def decode_timings(items, item_type) -> TimingList:
+    if items is None:
+        items = []
+    if not isinstance(items, list):
+        raise ValidationError(['Not a valid list.'])
+
+    try:
+        columns = {}
+        for name in item_type.fields:
+            if name in REQUIRED_TIMING_FIELDS:
+                column = [item[name] for item in items]
+            else:
+                column = [item.get(name, np.nan) for item in items]
+            columns[name] = np.array(column, dtype=item_type.column_dtype(name))
+        for name in item_type.matrix_fields:
+            width = getattr(item_type, name).width
+            missing = [np.nan] * width
+            matrix = np.array([item.get(name, missing) for item in items], dtype=np.float32)
+            columns[name] = matrix.reshape(len(items), width)
+    except (TypeError, ValueError, KeyError, AttributeError):
+        raise ValidationError(timing_errors(items, item_type))
+
+    for name in REQUIRED_TIMING_FIELDS:
+        if not np.isfinite(columns[name]).all():
+            raise ValidationError(timing_errors(items, item_type))
+
+    starts = columns['start']
+    if len(starts) > 1 and (starts[1:] < starts[:-1]).any():
+        order = np.argsort(starts, kind='stable')
+        columns = {name: column[order] for name, column in columns.items()}
+
+    return TimingList(item_type=item_type, columns=columns)
+
+
+def timing_errors(items, item_type):
+    # slow path, only used to say which entries are bad
+    errors = {}
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors[i] = {'_schema': ['Invalid input type.']}
+            continue
+        item_errors = {}
+        for name in item_type.fields:
+            if item.get(name) is None:
+                if name in REQUIRED_TIMING_FIELDS:
+                    item_errors[name] = ['Missing data for required field.']
+                continue
+            try:
+                value = float(item[name])
+            except (TypeError, ValueError):
+                item_errors[name] = ['Not a valid number.']
+                continue
+            if not np.isfinite(value):
+                item_errors[name] = ['Special numeric values (nan or infinity) are not permitted.']
+        for name in item_type.matrix_fields:
+            if name not in item:
+                continue
+            width = getattr(item_type, name).width
+            try:
+                if len(np.array(item[name], dtype=np.float32).reshape(-1)) != width:
+                    item_errors[name] = [f'Expected {width} values.']
+            except (TypeError, ValueError):
+                item_errors[name] = ['Not a valid list of numbers.']
+        if item_errors:
+            errors[i] = item_errors
+    return errors or {'_schema': ['Invalid input.']}
@@ -1,11 +1,19 @@
 import logging
 import random
+import time
 
 from sacn import sACNsender
 from sacn.sending.output_thread import OutputThread, DEFAULT_PORT
 
 
 class PatchedOutputThread(OutputThread):
+    last_tick = None
+
+    def send_out(self, output):
+        super().send_out(output)
+        # perf_counter, so the render loop can line its frames up with the sends
+        self.last_tick = time.perf_counter()
+
     def send_packet(self, packet, destination: str):
         MESSAGE = bytearray(packet.getBytes())
         try:
@@ -38,3 +46,7 @@ class PatchedsACNSender(sACNsender):
                                                   bind_port=bind_port, fps=fps,
                                                   universe_discovery=self._universeDiscovery)
         self._output_thread.start()
+
+    def tick(self):
+        thread = self._output_thread
+        return thread.last_tick if thread is not None else None
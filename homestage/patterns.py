@@ -1,18 +1,33 @@
 import math
 import random
 import time
-from colorsys import hsv_to_rgb
 from typing import List, Tuple
 
 import numpy as np
 
+from homestage.color import HueTable, hsv_to_rgb, hue_to_rgb, paint
+from homestage.mixer import Mixer
+from homestage.rig import RigFixture
 
-def cycle(f):
-    return (math.sin(time.time() / math.pi * 2 * f) + 1) / 2
+HUES = HueTable(16)
 
 
+def cycle(f, t=None):
+    # f may be an array to get one phase per fixture; old-style patterns leave out t and get the wall clock
+    if t is None:
+        t = time.time()
+    return (np.sin(t / math.pi * 2 * f) + 1) / 2
+
+
+def beat_advanced(beat, last_beat) -> bool:
+    # the predicted beat index can step back when the tracker corrects its phase, so only a later beat counts
+    return beat is not None and (last_beat is None or beat > last_beat)
+
+
+# Patterns render the whole stage at once: update() gets the Rig and assigns its attribute arrays, and reads time,
+# audio and beat information from the FrameContext rather than the clock or the live audio state.
 class Pattern:
-    def update(self, fixtures):
+    def update(self, rig, frame):
         return False
 
     def on_media_change(self, media):
@@ -38,8 +53,23 @@ class DelegatePattern:
     def on_segment_change(self, segment):
         self.delegate.on_segment_change(segment)
 
-    def update(self, fixtures):
-        self.delegate.update(fixtures)
+    def update(self, rig, frame):
+        self.delegate.update(rig, frame)
+
+
+# Runs an old-style pattern whose update() loops over the fixtures itself. It gets stand-ins that write the rig it
+# is rendered into rather than the universe, so it can be blended as a mixer layer like any other pattern.
+class FixturePattern(DelegatePattern):
+    def __init__(self, delegate):
+        super().__init__(delegate)
+        self.rig = None
+        self.fixtures = []
+
+    def update(self, rig, frame):
+        if rig is not self.rig:
+            self.rig = rig
+            self.fixtures = [RigFixture(rig, i) for i in range(rig.count)]
+        return self.delegate.update(self.fixtures)
 
 
 class RainbowRoundabout(Pattern):
@@ -47,34 +77,31 @@ class RainbowRoundabout(Pattern):
         self.state = state
         self.control = control
         self.index = 0
-        self.last_beat = time.time()
+        self.last_beat = 0
         self.tempo_beat = 0
         self.factor = factor
 
     def on_segment_change(self, segment):
         self.index += 0.2 * math.log(segment.duration * 10)
 
-    def update(self, fixtures):
-        now = time.time()
-        color = hsv_to_rgb(math.sin(self.index * self.factor) / 2 + 0.5, 1, 1)
-
-        for i, fixture in enumerate(fixtures):
-            active = True
-            fixture.pan = int((cycle(4 * (1 if i % 2 else -1)) / 6 + 2 / 6) * (2 / 3 * 255))
-            fixture.tilt = int((cycle(2) / 8 + 5 / 8) * 255)
-            fixture.r = int(255 * color[0])
-            fixture.g = int(255 * color[1])
-            fixture.b = int(255 * color[2])
-            fixture.level = int(134)
-            fixture.level = min(134, int(134 * np.average(self.state.spectrum_adjusted[:2]))) if active else 0
-            fixture.brightness = int(255 * np.average(self.state.spectrum_adjusted[:2])) if active else 0
-            fixture.motor1 = int((math.sin(time.time() / 0.7) * 255 / 2 + 255 / 2))
-            fixture.motor2 = int((math.sin(time.time() / 0.7) * 255 / 2 + 255 / 2))
+    def update(self, rig, frame):
+        now = frame.time
+        color = hue_to_rgb(math.sin(self.index * self.factor) / 2 + 0.5)
+        level = np.average(frame.spectrum[:2])
+        motor = math.sin(now / 0.7) * 255 / 2 + 255 / 2
+
+        rig.pan = (cycle(4 * rig.alternate, frame.time) / 6 + 2 / 6) * (2 / 3 * 255)
+        rig.tilt = (cycle(2, frame.time) / 8 + 5 / 8) * 255
+        paint(rig, color)
+        rig.level = min(134, 134 * level)
+        rig.brightness = 255 * level
+        rig.motor1 = motor
+        rig.motor2 = motor
 
         self.index += 0.01
 
-        if self.state.current_tempo and (now - self.last_beat) > 1 / self.state.current_tempo:
-            self.tempo_beat += 1 / len(fixtures) / 8
+        if rig.count and frame.tempo and (now - self.last_beat) > 1 / frame.tempo:
+            self.tempo_beat += 1 / rig.count / 8
             self.last_beat = now
 
         return False
@@ -89,20 +116,18 @@ class RainbowCycle(Pattern):
     def on_segment_change(self, segment):
         self.index += 0.2 * math.log(segment.duration * 10)
 
-    def update(self, fixtures):
-        for i, fixture in enumerate(fixtures):
-            color = hsv_to_rgb(math.sin(self.index + (i / len(fixtures) * 3)) / 2 + 0.5, 1, 1)
-            fixture.pan = int((cycle(4) / 6 + 2 / 6) * (2 / 3 * 255))
-            # fixture.tilt = int((cycle(2) / 8 + 7 / 8) * 255)
-            fixture.tilt = int((cycle(2) / 8 + 5 / 8) * 255)
-            fixture.r = int(255 * color[0])
-            fixture.g = int(255 * color[1])
-            fixture.b = int(255 * color[2])
-            fixture.level = int(134)
-            fixture.level = max(0, min(134, int(134 * self.state.spectrum_adjusted[1])))
-            fixture.brightness = max(0, min(255, int(255 * self.state.spectrum_adjusted[1])))
-            fixture.motor1 = int((math.sin(time.time() / 0.7) * 255 / 2 + 255 / 2))
-            fixture.motor2 = int((math.sin(time.time() / 0.7) * 255 / 2 + 255 / 2))
+    def update(self, rig, frame):
+        colors = HUES.lookup(np.sin(self.index + (rig.index / max(rig.count, 1) * 3)) / 2 + 0.5)
+        motor = math.sin(frame.time / 0.7) * 255 / 2 + 255 / 2
+
+        rig.pan = (cycle(4, frame.time) / 6 + 2 / 6) * (2 / 3 * 255)
+        # rig.tilt = (cycle(2, frame.time) / 8 + 7 / 8) * 255
+        rig.tilt = (cycle(2, frame.time) / 8 + 5 / 8) * 255
+        paint(rig, colors, 1)
+        rig.level = max(0, min(134, 134 * frame.spectrum[1]))
+        rig.brightness = max(0, min(255, 255 * frame.spectrum[1]))
+        rig.motor1 = motor
+        rig.motor2 = motor
 
         self.index += 0.01
         return False
@@ -115,31 +140,28 @@ class BloodPumper(Pattern):
         self.fixture_index = 0
         self.last_interval = 0
 
-    def update(self, fixtures):
-        now = time.time()
+    def update(self, rig, frame):
+        now = frame.time
         factor = 10 if self.control.lb else 20
-        if now - self.last_interval > factor / (self.state.current_tempo or 100):
+        if now - self.last_interval > factor / (frame.tempo or 100):
             self.last_interval = now
             self.fixture_index += 1
-            if self.fixture_index >= len(fixtures):
+            if self.fixture_index >= rig.count:
                 self.fixture_index = 0
-            target = fixtures[self.fixture_index]
-            for fixture in fixtures:
-                color = (1, 1, 1) if target == fixture else (0, 0, 0)
-                fixture.pan = int((cycle(4) / 3 + 1 / 3) * (2 / 3 * 255))
-                fixture.tilt = int((cycle(2) / 3 + 1 / 3) * 255)
-                fixture.r = int(255 * color[0])
-                fixture.g = int(255 * color[1])
-                fixture.b = int(255 * color[2])
-                fixture.level = int(134)
-                fixture.brightness = 255
+            target = (rig.index == self.fixture_index) * 255
+            rig.pan = (cycle(4, frame.time) / 3 + 1 / 3) * (2 / 3 * 255)
+            rig.tilt = (cycle(2, frame.time) / 3 + 1 / 3) * 255
+            paint(rig, np.broadcast_to(target, (3, rig.count)), 1)
+            rig.level = 134
+            rig.brightness = 255
 
         return False
 
 
+# Switching patterns crossfades through a Mixer, which is the delegate
 class PatternList(DelegatePattern):
-    def __init__(self, state, control, patterns: List[Tuple[str, Pattern]]):
-        super().__init__(patterns[0][1])
+    def __init__(self, state, control, patterns: List[Tuple[str, Pattern]], fade_time=1.0, fade_curve='smooth'):
+        super().__init__(Mixer(patterns[0][1], fade_time, fade_curve))
         self.name = patterns[0][0]
         self.patterns = patterns
         self.pattern_index = 0
@@ -151,37 +173,46 @@ class PatternList(DelegatePattern):
             self.pattern_index = 0
         else:
             self.pattern_index += 1
-        self.delegate = self.patterns[self.pattern_index][1]
+        self.delegate.crossfade(self.patterns[self.pattern_index][1])
         self.name = self.patterns[self.pattern_index][0]
 
+    def select(self, name, fade_time=None):
+        for index, (pattern_name, pattern) in enumerate(self.patterns):
+            if pattern_name == name:
+                self.pattern_index = index
+                self.delegate.crossfade(pattern, fade_time)
+                self.name = pattern_name
+                return
+        raise KeyError(name)
+
 
 class ControllablePattern(DelegatePattern):
-    def __init__(self, state, control):
-        super().__init__(RainbowRoundabout(state, control))
+    def __init__(self, state, control, fade_time=1.0, fade_curve='smooth'):
+        super().__init__(Mixer(RainbowRoundabout(state, control), fade_time, fade_curve))
         self.delegate_enabled = True
         self.state = state
         self.control = control
         self.pan = 0
         self.tilt = 0
-        self.rgb = [255, 255, 255]
+        self.rgb = np.full(3, 255.0)
 
-    def update(self, fixtures):
+    def update(self, rig, frame):
         if self.control.square:
             self.delegate_enabled = True
-            if not isinstance(self.delegate, RainbowRoundabout):
-                self.delegate = RainbowRoundabout(self.state, self.control)
+            if not isinstance(self.delegate.pattern, RainbowRoundabout):
+                self.delegate.crossfade(RainbowRoundabout(self.state, self.control))
         elif self.control.circle:
             self.delegate_enabled = True
-            if not isinstance(self.delegate, BloodPumper):
-                self.delegate = BloodPumper(self.state, self.control)
+            if not isinstance(self.delegate.pattern, BloodPumper):
+                self.delegate.crossfade(BloodPumper(self.state, self.control))
         elif self.control.cross:
             self.delegate_enabled = True
-            if not isinstance(self.delegate, RainbowCycle):
-                self.delegate = RainbowCycle(self.state, self.control)
+            if not isinstance(self.delegate.pattern, RainbowCycle):
+                self.delegate.crossfade(RainbowCycle(self.state, self.control))
         elif self.control.triangle:
             self.delegate_enabled = False
 
-        super().update(fixtures)
+        super().update(rig, frame)
 
         if not self.delegate_enabled:
             if self.control.lb:
@@ -193,7 +224,7 @@ class ControllablePattern(DelegatePattern):
                     v = 0
                 else:
                     v = (v - 0.1) / (1 - 0.1)
-                self.rgb = [int(255 * n) for n in hsv_to_rgb(h, 1, min(1, v))]
+                self.rgb = 255 * hsv_to_rgb(h, 1, min(1, v))
 
             if self.control.rb:
                 x1 = self.control.axis1[1]
@@ -207,74 +238,69 @@ class ControllablePattern(DelegatePattern):
                     tilt = (tilt - 0.1) / (1 - 0.1)
                 self.tilt = int((1 - min(1, tilt)) * 0.5 * 255)
 
-            for fixture in fixtures:
-                fixture.pan = self.pan
-                fixture.tilt = self.tilt
-                fixture.r = self.rgb[0]
-                fixture.g = self.rgb[1]
-                fixture.b = self.rgb[2]
-                fixture.level = int(134)
-                fixture.brightness = int(255)
+            rig.pan = self.pan
+            rig.tilt = self.tilt
+            paint(rig, self.rgb, 1)
+            rig.level = 134
+            rig.brightness = 255
+
+
+# seconds before a section change over which DualToneResponseFastSweep dims, so the new section lands bright
+SECTION_LEAD = 2.0
 
 
 class DualToneResponseFastSweep(Pattern):
     def __init__(self, state, colors):
         self.state = state
-        self.last_pulse = 0
+        self.last_beat = None
         self.colors = colors
         self.color = self.colors[0]
         self.color_index = 0
 
-    def update(self, fixtures):
-        now = time.time()
-        tempo = self.state.current_tempo
+    def update(self, rig, frame):
+        beat = frame.beat_index
 
-        if tempo > 0 and (now - self.last_pulse > 60 / (tempo * 1)):
-            self.last_pulse = now
+        if beat_advanced(beat, self.last_beat):
+            self.last_beat = beat
             self.color = self.colors[self.color_index]
             self.color_index += 1
             if self.color_index >= len(self.colors):
                 self.color_index = 0
 
-        for i, fixture in enumerate(fixtures):
-            fixture.pan = int((cycle(4 * (1 if i % 2 else -1)) / 6 + 2 / 6) * (2 / 3 * 255))
-            fixture.tilt = int((cycle(2) / 8 + 5 / 8) * 255)
-            fixture.r = int(255 * self.color[0])
-            fixture.g = int(255 * self.color[1])
-            fixture.b = int(255 * self.color[2])
-            fixture.level = int(134)
-            fixture.brightness = int(255)
+        rig.pan = (cycle(4 * rig.alternate, frame.time) / 6 + 2 / 6) * (2 / 3 * 255)
+        rig.tilt = (cycle(2, frame.time) / 8 + 5 / 8) * 255
+        paint(rig, self.color)
+        rig.level = 134
+        lead = frame.next_section
+        rig.brightness = 255 if lead is None or lead >= SECTION_LEAD else 255 * (0.25 + 0.75 * lead / SECTION_LEAD)
 
         return False
 
 
 class GrayResponseFastSweep(DualToneResponseFastSweep):
     def __init__(self, state):
-        super().__init__(state, [hsv_to_rgb(random.random(), 1, 1), hsv_to_rgb(random.random(), 1, 1)])
+        super().__init__(state, [hue_to_rgb(random.random()), hue_to_rgb(random.random())])
         self.state = state
-        self.last_pulse = 0
-        self.color = hsv_to_rgb(math.sin(time.time() * 5) * 0.5 + 0.5, 1, 1)
+        self.last_beat = None
+        self.color = hue_to_rgb(math.sin(time.time() * 5) * 0.5 + 0.5)
         self.color_index = 0
 
-    def update(self, fixtures):
-        now = time.time()
-        tempo = self.state.current_tempo
+    def update(self, rig, frame):
+        beat = frame.beat_index
 
-        if tempo > 0 and (self.state.beat or now - self.last_pulse > 60 / (tempo * 1)):
-            self.last_pulse = now
+        if beat_advanced(beat, self.last_beat):
+            self.last_beat = beat
             self.color = self.colors[self.color_index]
             self.color_index += 1
             if self.color_index >= len(self.colors):
                 self.color_index = 0
 
-        for fixture in fixtures:
-            fixture.pan = int((math.sin(time.time() / 1) * 255 / 2 + 255 / 2))
-            fixture.tilt = int((math.sin(time.time() / 1) * 255 / 2 + 255 / 2))
-            fixture.r = int(255 * self.color[0])
-            fixture.g = int(255 * self.color[1])
-            fixture.b = int(255 * self.color[2])
-            fixture.level = int(134)
-            fixture.brightness = int(255)
+        sweep = math.sin(frame.time / 1) * 255 / 2 + 255 / 2
+        rig.pan = sweep
+        rig.tilt = sweep
+        paint(rig, self.color)
+        rig.level = 134
+        rig.brightness = 255
 
         return False
 
@@ -282,27 +308,24 @@ class GrayResponseFastSweep(DualToneResponseFastSweep):
 class RainbowSweep(Pattern):
     def __init__(self, state):
         self.state = state
-        self.last_pulse = 0
+        self.last_beat = None
         self.index = 0
 
-    def update(self, fixtures):
-        now = time.time()
-        tempo = self.state.current_tempo
+    def update(self, rig, frame):
+        beat = frame.beat_index
 
-        if tempo > 0 and (self.state.beat or now - self.last_pulse > 60 / (tempo * 1)):
-            self.last_pulse = now
+        if beat_advanced(beat, self.last_beat):
+            self.last_beat = beat
             self.index += random.random() * 0.2 + 0.4
 
-        color = hsv_to_rgb(math.sin(self.index) / 2 + 0.5, 1, 1)
+        color = hue_to_rgb(math.sin(self.index) / 2 + 0.5)
 
-        for fixture in fixtures:
-            fixture.pan = int((math.sin(time.time() / 1) * 255 / 2 + 255 / 2))
-            fixture.tilt = int((math.sin(time.time() / 1) * 255 / 2 + 255 / 2))
-            fixture.r = int(255 * color[0])
-            fixture.g = int(255 * color[1])
-            fixture.b = int(255 * color[2])
-            fixture.level = int(134)
-            fixture.brightness = int(255)
+        sweep = math.sin(frame.time / 1) * 255 / 2 + 255 / 2
+        rig.pan = sweep
+        rig.tilt = sweep
+        paint(rig, color)
+        rig.level = 134
+        rig.brightness = 255
 
         return False
 
@@ -310,29 +333,25 @@ class RainbowSweep(Pattern):
 class MellowSweep(Pattern):
     def __init__(self, state):
         self.state = state
-        self.last_pulse = 0
-        self.color = hsv_to_rgb(math.sin(time.time() * 5) * 0.5 + 0.5, 1, 1)
-        self.colors = [hsv_to_rgb(random.random(), 1, 1), hsv_to_rgb(random.random(), 1, 1)]
+        self.last_beat = None
+        self.color = hue_to_rgb(math.sin(time.time() * 5) * 0.5 + 0.5)
+        self.colors = [hue_to_rgb(random.random()), hue_to_rgb(random.random())]
         self.color_index = 0
 
-    def update(self, fixtures):
-        now = time.time()
-        tempo = self.state.current_tempo
+    def update(self, rig, frame):
+        beat = frame.beat_index
 
-        if tempo > 0 and (self.state.beat or now - self.last_pulse > 60 / (tempo * 1)):
-            self.last_pulse = now
+        if beat_advanced(beat, self.last_beat):
+            self.last_beat = beat
             self.color = self.colors[self.color_index]
             self.color_index += 1
             if self.color_index >= len(self.colors):
                 self.color_index = 0
 
-        for fixture in fixtures:
-            fixture.pan = int(time.time() * 25 % 255)
-            fixture.tilt = 20
-            fixture.r = int(255 * self.color[0])
-            fixture.g = int(255 * self.color[1])
-            fixture.b = int(255 * self.color[2])
-            fixture.level = int(134)
-            fixture.brightness = int(255)
+        rig.pan = frame.time * 25 % 255
+        rig.tilt = 20
+        paint(rig, self.color)
+        rig.level = 134
+        rig.brightness = 255
 
         return False
@@ -0,0 +1,322 @@
+import logging
+import math
+import multiprocessing
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from homestage.audio import BeatTracker
+from homestage.backends import NullBackend
+from homestage.controller import AudioState, ControlState, HomeStage, PatternController, StageConfig
+from homestage.frame import FrameContext, Histogram
+from homestage.model import Media
+from homestage.shm import SeqlockBuffer, audio_snapshot_dtype, frame_snapshot_dtype, CONTROL_SNAPSHOT_DTYPE
+from homestage.universe import UNIVERSE_SIZE, Universe
+
+logger = logging.getLogger(__name__)
+
+AUDIO_STATS = ('blocks', 'overruns', 'skipped', 'queue_depth', 'max_queue_depth', 'latency', 'max_latency',
+               'analysis_load')
+
+
+# AudioState that publishes a snapshot of its analysis after every block it processes
+class PublishingAudioState(AudioState):
+    def __init__(self, snapshot: SeqlockBuffer, config: StageConfig, **kwargs):
+        super().__init__(config, **kwargs)
+        self.snapshot = snapshot
+
+    def process(self, signal: np.ndarray, timestamp: float, measure_latency: bool = True):
+        super().process(signal, timestamp, measure_latency)
+        tracker = self.beat_tracker
+        stats = self.stats()
+        with self.snapshot.writing() as record:
+            record['spectrum'] = self.spectrum_adjusted
+            record['beat'] = self.beat
+            record['tempo'] = self.current_tempo
+            record['beat_period'] = tracker.period
+            record['beat_reference'] = math.nan if tracker.reference is None else tracker.reference
+            for key in AUDIO_STATS:
+                record[key] = stats[key]
+
+
+# Stands in for AudioState in the processes that only read the analysis. refresh() copies the latest snapshot
+# into the same attributes AudioState has, beat tracker included, so frames are built from it unchanged.
+class SharedAudioState:
+    def __init__(self, snapshot: SeqlockBuffer, latency_offset: float = 0.0):
+        self.snapshot = snapshot
+        self.media = Media()
+        self.record = np.zeros((), dtype=snapshot.dtype)
+        self.spectrum_adjusted = np.zeros(snapshot.dtype['spectrum'].shape)
+        self.beat = False
+        self.current_tempo = 0.0
+        self.beat_tracker = BeatTracker(latency=latency_offset)
+        self.enabled = False
+
+    def start(self):
+        pass
+
+    def refresh(self):
+        record = self.snapshot.read(self.record)
+        self.spectrum_adjusted[:] = record['spectrum']
+        self.beat = bool(record['beat'])
+        self.current_tempo = float(record['tempo'])
+        reference = float(record['beat_reference'])
+        self.beat_tracker.period = float(record['beat_period'])
+        self.beat_tracker.reference = None if math.isnan(reference) else reference
+        return self
+
+    def reset(self, media: Media):
+        self.media = media
+
+    def stats(self):
+        self.refresh()
+        return {key: self.record[key].item() for key in AUDIO_STATS}
+
+
+# ControlState backed by a shared record: the web server's process writes it, the render process refreshes it
+class SharedControlState(ControlState):
+    def __init__(self, snapshot: SeqlockBuffer, writer: bool = False):
+        object.__setattr__(self, 'snapshot', snapshot)
+        object.__setattr__(self, 'writer', writer)
+        # socket handlers run on several threads, but a seqlock takes one writer at a time
+        object.__setattr__(self, 'lock', threading.Lock())
+        super().__init__()
+
+    def __setattr__(self, key, value):
+        object.__setattr__(self, key, value)
+        if self.writer:
+            with self.lock:
+                self.snapshot.write(**{key: value})
+
+    def refresh(self):
+        record = self.snapshot.read()
+        for key in CONTROL_SNAPSHOT_DTYPE.names:
+            value = record[key]
+            object.__setattr__(self, key, value.tolist() if value.ndim else value.item())
+
+
+# Stands in for the output in the render process. Frames go back to the main process through the frame snapshot;
+# tick() reports the real output's last send, which the main process keeps up to date in shared memory, so the
+# render scheduler can still phase-lock to it.
+class ForwardingBackend(NullBackend):
+    def __init__(self, shared_tick):
+        super().__init__()
+        self.shared_tick = shared_tick
+
+    def tick(self) -> Optional[float]:
+        tick = self.shared_tick.value
+        return None if math.isnan(tick) else tick
+
+
+# HomeStage in the render process: picks up the latest audio and control snapshots before each frame and publishes
+# the finished universe, signalling frame_ready for the main process, while commands from the main process are
+# applied by a thread of their own.
+class RenderStage(HomeStage):
+    def __init__(self, config: StageConfig, frames: SeqlockBuffer, commands, state: SharedAudioState,
+                 control: SharedControlState, frame_ready, shared_tick):
+        super().__init__(config, config.fixtures, ForwardingBackend(shared_tick), state=state, control=control)
+        self.frame_snapshot = frames
+        self.frame_ready = frame_ready
+        self.commands = commands
+
+    def start(self):
+        threading.Thread(target=self._listen, daemon=True).start()
+        super().start()
+
+    def _listen(self):
+        while True:
+            command, value = self.commands.get()
+            if command == 'enabled':
+                self.enabled = value
+            elif command == 'media':
+                self.load_media(value)
+            elif command == 'position':
+                self.sync_media(value)
+            elif command == 'next_pattern':
+                self.next_pattern()
+
+    def render(self) -> FrameContext:
+        self.state.refresh()
+        self.control.refresh()
+        start = time.perf_counter()
+        frame = super().render()
+        render_time = time.perf_counter() - start
+        with self.frame_snapshot.writing() as record:
+            record['index'] = frame.index
+            record['time'] = frame.time
+            record['render_time'] = render_time
+            record['pattern'] = self.controller.pattern.pattern_index
+            record['dropped'] = self.scheduler.dropped
+            record['sends'] = self.universe.sends
+            record['frame_times'] = self.scheduler.frame_times.counts
+            record['jitter'] = self.scheduler.jitter.counts
+            record['data'] = self.universe.data
+        self.frame_ready.set()
+        return frame
+
+
+def run_audio(config_path: str, snapshot_name: str, commands):
+    config = StageConfig(config_path)
+    config.load()
+    snapshot = SeqlockBuffer(audio_snapshot_dtype(config.audio_band_count), snapshot_name)
+    state = PublishingAudioState(snapshot, config, sample_rate=config.audio_sample_rate,
+                                 band_count=config.audio_band_count, band_layout=config.audio_band_layout,
+                                 window=config.audio_window, latency_offset=config.audio_latency_offset)
+    state.start()
+    while True:
+        command, value = commands.get()
+        if command == 'enabled':
+            state.enabled = value
+        elif command == 'microphone':
+            config.microphone = value
+
+
+def run_render(config_path: str, audio_name: str, control_name: str, frame_name: str, commands, frame_ready,
+               shared_tick):
+    config = StageConfig(config_path)
+    config.load()
+    state = SharedAudioState(SeqlockBuffer(audio_snapshot_dtype(config.audio_band_count), audio_name),
+                             config.audio_latency_offset)
+    control = SharedControlState(SeqlockBuffer(CONTROL_SNAPSHOT_DTYPE, control_name))
+    frames = SeqlockBuffer(frame_snapshot_dtype(len(config.universes), UNIVERSE_SIZE), frame_name)
+    RenderStage(config, frames, commands, state, control, frame_ready, shared_tick).start()
+
+
+# Drop-in for HomeStage that runs audio analysis and pattern rendering in processes of their own, so neither
+# competes with the web server for the GIL. They exchange snapshots through shared memory; this process keeps the
+# web server and the output backend, forwarding each finished frame to it as it's published.
+class MultiProcessStage:
+    def __init__(self, config: StageConfig, output):
+        self.config = config
+        self.output = output
+        self.audio_snapshot = SeqlockBuffer(audio_snapshot_dtype(config.audio_band_count), create=True)
+        self.control_snapshot = SeqlockBuffer(CONTROL_SNAPSHOT_DTYPE, create=True)
+        self.frame_snapshot = SeqlockBuffer(frame_snapshot_dtype(len(config.universes), UNIVERSE_SIZE), create=True)
+        # same layout as the render process's buffer, to forward universes out of
+        self.universe = Universe(config.universes)
+        self._state = SharedAudioState(self.audio_snapshot, config.audio_latency_offset)
+        self.control = SharedControlState(self.control_snapshot, writer=True)
+        self.frame = np.zeros((), dtype=self.frame_snapshot.dtype)
+        # only used for the pattern names, the patterns themselves run in the render process
+        self.pattern_names = [name for name, _ in PatternController(self._state, self.control).pattern.patterns]
+
+        context = multiprocessing.get_context('spawn')
+        self.audio_commands = context.Queue()
+        self.render_commands = context.Queue()
+        self.frame_ready = context.Event()
+        # the output's last send, for the render process to lock its frames to; NaN until there is one
+        self.shared_tick = context.Value('d', math.nan, lock=False)
+        self.audio_process = context.Process(
+            target=run_audio, name='homestage-audio', daemon=True,
+            args=(config.path, self.audio_snapshot.name, self.audio_commands))
+        self.render_process = context.Process(
+            target=run_render, name='homestage-render', daemon=True,
+            args=(config.path, self.audio_snapshot.name, self.control_snapshot.name, self.frame_snapshot.name,
+                  self.render_commands, self.frame_ready, self.shared_tick))
+        self.lock = threading.RLock()
+        self._enabled = False
+
+    def start(self):
+        self.audio_process.start()
+        self.render_process.start()
+        self.enabled = True
+        threading.Thread(target=self._forward, daemon=True).start()
+
+    def stop(self):
+        self.enabled = False
+        for process in (self.audio_process, self.render_process):
+            process.terminate()
+            process.join()
+        for snapshot in (self.audio_snapshot, self.control_snapshot, self.frame_snapshot):
+            snapshot.close()
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, enabled):
+        with self.lock:
+            if enabled == self._enabled:
+                return
+            logger.info("Output enabled" if enabled else "Output disabled")
+            self._enabled = enabled
+            self.audio_commands.put(('enabled', enabled))
+            self.render_commands.put(('enabled', enabled))
+            if enabled:
+                self.output.start()
+            else:
+                self.output.stop()
+
+    @property
+    def state(self) -> SharedAudioState:
+        return self._state.refresh()
+
+    @property
+    def pattern_name(self) -> Optional[str]:
+        self.frame_snapshot.read(self.frame)
+        return self.pattern_names[int(self.frame['pattern'])]
+
+    def next_pattern(self):
+        self.render_commands.put(('next_pattern', None))
+
+    def load_media(self, media: Media):
+        self._state.reset(media)
+        self.render_commands.put(('media', media))
+
+    def sync_media(self, start_datetime):
+        self._state.media.start_datetime = start_datetime
+        self.render_commands.put(('position', start_datetime))
+
+    def set_microphone(self, microphone):
+        self.config.microphone = microphone
+        self.config.save()
+        self.audio_commands.put(('microphone', microphone))
+
+    def stats(self):
+        # the render process only shares the histogram counts, so means and maxima aren't available here
+        frame = self.frame_snapshot.read(self.frame)
+
+        def summary(counts):
+            histogram = Histogram()
+            histogram.counts[:] = counts
+            return {key: value for key, value in histogram.summary().items() if key not in ('mean', 'max')}
+
+        return {
+            'audio': self._state.stats(),
+            'frames': {
+                'fps': self.config.render_fps,
+                'frames': int(frame['index']) + 1,
+                'dropped': int(frame['dropped']),
+                'sends': int(frame['sends'].sum()),
+                'render_time': float(frame['render_time']),
+                'frame_time': summary(frame['frame_times']),
+                'jitter': summary(frame['jitter']),
+            },
+            'sender': self.output.stats(),
+            'snapshot_retries': self.frame_snapshot.retries + self.audio_snapshot.retries,
+        }
+
+    def _forward(self):
+        # hand the backend every frame the render process decided to send, sleeping until it publishes one, and pass
+        # the backend's tick back to it
+        version = -1
+        sends = np.zeros(len(self.universe.numbers), dtype=np.int64)
+        while True:
+            if not self.frame_ready.wait(timeout=1):
+                continue
+            # cleared before reading, so a frame published from here on sets it again
+            self.frame_ready.clear()
+            tick = self.output.tick()
+            if tick is not None:
+                self.shared_tick.value = tick
+            if self.frame_snapshot.version != version:
+                version = self.frame_snapshot.version
+                self.frame_snapshot.read(self.frame)
+                updated = np.flatnonzero(self.frame['sends'] != sends)
+                if len(updated):
+                    sends[:] = self.frame['sends']
+                    self.universe.data[:] = self.frame['data']
+                    self.output.send(self.universe, [self.universe.numbers[i] for i in updated])
@@ -0,0 +1,308 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+from typing import Optional
+
+import numpy as np
+
+from homestage.universe import Universe
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HSSHOW\x00\x00'
+VERSION = 1
+
+# magic, version, universe count, universe size, keyframe interval, fps, first slot, frame count, index offset,
+# URI length; then the universe numbers, the URI, the frames and finally the index of frame offsets
+HEADER = struct.Struct('<8sHHHHdqIQH')
+
+KEYFRAME = 0
+DELTA = 1
+FRAME_HEADER = struct.Struct('<BI')
+RUN_DTYPE = np.dtype([('start', '<u4'), ('length', '<u4')])
+
+# changed bytes closer together than this share a run, which is cheaper than a run header of their own
+MERGE_GAP = 8
+
+# index entry for a slot with no frame; no frame can start at offset 0, where the header is
+GAP = 0
+
+# slots skipped by dropped render frames are filled with the frame before them, up to this many; a longer jump is
+# a seek, and the slots it skips are left as a gap
+MAX_REPEAT = 2
+
+
+def run_positions(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    # buffer index of every byte covered by the runs, in run order
+    lengths = lengths.astype(np.intp)
+    payload_starts = np.cumsum(lengths) - lengths
+    return np.repeat(starts.astype(np.intp) - payload_starts, lengths) + np.arange(int(lengths.sum()))
+
+
+def encode_delta(previous: np.ndarray, current: np.ndarray):
+    # (runs, payload) holding the bytes of current that differ from previous
+    changed = np.flatnonzero(previous != current)
+    if not len(changed):
+        return np.zeros(0, dtype=RUN_DTYPE), current[:0]
+    breaks = np.flatnonzero(np.diff(changed) > MERGE_GAP)
+    runs = np.empty(len(breaks) + 1, dtype=RUN_DTYPE)
+    runs['start'] = changed[np.r_[0, breaks + 1]]
+    runs['length'] = changed[np.r_[breaks, len(changed) - 1]] + 1 - runs['start']
+    return runs, current[run_positions(runs['start'], runs['length'])]
+
+
+def slot_at(position: float, fps: float) -> int:
+    return int(round(position * fps))
+
+
+# Writes the output universes of a show, one frame per 1/fps of media position. Each frame is stored as the runs
+# of bytes that changed since the one before, with a whole keyframe every keyframe_interval frames so a reader
+# can start anywhere after decoding at most that many. The first frame after a gap is always a keyframe, so decoding
+# can step over gaps. Writes go to a temporary file that only replaces path once close() has written the index, so
+# an interrupted recording never leaves a file that looks complete.
+class ShowRecorder:
+    def __init__(self, path: str, uri: str, universe: Universe, fps: float = 60.0, keyframe_interval: int = 120):
+        self.path = path
+        self.uri = uri
+        self.numbers = list(universe.numbers)
+        self.size = universe.size
+        self.fps = fps
+        self.keyframe_interval = keyframe_interval
+        self.first_slot = None
+        self.last_slot = None
+        self.offsets = []
+        self.previous = np.zeros(len(universe.data), dtype=np.uint8)
+        self.after_gap = False
+        self.bytes_written = 0
+        self._temp_path = f'{path}.partial'
+        self._file = open(self._temp_path, 'wb', buffering=1 << 20)
+        self._uri = uri.encode('utf-8')
+        self._write_header()
+
+    @property
+    def frames(self) -> int:
+        return len(self.offsets)
+
+    def _write_header(self, index_offset: int = 0):
+        self._file.write(HEADER.pack(MAGIC, VERSION, len(self.numbers), self.size, self.keyframe_interval, self.fps,
+                                     self.first_slot or 0, len(self.offsets), index_offset, len(self._uri)))
+        self._file.write(np.array(self.numbers, dtype='<u2').tobytes())
+        self._file.write(self._uri)
+
+    def add(self, position: float, data: np.ndarray):
+        # frames for positions already recorded (a seek back, or more than one render frame per slot) are dropped
+        slot = slot_at(position, self.fps)
+        if self.first_slot is None:
+            self.first_slot = slot
+        elif slot <= self.last_slot:
+            return
+        elif slot - self.last_slot - 1 > MAX_REPEAT:
+            self.offsets.extend([GAP] * (slot - self.last_slot - 1))
+            self.after_gap = True
+        else:
+            for _ in range(slot - self.last_slot - 1):
+                self._write(self.previous)
+        self.last_slot = slot
+        self._write(data)
+
+    def _write(self, data: np.ndarray):
+        f = self._file
+        keyframe = len(self.offsets) % self.keyframe_interval == 0 or self.after_gap
+        self.after_gap = False
+        self.offsets.append(f.tell())
+        if not keyframe:
+            runs, payload = encode_delta(self.previous, data)
+            # a frame that changes nearly everything is smaller whole
+            keyframe = runs.nbytes + payload.nbytes >= len(data)
+        if keyframe:
+            f.write(FRAME_HEADER.pack(KEYFRAME, 0))
+            f.write(data.tobytes())
+        else:
+            f.write(FRAME_HEADER.pack(DELTA, len(runs)))
+            f.write(runs.tobytes())
+            f.write(payload.tobytes())
+        self.previous[:] = data
+
+    def close(self) -> Optional[str]:
+        # returns the finished recording's path, or None if nothing was recorded
+        f = self._file
+        if self.offsets:
+            index_offset = f.tell()
+            f.write(np.array(self.offsets, dtype='<u8').tobytes())
+            f.seek(0)
+            self._write_header(index_offset)
+            f.seek(0, os.SEEK_END)
+            self.bytes_written = f.tell()
+        f.close()
+        if not self.offsets:
+            os.remove(self._temp_path)
+            return None
+        os.replace(self._temp_path, self.path)
+        return self.path
+
+
+# A finished recording, memory-mapped. frame(i) decodes into one reusable buffer: the next frame is a single
+# delta, anything else starts over from the keyframe at or before it, so seeking costs the same wherever it lands.
+class ShowRecording:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, universes, self.size, self.keyframe_interval, self.fps, self.first_slot, self.count,
+         index_offset, uri_length) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError(f'{path} is not a version {VERSION} show recording')
+        offset = HEADER.size
+        self.numbers = np.frombuffer(self.map, dtype='<u2', count=universes, offset=offset).tolist()
+        offset += universes * 2
+        self.uri = bytes(self.map[offset:offset + uri_length]).decode('utf-8')
+        self.index = np.frombuffer(self.map, dtype='<u8', count=self.count, offset=index_offset)
+        self.data = np.zeros(universes * self.size, dtype=np.uint8)
+        self.current = None
+
+    @property
+    def duration(self) -> float:
+        return self.count / self.fps
+
+    def compatible(self, universe: Universe) -> bool:
+        return self.numbers == list(universe.numbers) and self.size == universe.size
+
+    def frame_at(self, position: float) -> Optional[np.ndarray]:
+        # None outside the recording and in the gaps a seek left in it
+        index = slot_at(position, self.fps) - self.first_slot
+        if not 0 <= index < self.count or self.index[index] == GAP:
+            return None
+        return self.frame(index)
+
+    def frame(self, index: int) -> np.ndarray:
+        current = self.current
+        if current is None or index < current or index - current > index % self.keyframe_interval:
+            # the nearest keyframe is at least as close as the frame already decoded
+            current = index - index % self.keyframe_interval - 1
+        for i in range(current + 1, index + 1):
+            self._apply(i)
+        self.current = index
+        return self.data
+
+    def _apply(self, index: int):
+        offset = int(self.index[index])
+        if offset == GAP:
+            return
+        kind, run_count = FRAME_HEADER.unpack_from(self.map, offset)
+        offset += FRAME_HEADER.size
+        if kind == KEYFRAME:
+            self.data[:] = np.frombuffer(self.map, dtype=np.uint8, count=len(self.data), offset=offset)
+        elif run_count:
+            runs = np.frombuffer(self.map, dtype=RUN_DTYPE, count=run_count, offset=offset)
+            payload = np.frombuffer(self.map, dtype=np.uint8, count=int(runs['length'].sum()),
+                                    offset=offset + runs.nbytes)
+            self.data[run_positions(runs['start'], runs['length'])] = payload
+
+    def close(self):
+        # the numpy views have to go before the mapping can be closed
+        self.index = None
+        self.map.close()
+
+
+class ShowLibrary:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path_for(self, uri: str) -> str:
+        return os.path.join(self.directory, f'{hashlib.sha1(uri.encode("utf-8")).hexdigest()}.show')
+
+    def open(self, uri: str) -> Optional[ShowRecording]:
+        path = self.path_for(uri)
+        if not os.path.exists(path):
+            return None
+        recording = ShowRecording(path)
+        if recording.uri != uri:
+            recording.close()
+            return None
+        return recording
+
+    def recorder(self, uri: str, universe: Universe, fps: float) -> ShowRecorder:
+        os.makedirs(self.directory, exist_ok=True)
+        return ShowRecorder(self.path_for(uri), uri, universe, fps, keyframe_interval=max(1, int(fps)))
+
+
+# Decides per frame whether the stage renders live or plays a recording back. When the media changes it opens the
+# recording for the new URI if there is one that fits the universes, and otherwise starts recording it if asked
+# to. While a recording covers the frame's media position, play() copies the recorded frame into the universe and
+# the stage skips pattern rendering; outside it (and for media without a URI or position) the stage renders live.
+class ShowDirector:
+    def __init__(self, library: ShowLibrary, universe: Universe, fps: float = 60.0, record: bool = False,
+                 playback: bool = True):
+        self.library = library
+        self.universe = universe
+        self.fps = fps
+        self.record = record
+        self.playback = playback
+        self.media = None
+        self.recording: Optional[ShowRecording] = None
+        self.recorder: Optional[ShowRecorder] = None
+        self.played = 0
+        self.recorded = 0
+
+    def _change_media(self, media):
+        self.stop()
+        self.media = media
+        uri = media.uri
+        if not uri:
+            return
+        if self.playback:
+            try:
+                recording = self.library.open(uri)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Couldn't open the recording for {uri}: {e}")
+                recording = None
+            if recording is not None and not recording.compatible(self.universe):
+                logger.info(f"Recording for {uri} is for other universes, rendering live")
+                recording.close()
+                recording = None
+            if recording is not None:
+                logger.info(f"Playing back {recording.duration:.0f}s recording for {uri}")
+                self.recording = recording
+                return
+        if self.record:
+            logger.info(f"Recording {uri}")
+            self.recorder = self.library.recorder(uri, self.universe, self.fps)
+
+    def play(self, frame) -> bool:
+        if frame.media is not self.media:
+            self._change_media(frame.media)
+        if self.recording is None or frame.position is None:
+            return False
+        data = self.recording.frame_at(frame.position)
+        if data is None:
+            return False
+        self.universe.data[:] = data
+        self.played += 1
+        return True
+
+    def capture(self, frame):
+        if self.recorder is not None and frame.position is not None:
+            self.recorder.add(frame.position, self.universe.data)
+            self.recorded += 1
+
+    def stop(self):
+        # the next frame opens whatever there is for its media again
+        self.media = None
+        if self.recording is not None:
+            self.recording.close()
+            self.recording = None
+        if self.recorder is not None:
+            path = self.recorder.close()
+            if path:
+                logger.info(f"Saved {self.recorder.frames} frames ({self.recorder.bytes_written} bytes) to {path}")
+            self.recorder = None
+
+    def stats(self):
+        return {
+            'mode': 'playback' if self.recording is not None else 'recording' if self.recorder is not None else None,
+            'played': self.played,
+            'recorded': self.recorded,
+        }
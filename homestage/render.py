@@ -0,0 +1,123 @@
+import json
+import sys
+import time
+import tracemalloc
+from typing import List, Optional
+
+import numpy as np
+
+from homestage.backends import LoopbackBackend, NullBackend
+from homestage.controller import HomeStage, StageConfig
+from homestage.frame import VirtualClock
+from homestage.model import Media, decode_analysis
+from homestage.sources import FileSource, ClickTrackSource
+from homestage.universe import allocate
+
+
+def copy_fixture(fixture, keep_address: bool = True):
+    # an unpatched copy of a configured fixture, with its groups, curves and white mixing
+    copy = type(fixture)(fixture.address, fixture.universe) if keep_address else type(fixture)()
+    for name in ('groups', 'curves', 'white_from_rgb'):
+        if name in vars(fixture):
+            setattr(copy, name, getattr(fixture, name))
+    return copy
+
+
+def scale_fixtures(fixtures: List, count: Optional[int] = None, first_universe: int = 1) -> List:
+    # fresh copies of the configured fixtures, as configured when count is None, otherwise repeated until there are
+    # count of them and packed into as many universes as it takes
+    if count is None:
+        return [copy_fixture(fixture) for fixture in fixtures]
+    return allocate([copy_fixture(fixtures[i % len(fixtures)], False) for i in range(count)], first_universe)
+
+
+def load_analysis(path: str):
+    with open(path, 'r') as f:
+        data = json.load(f)
+    # accept either a whole /api/media/ payload or just its analysis
+    return decode_analysis(data.get('analysis') if 'analysis' in data else data)
+
+
+# Runs HomeStage on a virtual clock: audio blocks are read from a file (or a click track) and analyzed as the
+# frame clock passes them, then every frame is rendered back to back with nothing sleeping in between.
+class OfflineRenderer:
+    def __init__(self, config: StageConfig, fixtures: List, pattern: str, analysis=None,
+                 audio_path: Optional[str] = None, fps: float = 60):
+        self.fps = fps
+        self.clock = VirtualClock()
+        self.output = LoopbackBackend()
+        self.stage = HomeStage(config, fixtures, self.output, clock=self.clock)
+        self.stage.controller.pattern.select(pattern, 0)
+
+        state = self.stage.state
+        media = Media(title=pattern, analysis=analysis)
+        state.reset(media)
+        media.timeline.sync(0.0)
+
+        if audio_path:
+            source = FileSource(audio_path, realtime=False, loop=True)
+        else:
+            source = ClickTrackSource(realtime=False)
+        self.recorder = source.recorder(samplerate=state.sample_rate, channels=1, blocksize=state.block_size)
+        self.block_period = state.block_size / state.sample_rate
+        self.audio_time = 0.0
+        self.audio_cost = 0.0
+
+    def _feed_audio(self, until: float):
+        state = self.stage.state
+        while self.audio_time + self.block_period <= until:
+            signal = self.recorder.record(numframes=state.block_size).reshape(-1).astype(np.float32)
+            self.audio_time += self.block_period
+            start = time.perf_counter()
+            state.process(signal, self.audio_time, measure_latency=False)
+            self.audio_cost += time.perf_counter() - start
+
+    def render(self, seconds: float, out=None, allocations: bool = False):
+        frame_count = int(seconds * self.fps)
+        latencies = np.zeros(frame_count)
+        peaks = np.zeros(frame_count) if allocations else None
+        blocks = np.zeros(frame_count) if allocations else None
+        data = self.stage.universe.data
+
+        with self.recorder:
+            if allocations:
+                tracemalloc.start()
+            started = time.perf_counter()
+            for i in range(frame_count):
+                self._feed_audio(self.clock.now())
+                if allocations:
+                    tracemalloc.reset_peak()
+                    before, _ = tracemalloc.get_traced_memory()
+                    before_blocks = sys.getallocatedblocks()
+                start = time.perf_counter()
+                self.stage.render()
+                latencies[i] = time.perf_counter() - start
+                if allocations:
+                    blocks[i] = sys.getallocatedblocks() - before_blocks
+                    peaks[i] = tracemalloc.get_traced_memory()[1] - before
+                if out is not None:
+                    out.write(data.tobytes())
+                self.clock.advance(1 / self.fps)
+            elapsed = time.perf_counter() - started
+            if allocations:
+                tracemalloc.stop()
+
+        stats = {
+            'frames': frame_count,
+            'elapsed': elapsed,
+            'fps': frame_count / elapsed if elapsed else 0,
+            'audio': self.audio_cost,
+            'p50': np.percentile(latencies, 50),
+            'p95': np.percentile(latencies, 95),
+            'p99': np.percentile(latencies, 99),
+            'max': latencies.max(initial=0),
+        }
+        if allocations:
+            stats['peak_bytes'] = peaks.mean()
+            stats['net_blocks'] = blocks.mean()
+        return stats
+
+
+def pattern_names(config: StageConfig) -> List[str]:
+    stage = HomeStage(config, [], NullBackend(), clock=VirtualClock())
+    return [name for name, _ in stage.controller.pattern.patterns]
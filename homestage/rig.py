@@ -0,0 +1,167 @@
+from typing import List, Optional
+
+import numpy as np
+
+from homestage.color import curve_table, inverse_table
+from homestage.universe import Universe, universe_numbers
+
+
+# Struct-of-arrays view of every fixture on the stage: rig.pan, rig.r, rig.level... are float arrays with one
+# entry per fixture that patterns assign whole (rig.tilt = expr, scalars broadcast). An attribute's array is created
+# from the fixtures' current values the first time it is touched and keeps its contents between frames, so a
+# pattern only has to write what changes. flush() scatters every array into the universe buffer in one indexed
+# assignment per attribute, using channel indices compiled from the fixture mappings. The universe holds output
+# values, after the fixtures' curves: the arrays hold them before, and anything read back from the universe goes
+# through the inverse of the curve so it isn't curved a second time.
+class Rig:
+    def __init__(self, fixtures: List, universe: Optional[Universe] = None):
+        if universe is None:
+            universe = Universe(universe_numbers(fixtures))
+            for fixture in fixtures:
+                universe.patch(fixture)
+        object.__setattr__(self, 'fixtures', list(fixtures))
+        object.__setattr__(self, 'universe', universe)
+        object.__setattr__(self, 'count', len(self.fixtures))
+        object.__setattr__(self, 'values', {})
+        object.__setattr__(self, '_targets', {})
+        object.__setattr__(self, '_curves', {})
+        object.__setattr__(self, '_masks', {})
+        object.__setattr__(self, '_flushed', {})
+        object.__setattr__(self, '_written', {})
+        # handy per-fixture constants for phase offsets
+        object.__setattr__(self, 'index', np.arange(self.count))
+        object.__setattr__(self, 'alternate', np.where(self.index % 2, 1, -1))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        array = self.values.get(name)
+        if array is None:
+            array = np.array([getattr(fixture, name, 0) for fixture in self.fixtures], dtype=np.float64)
+            sources, slots = self._targets_for(name)
+            if len(slots):
+                array[sources] = self._read(name)
+            self.values[name] = array
+        return array
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__:
+            object.__setattr__(self, name, value)
+        else:
+            getattr(self, name)[:] = value
+
+    def __len__(self):
+        return self.count
+
+    def _targets_for(self, name):
+        # (fixture index per channel, universe slot per channel) for everything the attribute drives
+        targets = self._targets.get(name)
+        if targets is None:
+            sources = []
+            slots = []
+            for i, fixture in enumerate(self.fixtures):
+                for offset in fixture.channel_offsets(name):
+                    sources.append(i)
+                    slots.append(fixture.slot + offset)
+            targets = (np.array(sources, dtype=np.intp), np.array(slots, dtype=np.intp))
+            self._targets[name] = targets
+        return targets
+
+    def _curves_for(self, name):
+        # [(positions in the attribute's slots, table, inverse table)] for the channels that have an output curve
+        curves = self._curves.get(name)
+        if curves is None:
+            groups = {}
+            position = 0
+            for fixture in self.fixtures:
+                for offset in fixture.channel_offsets(name):
+                    curve = fixture.curves.get(fixture.mapping[offset])
+                    if curve is not None:
+                        table = curve_table(curve)
+                        groups.setdefault(id(table), (table, []))[1].append(position)
+                    position += 1
+            curves = [(np.array(positions, dtype=np.intp), table, inverse_table(table))
+                      for table, positions in groups.values()]
+            self._curves[name] = curves
+        return curves
+
+    def channel_mask(self, name):
+        # 1 for fixtures that have a channel for the attribute, 0 for the rest
+        mask = self._masks.get(name)
+        if mask is None:
+            mask = np.array([bool(fixture.channel_offsets(name)) for fixture in self.fixtures], dtype=np.float64)
+            self._masks[name] = mask
+        return mask
+
+    def _read(self, name):
+        # the attribute's channels in the universe, with their output curves undone
+        sources, slots = self._targets_for(name)
+        data = self.universe.data[slots]
+        values = data.astype(np.float64)
+        for positions, table, inverse in self._curves_for(name):
+            values[positions] = inverse[data[positions]]
+        return values
+
+    def flag_mask(self, name):
+        # 1 for fixtures where the (non-channel) attribute is set, 0 for the rest
+        key = ('flag', name)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = np.array([bool(getattr(fixture, name, False)) for fixture in self.fixtures], dtype=np.float64)
+            self._masks[key] = mask
+        return mask
+
+    def load(self):
+        # pick up values that were written straight to the fixtures or the universe; channels still holding what
+        # the rig last wrote keep the value it had before the curve, which the inverse can't always recover
+        data = self.universe.data
+        for name, array in self.values.items():
+            sources, slots = self._targets_for(name)
+            values = self._read(name)
+            written = self._written.get(name)
+            if written is not None:
+                changed = data[slots] != written
+                sources, values = sources[changed], values[changed]
+            array[sources] = values
+        self._flushed.clear()
+
+    def flush(self):
+        # attributes that haven't changed since they were last flushed are skipped
+        data = self.universe.data
+        for name, array in self.values.items():
+            flushed = self._flushed.get(name)
+            if flushed is None:
+                self._flushed[name] = array.copy()
+            elif np.array_equal(array, flushed):
+                continue
+            else:
+                flushed[:] = array
+            sources, slots = self._targets_for(name)
+            if len(slots):
+                values = np.clip(array[sources], 0, 255)
+                for positions, table, inverse in self._curves_for(name):
+                    values[positions] = table[values[positions].astype(np.uint8)]
+                data[slots] = values
+                self._written[name] = data[slots]
+
+
+# One fixture of a rig as an old-style pattern sees it: its channel attributes read and write the fixture's entry
+# in the rig's arrays, and anything else goes to the fixture itself
+class RigFixture:
+    __slots__ = ('rig', 'index', 'fixture')
+
+    def __init__(self, rig: Rig, index: int):
+        object.__setattr__(self, 'rig', rig)
+        object.__setattr__(self, 'index', index)
+        object.__setattr__(self, 'fixture', rig.fixtures[index])
+
+    def __getattr__(self, name):
+        if self.fixture.channel_offsets(name):
+            return int(getattr(self.rig, name)[self.index])
+        return getattr(self.fixture, name)
+
+    def __setattr__(self, name, value):
+        if self.fixture.channel_offsets(name):
+            getattr(self.rig, name)[self.index] = value
+        else:
+            setattr(self.fixture, name, value)
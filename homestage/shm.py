@@ -0,0 +1,110 @@
+import time
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+
+from homestage.frame import HISTOGRAM_BINS
+
+HEADER_SIZE = 8
+
+
+# One fixed-layout record in shared memory with a single writer and any number of readers. The writer bumps the
+# sequence number to odd before touching the record and back to even after; a reader copies the record out and
+# keeps the copy only if the sequence was even and unchanged across the copy, so it never sees a half written
+# record and the writer never waits for readers. Relies on the stores landing in program order, which holds on
+# x86 and for the word sized counter updates numpy makes here.
+class SeqlockBuffer:
+    def __init__(self, dtype, name: Optional[str] = None, create: bool = False):
+        self.dtype = np.dtype(dtype)
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=HEADER_SIZE + self.dtype.itemsize)
+        self.owner = create
+        self._sequence = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf)
+        self.record = np.ndarray((), dtype=self.dtype, buffer=self.shm.buf, offset=HEADER_SIZE)
+        if create:
+            self._sequence[0] = 0
+            self.record[...] = np.zeros((), dtype=self.dtype)
+        self.retries = 0
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def version(self) -> int:
+        # number of completed writes
+        return int(self._sequence[0]) // 2
+
+    @contextmanager
+    def writing(self):
+        self._sequence[0] += 1
+        try:
+            yield self.record
+        finally:
+            self._sequence[0] += 1
+
+    def write(self, **fields):
+        with self.writing() as record:
+            for key, value in fields.items():
+                record[key] = value
+
+    def read(self, out: Optional[np.ndarray] = None) -> np.ndarray:
+        if out is None:
+            out = np.zeros((), dtype=self.dtype)
+        while True:
+            before = int(self._sequence[0])
+            if not before & 1:
+                out[...] = self.record
+                if int(self._sequence[0]) == before:
+                    return out
+            self.retries += 1
+            time.sleep(0)
+
+    def close(self):
+        # the numpy views have to go before the mapping can be closed
+        self._sequence = None
+        self.record = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def audio_snapshot_dtype(band_count: int) -> np.dtype:
+    return np.dtype([
+        ('spectrum', np.float64, (band_count,)),
+        ('beat', np.bool_),
+        ('tempo', np.float64),
+        ('beat_period', np.float64),
+        ('beat_reference', np.float64),
+        ('blocks', np.int64),
+        ('overruns', np.int64),
+        ('skipped', np.int64),
+        ('queue_depth', np.int64),
+        ('max_queue_depth', np.int64),
+        ('latency', np.float64),
+        ('max_latency', np.float64),
+        ('analysis_load', np.float64),
+    ])
+
+
+def frame_snapshot_dtype(universes: int, size: int) -> np.dtype:
+    return np.dtype([
+        ('index', np.int64),
+        ('time', np.float64),
+        ('render_time', np.float64),
+        ('pattern', np.int64),
+        ('dropped', np.int64),
+        ('sends', np.int64, (universes,)),
+        ('frame_times', np.int64, (HISTOGRAM_BINS,)),
+        ('jitter', np.int64, (HISTOGRAM_BINS,)),
+        ('data', np.uint8, (universes * size,)),
+    ])
+
+
+CONTROL_SNAPSHOT_DTYPE = np.dtype([
+    ('axis0', np.float64, (2,)),
+    ('axis1', np.float64, (2,)),
+    ('lt', np.float64),
+    ('rt', np.float64),
+] + [(key, np.bool_) for key in ('lb', 'rb', 'left', 'right', 'up', 'down', 'triangle', 'square', 'circle', 'cross')])
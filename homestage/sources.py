@@ -0,0 +1,293 @@
+import mmap
+import struct
+import time
+from typing import Optional
+
+import numpy as np
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+# Audio sources hand out recorders with the same shape as soundcard's: a context manager whose
+# record(numframes) returns a (numframes, channels) float array. Sources that aren't paced by a real device set
+# realtime = False so the capture thread applies back pressure instead of dropping blocks.
+class AudioSource:
+    realtime = True
+
+    def recorder(self, samplerate: int, channels: int = 1, blocksize: Optional[int] = None):
+        raise NotImplementedError()
+
+
+class Recorder:
+    def __init__(self, samplerate: int, channels: int, realtime: bool):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.realtime = realtime
+        self.frames = 0
+        self.started = None
+
+    def __enter__(self):
+        self.frames = 0
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def record(self, numframes: int) -> np.ndarray:
+        data = self._read(numframes)
+        self.frames += numframes
+        if self.realtime:
+            delay = self.started + self.frames / self.samplerate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        return data
+
+    def _read(self, numframes: int) -> np.ndarray:
+        raise NotImplementedError()
+
+
+class MicrophoneSource(AudioSource):
+    def __init__(self, microphone):
+        self.microphone = microphone
+
+    @property
+    def id(self):
+        return self.microphone.id
+
+    @property
+    def name(self):
+        return self.microphone.name
+
+    def recorder(self, samplerate: int, channels: int = 1, blocksize: Optional[int] = None):
+        return self.microphone.recorder(samplerate=samplerate, channels=channels, blocksize=blocksize)
+
+
+class FileSource(AudioSource):
+    # Plays back a WAV file, or headerless PCM when dtype/channels/sample_rate are given, through a read-only
+    # memory map. Samples are converted block by block, so large files cost nothing until they're read.
+    def __init__(self, path: str, realtime: bool = True, loop: bool = True, dtype: Optional[str] = None,
+                 channels: Optional[int] = None, sample_rate: Optional[int] = None, offset: int = 0):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.size = None
+        if dtype is None:
+            offset, self.size, dtype, channels, sample_rate = read_wave_header(path)
+        elif channels is None or sample_rate is None:
+            raise ValueError('raw PCM needs dtype, channels and sample_rate')
+        self.offset = offset
+        self.dtype = np.dtype(dtype)
+        self.channels = channels
+        self.sample_rate = sample_rate
+
+    def open(self) -> np.ndarray:
+        with open(self.path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        frame_size = self.dtype.itemsize * self.channels
+        size = len(data) - self.offset if self.size is None else min(self.size, len(data) - self.offset)
+        count = size // frame_size
+        return np.frombuffer(data, dtype=self.dtype, count=count * self.channels,
+                             offset=self.offset).reshape(count, self.channels)
+
+    def recorder(self, samplerate: int, channels: int = 1, blocksize: Optional[int] = None):
+        return FileRecorder(self, samplerate, channels)
+
+
+class FileRecorder(Recorder):
+    def __init__(self, source: FileSource, samplerate: int, channels: int):
+        super().__init__(samplerate, channels, source.realtime)
+        self.source = source
+        self.samples = None
+        self.step = source.sample_rate / samplerate
+        self.position = 0.0
+        self.finished = False
+        if source.dtype.kind == 'u':
+            self.scale = 2 ** (8 * source.dtype.itemsize - 1)
+            self.bias = -1.0
+        elif source.dtype.kind == 'i':
+            self.scale = 2 ** (8 * source.dtype.itemsize - 1)
+            self.bias = 0.0
+        else:
+            self.scale = 1.0
+            self.bias = 0.0
+
+    def __enter__(self):
+        self.samples = self.source.open()
+        self.position = 0.0
+        self.finished = False
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.samples = None
+
+    def _read(self, numframes: int) -> np.ndarray:
+        total = len(self.samples)
+        positions = self.position + np.arange(numframes) * self.step
+        self.position += numframes * self.step
+        if self.source.loop and total:
+            positions %= total
+            self.position %= total
+        elif self.position >= total:
+            self.finished = True
+
+        if self.step == 1:
+            indices = positions.astype(np.intp)
+            valid = indices < total
+            frames = np.zeros((numframes, self.source.channels), dtype=np.float32)
+            frames[valid] = self.samples[indices[valid]] / self.scale + self.bias
+        else:
+            # linear interpolation between neighbouring frames when the file rate differs
+            lower = np.minimum(positions.astype(np.intp), max(total - 1, 0))
+            upper = np.minimum(lower + 1, max(total - 1, 0))
+            fraction = (positions - lower)[:, None]
+            frames = self.samples[lower] * (1 - fraction) + self.samples[upper] * fraction
+            frames = frames / self.scale + self.bias
+            # padding past the end goes in after the conversion, so it's silence for unsigned formats too
+            frames[positions >= total] = 0
+        return mix(frames.astype(np.float32), self.channels)
+
+
+class ClickTrackSource(AudioSource):
+    # Noise with a short decaying tone on every beat, for checking tempo detection against a known BPM
+    def __init__(self, bpm: float = 120.0, noise: float = 0.05, click_length: float = 0.03,
+                 click_frequency: float = 1000.0, amplitude: float = 0.8, realtime: bool = True, seed: int = 0):
+        self.bpm = bpm
+        self.noise = noise
+        self.click_length = click_length
+        self.click_frequency = click_frequency
+        self.amplitude = amplitude
+        self.realtime = realtime
+        self.seed = seed
+
+    @property
+    def period(self) -> float:
+        return 60 / self.bpm
+
+    def beat_times(self, duration: float) -> np.ndarray:
+        return np.arange(0, duration, self.period)
+
+    def recorder(self, samplerate: int, channels: int = 1, blocksize: Optional[int] = None):
+        return ClickTrackRecorder(self, samplerate, channels)
+
+
+class ClickTrackRecorder(Recorder):
+    def __init__(self, source: ClickTrackSource, samplerate: int, channels: int):
+        super().__init__(samplerate, channels, source.realtime)
+        self.source = source
+        self.random = np.random.default_rng(source.seed)
+
+    def _read(self, numframes: int) -> np.ndarray:
+        source = self.source
+        t = (self.frames + np.arange(numframes)) / self.samplerate
+        since_beat = t % source.period
+        envelope = np.where(since_beat < source.click_length,
+                            np.exp(-since_beat * 5 / source.click_length), 0)
+        signal = source.amplitude * envelope * np.sin(2 * np.pi * source.click_frequency * since_beat)
+        if source.noise:
+            signal += self.random.normal(0, source.noise, numframes)
+        return np.repeat(signal.astype(np.float32)[:, None], self.channels, axis=1)
+
+
+class ImpulseSource(AudioSource):
+    # Silence (or a noise floor) broken by short tone bursts at randomized intervals, so each one stands out from
+    # the audio around it and drifts against the frame clock instead of always landing in the same phase
+    def __init__(self, interval: float = 0.5, jitter: float = 0.25, click_length: float = 0.005,
+                 click_frequency: float = 1000.0, amplitude: float = 0.9, noise: float = 0.0, start: float = 1.0,
+                 realtime: bool = True, seed: int = 0):
+        self.interval = interval
+        self.jitter = jitter
+        self.click_length = click_length
+        self.click_frequency = click_frequency
+        self.amplitude = amplitude
+        self.noise = noise
+        self.start = start
+        self.realtime = realtime
+        self.seed = seed
+
+    def recorder(self, samplerate: int, channels: int = 1, blocksize: Optional[int] = None):
+        return ImpulseRecorder(self, samplerate, channels)
+
+
+class ImpulseRecorder(Recorder):
+    def __init__(self, source: ImpulseSource, samplerate: int, channels: int):
+        super().__init__(samplerate, channels, source.realtime)
+        self.source = source
+        self.random = np.random.default_rng(source.seed)
+        self.length = max(1, int(source.click_length * samplerate))
+        self.next_click = 0
+
+    def __enter__(self):
+        self.next_click = int(self.source.start * self.samplerate)
+        return super().__enter__()
+
+    def _read(self, numframes: int) -> np.ndarray:
+        source = self.source
+        start = self.frames
+        end = start + numframes
+        signal = np.zeros(numframes, dtype=np.float64)
+        if source.noise:
+            signal += self.random.normal(0, source.noise, numframes)
+        while self.next_click < end:
+            # a burst can straddle blocks, in which case the rest of it goes in the next one
+            lo = max(self.next_click, start)
+            hi = min(self.next_click + self.length, end)
+            t = (np.arange(lo, hi) - self.next_click) / self.samplerate
+            signal[lo - start:hi - start] += source.amplitude * np.sin(2 * np.pi * source.click_frequency * t + 1)
+            if self.next_click + self.length > end:
+                break
+            interval = source.interval * (1 + self.random.uniform(-source.jitter, source.jitter))
+            self.next_click += max(self.length, int(interval * self.samplerate))
+        return np.repeat(signal.astype(np.float32)[:, None], self.channels, axis=1)
+
+
+def mix(frames: np.ndarray, channels: int) -> np.ndarray:
+    if frames.shape[1] == channels:
+        return frames
+    mono = frames.mean(axis=1, keepdims=True)
+    return np.repeat(mono, channels, axis=1)
+
+
+def read_wave_header(path: str):
+    with open(path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(f'{path} is not a WAV file')
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f'{path} has no data chunk')
+            chunk_id, size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                fmt = f.read(size)
+                if size % 2:
+                    f.seek(1, 1)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError(f'{path} has a data chunk before its fmt chunk')
+                data_size = size
+                break
+            else:
+                f.seek(size + size % 2, 1)
+        offset = f.tell()
+
+    format_tag, channels, sample_rate, _, _, bits = struct.unpack('<HHIIHH', fmt[:16])
+    if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        format_tag = struct.unpack('<H', fmt[24:26])[0]
+    if format_tag == WAVE_FORMAT_PCM and bits in (8, 16, 32):
+        dtype = {8: 'u1', 16: '<i2', 32: '<i4'}[bits]
+    elif format_tag == WAVE_FORMAT_IEEE_FLOAT and bits in (32, 64):
+        dtype = {32: '<f4', 64: '<f8'}[bits]
+    else:
+        raise ValueError(f'unsupported WAV encoding in {path} (format {format_tag}, {bits} bits)')
+    return offset, data_size, dtype, channels, sample_rate
+
+
+SOURCES = {
+    'file': FileSource,
+    'synthetic': ClickTrackSource,
+    'impulse': ImpulseSource,
+}
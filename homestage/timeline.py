@@ -0,0 +1,135 @@
+import math
+import time
+from typing import Callable, Optional, List, Tuple
+
+import numpy as np
+
+SECTION = 0
+SEGMENT = 1
+
+
+# Playhead anchored to a monotonic clock. Position reports from the player are sync samples: small disagreements
+# are slewed out gradually at slew_rate seconds per second so the playhead never jumps, and only errors larger
+# than max_slew (seeks, track restarts) move it immediately.
+class MediaTimeline:
+    def __init__(self, clock: Callable[[], float] = time.perf_counter, slew_rate: float = 0.05,
+                 max_slew: float = 0.5):
+        self.clock = clock
+        self.slew_rate = slew_rate
+        self.max_slew = max_slew
+        self.origin = None
+        self.last_error = 0.0
+        self._pending = 0.0
+        self._slew_from = 0.0
+
+    def _origin_at(self, now: float) -> float:
+        if not self._pending:
+            return self.origin
+        step = (now - self._slew_from) * self.slew_rate
+        if step >= abs(self._pending):
+            return self.origin + self._pending
+        return self.origin + math.copysign(step, self._pending)
+
+    def sync(self, position: float, at: Optional[float] = None):
+        if at is None:
+            at = self.clock()
+        target = at - position
+        if self.origin is None:
+            self.last_error = 0.0
+            error = math.inf
+        else:
+            current = self._origin_at(at)
+            error = target - current
+            self.last_error = error
+        if abs(error) > self.max_slew:
+            self.origin = target
+            self._pending = 0.0
+        else:
+            self.origin = current
+            self._pending = error
+            self._slew_from = at
+
+    def stop(self):
+        self.origin = None
+        self._pending = 0.0
+
+    @property
+    def position(self) -> Optional[float]:
+        return self.position_at(self.clock())
+
+    def position_at(self, now: float) -> Optional[float]:
+        if self.origin is None:
+            return None
+        if self._pending:
+            return now - self._origin_at(now)
+        return now - self.origin
+
+
+# Sorted (time, kind, index) events for every section and segment boundary of a track. advance() hands back each
+# boundary the playhead crossed since the last call, in order, so none are missed or repeated when several fall
+# inside one frame. Moving backwards or jumping further than seek_threshold only reports where the playhead landed,
+# and only the section or segment that differs from the one already active.
+class CueSchedule:
+    def __init__(self, sections, segments, seek_threshold: float = 1.0):
+        self.seek_threshold = seek_threshold
+        self.section_starts = np.asarray(sections.starts, dtype=np.float64)
+        self.segment_starts = np.asarray(segments.starts, dtype=np.float64)
+        times = np.concatenate([self.section_starts, self.segment_starts])
+        kinds = np.concatenate([np.full(len(self.section_starts), SECTION, dtype=np.int8),
+                                np.full(len(self.segment_starts), SEGMENT, dtype=np.int8)])
+        indexes = np.concatenate([np.arange(len(self.section_starts)), np.arange(len(self.segment_starts))])
+        order = np.lexsort((kinds, times))
+        self.times = times[order]
+        self.kinds = kinds[order]
+        self.indexes = indexes[order]
+        self.next = 0
+        self.position = None
+        self.section = None
+        self.segment = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def advance(self, position: Optional[float]) -> List[Tuple[int, int]]:
+        if position is None:
+            self.position = None
+            return []
+
+        last = self.position
+        self.position = position
+        if last is None or position < last or position - last > self.seek_threshold:
+            self.next = int(np.searchsorted(self.times, position, side='right'))
+            events = []
+            section = int(np.searchsorted(self.section_starts, position, side='right')) - 1
+            if section >= 0 and section != self.section:
+                events.append((SECTION, section))
+                self.section = section
+            segment = int(np.searchsorted(self.segment_starts, position, side='right')) - 1
+            if segment >= 0 and segment != self.segment:
+                events.append((SEGMENT, segment))
+                self.segment = segment
+            return events
+
+        times = self.times
+        start = end = self.next
+        while end < len(times) and times[end] <= position:
+            end += 1
+        self.next = end
+        if start == end:
+            return []
+        events = list(zip(self.kinds[start:end].tolist(), self.indexes[start:end].tolist()))
+        for kind, index in events:
+            if kind == SECTION:
+                self.section = index
+            else:
+                self.segment = index
+        return events
+
+    def next_boundary(self, kind: int, position: float) -> Optional[float]:
+        starts = self.section_starts if kind == SECTION else self.segment_starts
+        index = int(np.searchsorted(starts, position, side='right'))
+        return float(starts[index]) if index < len(starts) else None
+
+    def time_to_next(self, kind: int, position: float) -> Optional[float]:
+        boundary = self.next_boundary(kind, position)
+        return boundary - position if boundary is not None else None
@@ -0,0 +1,149 @@
+from typing import Iterable, List
+
+import numpy as np
+
+UNIVERSE_SIZE = 512
+
+# E1.31 receivers treat a source as lost after 2.5 s of silence, and senders are expected to repeat unchanged data
+# about once a second
+KEEPALIVE_INTERVAL = 0.8
+
+
+def allocate(fixtures: List, first_universe: int = 1, size: int = UNIVERSE_SIZE) -> List:
+    # Fixtures with a universe and address keep them, and ones with only an address get that address in
+    # first_universe, where fixtures sharing an address mirror each other as they always have. The rest are packed
+    # into the first gap that fits, starting from first_universe. Raises ValueError for fixtures with a universe
+    # that overlap each other or an address-only fixture, and for fixtures that don't fit in a universe.
+    used = {}
+
+    def fits(universe, start, length):
+        return start >= 0 and start + length <= size and \
+            all(end <= start or start + length <= begin for begin, end, _ in used.get(universe, ()))
+
+    def place(fixture, universe, start):
+        used.setdefault(universe, []).append((start, start + len(fixture.channels), fixture))
+        fixture.universe = universe
+        fixture.address = start
+
+    for fixture in fixtures:
+        if fixture.universe is None or fixture.address is None:
+            continue
+        length = len(fixture.channels)
+        if fixture.address < 0 or fixture.address + length > size:
+            raise ValueError(f'{type(fixture).__name__} at {fixture.universe}/{fixture.address} '
+                             f'does not fit in the universe')
+        for begin, end, other in used.get(fixture.universe, ()):
+            if begin < fixture.address + length and fixture.address < end:
+                raise ValueError(f'{type(fixture).__name__} at {fixture.universe}/{fixture.address} overlaps '
+                                 f'{type(other).__name__} at {fixture.universe}/{begin}')
+        place(fixture, fixture.universe, fixture.address)
+
+    patched = list(used.get(first_universe, ()))
+    for fixture in fixtures:
+        if fixture.universe is None and fixture.address is not None:
+            length = len(fixture.channels)
+            if fixture.address < 0 or fixture.address + length > size:
+                raise ValueError(f'{type(fixture).__name__} at {fixture.address} does not fit in the universe')
+            for begin, end, other in patched:
+                if begin < fixture.address + length and fixture.address < end:
+                    raise ValueError(f'{type(fixture).__name__} at {fixture.address} overlaps '
+                                     f'{type(other).__name__} at {first_universe}/{begin}')
+            place(fixture, first_universe, fixture.address)
+
+    for fixture in fixtures:
+        if fixture.address is not None:
+            continue
+        length = len(fixture.channels)
+        if length > size:
+            raise ValueError(f'{type(fixture).__name__} has more channels than a universe')
+        universe = first_universe if fixture.universe is None else fixture.universe
+        while True:
+            starts = [0] + [end for _, end, _ in sorted(used.get(universe, ()), key=lambda u: u[0])]
+            start = next((s for s in starts if fits(universe, s, length)), None)
+            if start is not None:
+                place(fixture, universe, start)
+                break
+            if fixture.universe is not None:
+                raise ValueError(f'no room for {type(fixture).__name__} in universe {universe}')
+            universe += 1
+    return fixtures
+
+
+def universe_numbers(fixtures: Iterable, default: int = 1) -> List[int]:
+    return sorted({fixture.universe for fixture in fixtures if fixture.universe is not None}) or [default]
+
+
+# One or more DMX universes in a single contiguous uint8 buffer, universe i at data[i * size:(i + 1) * size].
+# Patched fixtures get a view of their slots, so writing a fixture attribute writes the buffer, and outputs are
+# handed each universe's slice as a view. They still copy it once into their packets (the sacn library's
+# dmxData setter goes through a 512 element tuple); nothing is copied on the way there.
+class Universe:
+    def __init__(self, numbers: Iterable[int] = (1,), size: int = UNIVERSE_SIZE):
+        self.numbers = list(numbers)
+        self.size = size
+        self.index = {number: i for i, number in enumerate(self.numbers)}
+        self.data = np.zeros(len(self.numbers) * size, dtype=np.uint8)
+        self.view = memoryview(self.data)
+        self.blocks = self.data.reshape(len(self.numbers), size)
+        self.views = {number: memoryview(self.blocks[i]) for i, number in enumerate(self.numbers)}
+        self.fixtures = []
+        # what the output last got, to tell which frames actually change anything
+        self.sent = np.zeros_like(self.data)
+        self.last_sent = np.full(len(self.numbers), -np.inf)
+        self.changed = 0
+        self.dirty_range = None
+        self.frames = 0
+        self.sends = np.zeros(len(self.numbers), dtype=np.int64)
+        self.keepalives = 0
+        self.idle_universes = 0
+        self.changed_total = 0
+        self._diff = np.zeros(len(self.data), dtype=np.bool_)
+
+    def patch(self, fixture):
+        number = self.numbers[0] if fixture.universe is None else fixture.universe
+        if number not in self.index:
+            raise ValueError(f'{type(fixture).__name__} is in universe {number}, which is not in the buffer')
+        start = fixture.address
+        end = start + len(fixture.channels)
+        if start < 0 or end > self.size:
+            raise ValueError(f'{type(fixture).__name__} at address {start} does not fit in the universe')
+        fixture.slot = self.index[number] * self.size + start
+        channels = self.data[fixture.slot:fixture.slot + len(fixture.channels)]
+        channels[:] = fixture.channels
+        fixture.channels = channels
+        self.fixtures.append(fixture)
+        return fixture
+
+    def commit(self, now: float) -> List[int]:
+        # the universes that have to go out this frame: those that changed since their last send, and those due a
+        # keepalive
+        diff = np.not_equal(self.data, self.sent, out=self._diff)
+        changed = diff.reshape(self.blocks.shape).any(axis=1)
+        self.changed = int(np.count_nonzero(diff))
+        self.frames += 1
+        if self.changed:
+            start = int(diff.argmax())
+            end = len(diff) - int(diff[::-1].argmax())
+            self.dirty_range = (start, end)
+            self.sent[start:end] = self.data[start:end]
+            self.changed_total += self.changed
+        else:
+            self.dirty_range = None
+        keepalive = ~changed & (now - self.last_sent >= KEEPALIVE_INTERVAL)
+        due = changed | keepalive
+        self.idle_universes = len(changed) - int(np.count_nonzero(changed))
+        self.keepalives += int(np.count_nonzero(keepalive))
+        self.last_sent[due] = now
+        self.sends += due
+        return [self.numbers[i] for i in np.flatnonzero(due)]
+
+    def stats(self):
+        return {
+            'universes': len(self.numbers),
+            'frames': self.frames,
+            'sends': int(self.sends.sum()),
+            'keepalives': self.keepalives,
+            'idle_universes': self.idle_universes,
+            'changed': self.changed,
+            'changed_per_frame': self.changed_total / self.frames if self.frames else 0,
+        }
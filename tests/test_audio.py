@@ -0,0 +1,73 @@
+import threading
+
+import numpy as np
+import pytest
+
+from homestage.audio import BlockRing, SpectrumHistory
+
+
+def test_spectrum_history_matches_a_full_scan():
+    rng = np.random.default_rng(0)
+    history = SpectrumHistory(band_count=3, size=16, average_size=5)
+    pushed = []
+    for _ in range(100):
+        values = rng.random(3)
+        history.push(values)
+        pushed.append(values)
+        # the buffer starts out zero-filled, so the zeros count until they've been pushed out
+        window = np.array(([np.zeros(3)] * 16 + pushed)[-16:]).T
+        assert np.allclose(history.maximum, window.max(axis=1))
+        assert np.allclose(history.minimum, window.min(axis=1))
+        assert np.allclose(history.average, window[:, -5:].mean(axis=1))
+        assert np.array_equal(history.latest(4), window[:, ::-1][:, :4])
+
+
+def test_spectrum_history_rejects_long_average():
+    with pytest.raises(ValueError):
+        SpectrumHistory(band_count=1, size=4, average_size=5)
+
+
+def blocks(count, size=4):
+    return [np.full(size, i, dtype=np.float32) for i in range(count)]
+
+
+def test_block_ring_keeps_order_and_timestamps():
+    ring = BlockRing(capacity=4, block_size=4)
+    out = np.empty(4, dtype=np.float32)
+    for i, block in enumerate(blocks(3)):
+        ring.put(block, i / 10)
+    assert ring.depth == ring.max_depth == 3
+    for i in range(3):
+        assert ring.get(out) == pytest.approx(i / 10)
+        assert (out == i).all()
+    assert ring.get(out, timeout=0) is None
+
+
+def test_block_ring_drops_oldest_on_overrun():
+    ring = BlockRing(capacity=4, block_size=4)
+    out = np.empty(4, dtype=np.float32)
+    for i, block in enumerate(blocks(6)):
+        ring.put(block, float(i))
+    assert ring.overruns == 2
+    assert ring.get(out) == 2.0
+
+
+def test_block_ring_skips_to_newest_when_lagging():
+    ring = BlockRing(capacity=8, block_size=4, max_lag=2)
+    out = np.empty(4, dtype=np.float32)
+    for i, block in enumerate(blocks(5)):
+        ring.put(block, float(i))
+    assert ring.get(out) == 4.0
+    assert ring.skipped == 4
+
+
+def test_block_ring_waits_instead_of_dropping():
+    ring = BlockRing(capacity=2, block_size=4, max_lag=1)
+    out = np.empty(4, dtype=np.float32)
+    producer = threading.Thread(target=lambda: [ring.put(block, float(i), wait=True)
+                                                for i, block in enumerate(blocks(10))])
+    producer.start()
+    timestamps = [ring.get(out, timeout=5) for _ in range(10)]
+    producer.join(5)
+    assert timestamps == [float(i) for i in range(10)]
+    assert ring.overruns == ring.skipped == 0
@@ -0,0 +1,64 @@
+import struct
+import uuid
+
+import numpy as np
+
+from homestage.e131 import DMX_OFFSET, E131Packet, E131SyncPacket, discovery_packets
+
+CID = uuid.UUID('12345678-1234-5678-1234-567812345678').bytes
+
+
+def flags_length(buffer, offset):
+    value = struct.unpack_from('!H', buffer, offset)[0]
+    assert value >> 12 == 0x7
+    return value & 0x0fff
+
+
+def test_data_packet_layout():
+    packet = E131Packet(7, CID, 'homestage', priority=150, slots=512, sync_address=3)
+    buffer = bytes(packet.next())
+    assert len(buffer) == 638
+
+    # root layer
+    assert struct.unpack_from('!HH12s', buffer, 0) == (0x0010, 0x0000, b'ASC-E1.17\x00\x00\x00')
+    assert flags_length(buffer, 16) == 638 - 16
+    assert struct.unpack_from('!I16s', buffer, 18) == (0x00000004, CID)
+
+    # framing layer
+    assert flags_length(buffer, 38) == 638 - 38
+    assert struct.unpack_from('!I', buffer, 40)[0] == 0x00000002
+    assert buffer[44:108] == b'homestage'.ljust(64, b'\x00')
+    assert struct.unpack_from('!BHBBH', buffer, 108) == (150, 3, 0, 0, 7)
+
+    # DMP layer
+    assert flags_length(buffer, 115) == 638 - 115
+    assert struct.unpack_from('!BBHHHB', buffer, 117) == (0x02, 0xa1, 0x0000, 0x0001, 513, 0)
+    assert DMX_OFFSET == 126
+
+
+def test_data_packet_updates_in_place():
+    packet = E131Packet(1, CID, 'homestage')
+    packet.dmx[:] = np.arange(512) % 256
+    packet.priority = 50
+    packet.sync_address = 9
+    sequences = [bytes(packet.next())[111] for _ in range(258)]
+    assert sequences[:3] == [0, 1, 2]
+    assert sequences[255:] == [255, 0, 1]
+    buffer = bytes(packet.view)
+    assert list(buffer[DMX_OFFSET:]) == [i % 256 for i in range(512)]
+    assert (buffer[108], struct.unpack_from('!H', buffer, 109)[0]) == (50, 9)
+
+
+def test_sync_and_discovery_packets():
+    sync = bytes(E131SyncPacket(9, CID).next())
+    assert len(sync) == 49
+    assert struct.unpack_from('!I', sync, 18)[0] == 0x00000008
+    assert flags_length(sync, 38) == 49 - 38
+    assert struct.unpack_from('!IBH', sync, 40) == (0x00000001, 0, 9)
+
+    pages = discovery_packets(list(range(600, 0, -1)), CID, 'homestage')
+    assert [len(page) for page in pages] == [120 + 2 * 512, 120 + 2 * 88]
+    first = pages[0]
+    assert struct.unpack_from('!I', first, 40)[0] == 0x00000002
+    assert struct.unpack_from('!IBB', first, 114) == (0x00000001, 0, 1)
+    assert struct.unpack_from('!3H', first, 120) == (1, 2, 3)
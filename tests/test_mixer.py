@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from homestage.fixtures import LEDWash, MovingHeadLight
+from homestage.mixer import LTP, Mixer
+from homestage.patterns import Pattern
+from homestage.rig import Rig
+
+
+class Solid(Pattern):
+    def __init__(self, r, pan):
+        self.r = r
+        self.pan = pan
+
+    def update(self, rig, frame):
+        rig.r = self.r
+        rig.pan = self.pan
+        return False
+
+
+def render(mixer, rig, time):
+    mixer.update(rig, SimpleNamespace(time=time))
+    return rig.r.copy(), rig.pan.copy()
+
+
+def stage():
+    return Rig([MovingHeadLight(0, 1), MovingHeadLight(14, 1), LEDWash(28, 1)])
+
+
+def test_crossfade_merges_intensity_htp_and_the_rest_ltp():
+    rig = stage()
+    mixer = Mixer(Solid(200, 0), fade_curve='linear')
+    render(mixer, rig, 0.0)
+    mixer.crossfade(Solid(100, 100), duration=1.0)
+
+    r, pan = render(mixer, rig, 0.5)
+    # both layers at half level: the brighter one wins, and the incoming layer moves pan halfway from the outgoing
+    # layer's to its own
+    assert r == pytest.approx(100)
+    assert pan == pytest.approx(50)
+
+    r, pan = render(mixer, rig, 0.75)
+    assert r == pytest.approx(75)
+    # the outgoing layer still sets pan first every frame, so the blend doesn't build on the last one
+    assert pan == pytest.approx(75)
+
+    r, pan = render(mixer, rig, 1.0)
+    assert len(mixer.layers) == 1
+    assert r == pytest.approx(100)
+    assert pan == pytest.approx(100)
+
+
+def test_merge_override_and_group_layers():
+    rig = stage()
+    mixer = Mixer(Solid(200, 0), merge={'r': LTP})
+    mixer.add(Solid(100, 100), level=0.5, groups=['LEDWash'])
+    r, pan = render(mixer, rig, 0.0)
+    # r merges LTP now, and the layer on top only reaches the wash
+    assert np.allclose(r, [200, 200, 150])
+    assert np.allclose(pan[:2], 0)
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from marshmallow import ValidationError
+
+from homestage.model import AnalysisSchema, Section, Segment, TimingList, decode_analysis
+
+ANALYSIS = {
+    'energy': 0.8,
+    'tempo': 'ignored',
+    'sections': [
+        {'start': 10.0, 'duration': 5.0, 'loudness': -6.5},
+        {'start': 0.0, 'duration': 10.0, 'loudness': -8.0, 'tempo': 120.0},
+    ],
+    'segments': [
+        {'start': 0.0, 'duration': 0.5, 'pitches': [0.5] * 12},
+        {'start': 0.5, 'duration': 0.25, 'loudness_max': -3.0},
+    ],
+}
+
+
+def test_decode_analysis_matches_schema():
+    analysis = decode_analysis(ANALYSIS)
+    expected = AnalysisSchema().load(ANALYSIS, unknown='exclude')
+    assert analysis.energy == pytest.approx(expected.energy)
+    for name in ('sections', 'segments'):
+        decoded = list(getattr(analysis, name))
+        loaded = sorted(getattr(expected, name), key=lambda timing: timing.start)
+        assert len(decoded) == len(loaded)
+        for a, b in zip(decoded, loaded):
+            for field in type(a).fields:
+                assert getattr(a, field) == pytest.approx(getattr(b, field), nan_ok=True)
+
+
+def test_decode_analysis_sorts_and_fills_optional_fields():
+    analysis = decode_analysis(ANALYSIS)
+    assert list(analysis.sections.starts) == [0.0, 10.0]
+    first, second = analysis.sections
+    assert (first.duration, first.tempo) == (10.0, 120.0)
+    assert second.loudness == pytest.approx(-6.5)
+    assert second.tempo is None
+    segment = analysis.segments[1]
+    assert segment.loudness_max == pytest.approx(-3.0)
+    assert segment.loudness_start is None
+    assert segment.pitches is None
+    assert np.allclose(analysis.segments[0].pitches, 0.5)
+
+
+def test_decode_analysis_errors():
+    assert len(decode_analysis(None).sections) == 0
+    with pytest.raises(ValidationError) as error:
+        decode_analysis({'energy': 'loud', 'sections': [{'start': 0.0}, 'nope'], 'segments': {}})
+    assert error.value.messages == {
+        'energy': ['Not a valid number.'],
+        'sections': {0: {'duration': ['Missing data for required field.']},
+                     1: {'_schema': ['Invalid input type.']}},
+        'segments': ['Not a valid list.'],
+    }
+
+
+def test_timing_list_at_follows_playback_and_seeks():
+    sections = TimingList([Section(i * 2.0, 2.0) for i in range(20)])
+    assert sections.at(-1.0) is None
+    # forward in small steps, then jumps both ways
+    for offset in list(np.arange(0, 40, 0.3)) + [35.0, 1.0, 39.9, 0.0, 100.0]:
+        section = sections.at(offset)
+        assert section.start == min(int(offset // 2) * 2.0, 38.0)
+    assert sections[-1] == sections.at(100.0)
+    with pytest.raises(IndexError):
+        sections[20]
+
+
+def test_timing_list_columns():
+    segments = TimingList([Segment(0.0, 1.0, timbre=list(range(12))), Segment(1.0, 1.0)])
+    assert segments.item_type is Segment
+    assert segments.columns['start'].dtype == np.float64
+    assert segments.columns['loudness_max'].dtype == np.float32
+    assert segments.columns['timbre'].shape == (2, 12)
+    assert list(segments[0].timbre) == list(range(12))
+    assert segments[1].timbre is None
@@ -0,0 +1,74 @@
+import numpy as np
+
+from homestage.recording import GAP, ShowRecorder, ShowRecording, encode_delta, run_positions
+from homestage.universe import Universe
+
+
+def record(tmp_path, positions, frames, keyframe_interval=8):
+    universe = Universe([1, 2])
+    recorder = ShowRecorder(str(tmp_path / 'show'), 'spotify:track:test', universe, fps=10,
+                            keyframe_interval=keyframe_interval)
+    for position, frame in zip(positions, frames):
+        recorder.add(position, frame)
+    return ShowRecording(recorder.close())
+
+
+def changing_frames(count, size=1024, seed=0):
+    # small local changes most frames, the whole buffer now and then
+    rng = np.random.default_rng(seed)
+    data = np.zeros(size, dtype=np.uint8)
+    frames = []
+    for i in range(count):
+        if i % 17 == 0:
+            data = rng.integers(0, 256, size, dtype=np.uint8)
+        else:
+            start = int(rng.integers(0, size - 40))
+            data[start:start + int(rng.integers(1, 40))] = rng.integers(0, 256)
+            data[int(rng.integers(0, size))] ^= 0xff
+        frames.append(data.copy())
+    return frames
+
+
+def test_delta_round_trip():
+    rng = np.random.default_rng(1)
+    previous = rng.integers(0, 256, 1024, dtype=np.uint8)
+    for changed in (0, 1, 5, 100, 1024):
+        current = previous.copy()
+        positions = rng.choice(1024, changed, replace=False)
+        current[positions] = ~current[positions]
+        runs, payload = encode_delta(previous, current)
+        decoded = previous.copy()
+        decoded[run_positions(runs['start'], runs['length'])] = payload
+        assert np.array_equal(decoded, current)
+
+
+def test_frames_round_trip(tmp_path):
+    frames = changing_frames(100)
+    recording = record(tmp_path, [i / 10 for i in range(100)], frames)
+    try:
+        assert recording.count == 100
+        for i, frame in enumerate(frames):
+            assert np.array_equal(recording.frame(i), frame)
+        # seeking back and forth decodes from the nearest keyframe
+        for i in np.random.default_rng(2).integers(0, 100, 200):
+            assert np.array_equal(recording.frame(int(i)), frames[i])
+    finally:
+        recording.close()
+
+
+def test_dropped_frames_repeat_and_seeks_leave_gaps(tmp_path):
+    frames = changing_frames(6)
+    # slot 2 is dropped, then a seek jumps from slot 3 to slot 20
+    recording = record(tmp_path, [0.0, 0.1, 0.3, 2.0, 2.1, 2.2], frames[:6])
+    try:
+        assert recording.count == 23
+        assert np.array_equal(recording.frame_at(0.2), frames[1])
+        assert np.array_equal(recording.frame_at(0.3), frames[2])
+        assert all(recording.index[i] == GAP for i in range(4, 20))
+        assert recording.frame_at(1.0) is None
+        assert np.array_equal(recording.frame_at(2.1), frames[4])
+        assert np.array_equal(recording.frame_at(0.1), frames[1])
+        assert np.array_equal(recording.frame_at(2.2), frames[5])
+        assert np.array_equal(recording.frame_at(2.0), frames[3])
+    finally:
+        recording.close()
@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+from homestage.timeline import SECTION, SEGMENT, CueSchedule
+
+
+def schedule(seek_threshold=1.0):
+    sections = SimpleNamespace(starts=[0.0, 10.0, 20.0])
+    segments = SimpleNamespace(starts=[0.0, 0.5, 10.0, 10.2, 10.4])
+    return CueSchedule(sections, segments, seek_threshold)
+
+
+def test_every_boundary_once_in_order():
+    cues = schedule()
+    assert cues.advance(None) == []
+    assert cues.advance(0.0) == [(SECTION, 0), (SEGMENT, 0)]
+    assert cues.advance(0.1) == []
+    assert cues.advance(0.6) == [(SEGMENT, 1)]
+    events = []
+    for i in range(7, 106):
+        events += cues.advance(i / 10)
+    # several boundaries inside one frame all come out, the section before the segment at the same time
+    assert events == [(SECTION, 1), (SEGMENT, 2), (SEGMENT, 3), (SEGMENT, 4)]
+    assert (cues.section, cues.segment) == (1, 4)
+
+
+def test_seek_reports_only_what_changed():
+    cues = schedule()
+    cues.advance(0.0)
+    assert cues.advance(10.3) == [(SECTION, 1), (SEGMENT, 3)]
+    # a jump backwards within the same section only reports the segment
+    assert cues.advance(10.1) == [(SEGMENT, 2)]
+    assert cues.advance(10.1) == []
+    # losing the playhead and finding it again where it was reports nothing new
+    cues.advance(None)
+    assert cues.advance(10.15) == []
+    assert cues.advance(25.0) == [(SECTION, 2), (SEGMENT, 4)]
+
+
+def test_lookahead():
+    cues = schedule()
+    assert cues.next_boundary(SECTION, 0.0) == 10.0
+    assert cues.next_boundary(SEGMENT, 10.0) == 10.2
+    assert cues.time_to_next(SECTION, 9.5) == 0.5
+    assert cues.next_boundary(SECTION, 20.0) is None
+    assert cues.time_to_next(SEGMENT, 11.0) is None
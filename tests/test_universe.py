@@ -0,0 +1,37 @@
+import pytest
+
+from homestage.fixtures import LEDWash, MovingHeadLight
+from homestage.universe import allocate
+
+
+def placement(fixtures):
+    return [(fixture.universe, fixture.address) for fixture in fixtures]
+
+
+def test_patched_and_address_only_fixtures_keep_their_place():
+    fixtures = allocate([MovingHeadLight(0, 2), LEDWash(20), LEDWash(20), LEDWash()], first_universe=1)
+    # fixtures sharing an address mirror each other; the free one goes in the first gap
+    assert placement(fixtures) == [(2, 0), (1, 20), (1, 20), (1, 0)]
+
+
+def test_packs_into_gaps_and_further_universes():
+    fixtures = allocate([LEDWash(0, 1)] + [MovingHeadLight() for _ in range(40)], first_universe=1, size=64)
+    assert placement(fixtures)[:5] == [(1, 0), (1, 7), (1, 21), (1, 35), (1, 49)]
+    assert placement(fixtures)[5] == (2, 0)
+    for universe in {fixture.universe for fixture in fixtures}:
+        ranges = sorted((f.address, f.address + len(f.channels)) for f in fixtures if f.universe == universe)
+        assert all(end <= start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+        assert ranges[-1][1] <= 64
+
+
+def test_overlaps_and_misfits_raise():
+    with pytest.raises(ValueError):
+        allocate([MovingHeadLight(0, 1), LEDWash(10, 1)])
+    with pytest.raises(ValueError):
+        allocate([MovingHeadLight(0, 1), LEDWash(10)], first_universe=1)
+    with pytest.raises(ValueError):
+        allocate([LEDWash(510, 1)])
+    with pytest.raises(ValueError):
+        allocate([MovingHeadLight()], size=8)
+    # an address-only fixture only clashes with what's patched into first_universe
+    assert placement(allocate([MovingHeadLight(0, 1), LEDWash(10)], first_universe=2)) == [(1, 0), (2, 10)]